@@ -223,6 +223,37 @@ class PatchLevelDecoder(PreTrainedModel):
         torch.nn.init.normal_(self.patch_embedding.weight, std=0.02)
         self.base = GPT2Model(config)
 
+    def embedding_table(self) -> torch.Tensor:
+        """
+        The patch_embedding weight transposed to [PATCH_SIZE * 128, hidden], so that row position * 128 + char is the
+        column of that char at that position. It is rebuilt on every call with grad (training), and cached until the
+        weight changes otherwise (generation).
+        """
+        weight = self.patch_embedding.weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return weight.t().contiguous()
+        key = (weight.data_ptr(), weight._version, weight.dtype, weight.device)
+        if getattr(self, '_embedding_table_key', None) != key:
+            with torch.no_grad():
+                self._embedding_table = weight.t().contiguous()
+            self._embedding_table_key = key
+        return self._embedding_table
+
+    def embed(self, patches: torch.Tensor) -> torch.Tensor:
+        """
+        Embed the patches, equal to applying patch_embedding to their one-hot chars.
+        Instead of building the sparse [.., PATCH_SIZE * 128] one-hot tensor, the PATCH_SIZE rows of each patch
+        are gathered from the embedding table and summed with embedding_bag.
+        :param patches: the chars of the patches, of shape [batch, length * PATCH_SIZE] or [batch, length, PATCH_SIZE]
+        :return: the patch embeddings, of shape [batch, length, hidden]
+        """
+        batch_size = len(patches)
+        patches = patches.to(self.device).reshape(-1, PATCH_SIZE)
+        offsets = torch.arange(PATCH_SIZE, device=patches.device) * 128
+        embeddings = torch.nn.functional.embedding_bag(patches + offsets, self.embedding_table(), mode='sum')
+        embeddings = embeddings + self.patch_embedding.bias
+        return embeddings.reshape(batch_size, -1, embeddings.shape[-1])
+
     def forward(self,
                 patches: torch.Tensor,
                 masks=None) -> torch.Tensor:
@@ -232,9 +263,7 @@ class PatchLevelDecoder(PreTrainedModel):
         :param masks: the masks for the patches
         :return: the encoded patches
         """
-        patches = torch.nn.functional.one_hot(patches, num_classes=128).to(self.dtype)
-        patches = patches.reshape(len(patches), -1, PATCH_SIZE * (128))
-        patches = self.patch_embedding(patches.to(self.device))
+        patches = self.embed(patches)
 
         if masks==None:
             return self.base(inputs_embeds=patches)
@@ -350,13 +379,15 @@ class NotaGenLMHeadModel(PreTrainedModel):
                  patches: torch.Tensor,
                  top_k=0,
                  top_p=1,
-                 temperature=1.0):
+                 temperature=1.0,
+                 stop_at_eos=True):
         """
         The generate function for generating patches based on patches.
         :param patches: the patches to be encoded
         :param top_k: the top k for sampling
         :param top_p: the top p for sampling
         :param temperature: the temperature for sampling
+        :param stop_at_eos: stop at the eos char and pad the rest of the patch with the special char
         :return: the generated patches
         """
         if patches.shape[-1] % PATCH_SIZE != 0:
@@ -378,7 +409,10 @@ class NotaGenLMHeadModel(PreTrainedModel):
             char = chr(token)
             generated_patch.append(token)
 
-            if len(tokens) >= PATCH_SIZE:# or token == self.eos_token_id:
+            if len(tokens) >= PATCH_SIZE:
+                break
+            elif stop_at_eos and token == self.eos_token_id:
+                generated_patch += [self.special_token_id] * (PATCH_SIZE - len(tokens))
                 break
             else:
                 tokens = torch.cat((tokens, torch.tensor([token], device=self.device)), dim=0)
@@ -1,18 +1,17 @@
 # import spaces
 # import zero
 import gradio as gr
-import sys
-import threading
-import queue
 import time
 import random
-from io import TextIOBase
+import asyncio
 import datetime
 import os
+import threading
 
-from gradio_app.inference import postprocess_inst_names
-from gradio_app.inference import inference_patch
+from gradio_app.inference import postprocess_inst_names, load_models, GenerationCancelled
+from gradio_app.service import GenerationService
 from gradio_app.convert import abc2xml, xml2, pdf2img
+from gradio_app.ms import mscore
 
 
 title_html = """
@@ -81,14 +80,8 @@ def update_components(period, composer):
         )
     ]
 
-# Custom realtime stream for outputting model inference process to frontend
-class RealtimeStream(TextIOBase):
-    def __init__(self, queue):
-        self.queue = queue
-
-    def write(self, text):
-        self.queue.put(text)
-        return len(text)
+# All clicks share one model, their pieces are generated in one continuous batch by the worker of the service
+service = GenerationService()
 
 def convert_files(abc_content, period, composer, instrumentation):
     if not all([period, composer, instrumentation]):
@@ -177,7 +170,7 @@ def update_page(direction, data):
 
 
 # @spaces.GPU(duration=600)
-def generate_music(period, composer, instrumentation):
+async def generate_music(period, composer, instrumentation):
     """
     Must ensure each yield returns the same number of values.
     We're preparing to return 5 values, corresponding to:
@@ -211,22 +204,10 @@ def generate_music(period, composer, instrumentation):
         # If the combination is invalid, raise an error
         raise gr.Error("Invalid prompt combination! Please re-select from the period options")
 
-    output_queue = queue.Queue()
-    original_stdout = sys.stdout
-    sys.stdout = RealtimeStream(output_queue)
-
-    result_container = []
-
-    def run_inference():
-        try:
-            # Use downloaded model weights path for inference
-            result = inference_patch(period, composer, instrumentation)
-            result_container.append(result)
-        finally:
-            sys.stdout = original_stdout
-
-    thread = threading.Thread(target=run_inference)
-    thread.start()
+    try:
+        request = await service.submit((period, composer, instrumentation))
+    except RuntimeError as e:
+        raise gr.Error(str(e))
 
     process_output = ""
     final_output_abc = ""
@@ -235,22 +216,22 @@ def generate_music(period, composer, instrumentation):
     pdf_state = None
 
     # First continuously read intermediate output
-    while thread.is_alive():
-        try:
-            text = output_queue.get(timeout=0.1)
-            process_output += text
+    try:
+        async for event in request:
+            if event.kind == 'line':
+                continue    # the text of the lines comes with the patches
+            process_output += event.text
             # No final ABC yet, files not yet converted
             yield process_output, final_output_abc, pdf_image, audio_file, pdf_state, gr.update(value=None, visible=False)
-        except queue.Empty:
-            continue
-
-    # After thread ends, get all remaining items from the queue
-    while not output_queue.empty():
-        text = output_queue.get()
-        process_output += text
+    finally:
+        # The page was closed or the event was cancelled: free the lane instead of finishing the piece
+        request.cancel()
 
     # Final inference result
-    final_result = result_container[0] if result_container else ""
+    try:
+        final_result = request.result() or ""
+    except GenerationCancelled as e:
+        raise gr.Error(str(e))
     
     # Display file conversion prompt
     final_output_abc = "Converting files..."
@@ -259,7 +240,7 @@ def generate_music(period, composer, instrumentation):
 
     # Convert files
     try:
-        file_paths = convert_files(final_result, period, composer, instrumentation)
+        file_paths = await asyncio.to_thread(convert_files, final_result, period, composer, instrumentation)
         final_output_abc = final_result
         # Get the first image and mp3 file
         if file_paths['pages'] > 0:
@@ -531,6 +512,10 @@ if __name__ == "__main__":
     # Configure GPU/CPU handling
     #demo.enable_queue()
 
+    # Load the model and fetch MuseScore while the server starts, the first click waits for them if still loading
+    threading.Thread(target=load_models, daemon=True).start()
+    threading.Thread(target=mscore, daemon=True).start()
+
     demo.launch(
         server_name="0.0.0.0",
         server_port=7860
@@ -0,0 +1,112 @@
+
+import os
+import time
+import torch
+import typer
+import random
+import functools
+
+from gradio_app.config import *
+from gradio_app.utils import NotaGenLMHeadModel, GenerationSession, autocast, cpu_supports_bf16, load_model, quantize_int8, weights_file
+from gradio_app import inference
+from gradio_app.inference import PieceGeneration
+
+
+
+app = typer.Typer()
+
+
+def load(precision):
+	"""
+	Load the model on the cpu as load_models() does with CPU_PRECISION = precision.
+	"""
+	dtype = torch.bfloat16 if precision == 'bfloat16' else torch.float32
+	weights_path = weights_file(os.path.join(inference.MODEL_CACHE_DIR, INFERENCE_WEIGHTS_PATH),
+								dtype=torch.float16 if precision == 'int8' else dtype)
+	model = load_model(lambda: NotaGenLMHeadModel(encoder_config=inference.patch_config, decoder_config=inference.byte_config),
+					   weights_path, 'cpu', dtype)
+	if precision == 'int8':
+		quantize_int8(model)
+	return model
+
+
+def generate(model, prompt, num_patches):
+	"""
+	Generate up to num_patches patches of a piece, return the number of patches, the patches of the piece and the
+	seconds taken.
+	"""
+	piece = PieceGeneration(*prompt, verbose=False)
+	session = GenerationSession(model)
+
+	count = 0
+	start_time = time.time()
+	with torch.inference_mode(), autocast('cpu', model.dtype):
+		session.reset(piece.prompt_patches())
+		while count < num_patches and not piece.stop_flag:
+			predicted_patch = piece.next_patch(functools.partial(session.generate, top_k=TOP_K, top_p=TOP_P, temperature=TEMPERATURE))
+			piece.advance(session, predicted_patch)
+			count += 1
+
+			if not piece.stop_flag and len(session) >= PATCH_LENGTH * PATCH_SIZE:
+				piece.shift_window(session.reset)
+
+	return count, session.input_patches, time.time() - start_time
+
+
+def char_logits(model, patches):
+	"""
+	The teacher-forced logits of every char of the patches after the first, [num_patches - 1, patch_size, vocab_size].
+	"""
+	patches = patches[0, :patches.shape[-1] // PATCH_SIZE * PATCH_SIZE].reshape(-1, PATCH_SIZE)
+	with torch.inference_mode(), autocast('cpu', model.dtype):
+		encoded_patches = model.patch_level_decoder(patches.unsqueeze(0))["last_hidden_state"][0]
+		tokens = torch.full((len(patches) - 1, 1), model.bos_token_id, dtype=torch.long)
+		tokens = torch.cat((tokens, patches[1:, :-1]), dim=1)
+		return model.char_level_decoder.score(encoded_patches[:-1], tokens).float()
+
+
+@app.command()
+def main(
+	precisions: str = typer.Option('float32,bfloat16,int8', help="Comma separated cpu precisions to compare with float32"),
+	patches: int = typer.Option(64, help="Number of patches to generate per precision"),
+	threads: int = typer.Option(0, help="Intra-op threads (0 for the torch default)"),
+	period: str = typer.Option('Classical'),
+	composer: str = typer.Option('Beethoven, Ludwig van'),
+	instrumentation: str = typer.Option('Keyboard'),
+	seed: int = typer.Option(0),
+):
+	"""
+	Compare the cpu precisions: patches per second generating a piece, and the parity of the char logits with float32
+	on the patches the float32 model generated (mean KL divergence of the distributions, agreement of the most likely
+	chars, largest logit difference).
+	"""
+	if threads:
+		torch.set_num_threads(threads)
+	print(f'{torch.get_num_threads()} threads, native bfloat16: {cpu_supports_bf16()}')
+	prompt = (period, composer, instrumentation)
+
+	reference_model = load('float32')
+	_, reference_patches, _ = generate(reference_model, prompt, patches)
+	reference_logits = char_logits(reference_model, reference_patches)
+	reference_log_probs = torch.log_softmax(reference_logits, dim=-1)
+	del reference_model
+
+	for precision in precisions.split(','):
+		model = load(precision)
+		random.seed(seed)
+		torch.manual_seed(seed)
+		generate(model, prompt, 2)    # warm up
+		num_patches, _, seconds = generate(model, prompt, patches)
+
+		logits = char_logits(model, reference_patches)
+		log_probs = torch.log_softmax(logits, dim=-1)
+		kl = (reference_log_probs.exp() * (reference_log_probs - log_probs)).sum(-1).mean().item()
+		top1 = (reference_logits.argmax(-1) == logits.argmax(-1)).float().mean().item()
+		max_diff = (reference_logits - logits).abs().max().item()
+		print(f'{precision}\t{num_patches / seconds:.2f} patches/s'
+			f'\tKL: {kl:.5f}\ttop-1 agreement: {top1:.4f}\tmax logit difference: {max_diff:.3f}')
+		del model
+
+
+if __name__ == "__main__":
+	app()
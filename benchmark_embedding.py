@@ -0,0 +1,81 @@
+
+import time
+import torch
+import typer
+
+from transformers import GPT2Config
+from gradio_app.config import *
+from gradio_app.utils import PatchLevelDecoder
+
+
+
+app = typer.Typer()
+
+
+def one_hot_embed(decoder, patches):
+	"""
+	The previous patch embedding: patch_embedding applied to the dense one-hot chars.
+	"""
+	patches = torch.nn.functional.one_hot(patches, num_classes=128).to(decoder.dtype)
+	patches = patches.reshape(len(patches), -1, PATCH_SIZE * (128))
+	return decoder.patch_embedding(patches.to(decoder.device))
+
+
+def measure(embed, patches, steps, backward):
+	"""
+	Return the milliseconds per step, and the peak memory in MB on cuda (None on cpu).
+	"""
+	device = patches.device
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+		torch.cuda.reset_peak_memory_stats()
+		base_memory = torch.cuda.memory_allocated()
+
+	start_time = time.time()
+	for _ in range(steps):
+		embeddings = embed(patches)
+		if backward:
+			embeddings.sum().backward()
+	if device.type == 'cuda':
+		torch.cuda.synchronize()
+	ms = (time.time() - start_time) * 1000 / steps
+
+	memory = (torch.cuda.max_memory_allocated() - base_memory) / 2**20 if device.type == 'cuda' else None
+	return ms, memory
+
+
+@app.command()
+def main(
+	batch_size: int = typer.Option(1, help="Number of sequences per batch"),
+	length: int = typer.Option(PATCH_LENGTH, help="Number of patches per sequence"),
+	steps: int = typer.Option(10, help="Number of timed steps"),
+	backward: bool = typer.Option(True, help="Time the backward pass of training as well"),
+	dtype: str = typer.Option('float32', help="Weight dtype, e.g. float32 or float16"),
+):
+	"""
+	Compare the speed and memory of the embedding-bag patch embedding with the one-hot one at the patch-level decoder
+	size of gradio_app/config.py. Their parity is checked by tests/test_embedding.py.
+	"""
+	device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+	config = GPT2Config(num_hidden_layers=1,
+						max_length=length,
+						max_position_embeddings=length,
+						n_embd=HIDDEN_SIZE,
+						num_attention_heads=HIDDEN_SIZE // 64,
+						vocab_size=1)
+	decoder = PatchLevelDecoder(config).to(device, getattr(torch, dtype))
+	patches = torch.randint(0, 128, (batch_size, length * PATCH_SIZE), device=device)
+
+	one_hot_bytes = batch_size * length * PATCH_SIZE * 128 * decoder.dtype.itemsize
+	print(f'one-hot input: {one_hot_bytes / 2**20:.1f} MB per batch')
+
+	torch.set_grad_enabled(backward)
+	for name, embed in (('one-hot', lambda p: one_hot_embed(decoder, p)), ('embedding-bag', decoder.embed)):
+		measure(embed, patches, 1, backward)     # warm up
+		ms, memory = measure(embed, patches, steps, backward)
+		memory = '' if memory is None else f'\tpeak memory: {memory:.1f} MB'
+		print(f'{name}\t{ms:.2f} ms/batch\t{batch_size * length / ms:.0f} patches/ms{memory}')
+
+
+if __name__ == "__main__":
+	app()
@@ -0,0 +1,93 @@
+
+import time
+import torch
+import typer
+import random
+import functools
+
+from gradio_app.config import *
+from gradio_app.utils import GenerationSession, autocast
+from gradio_app import inference
+from gradio_app.inference import load_models, PieceGeneration
+
+
+
+app = typer.Typer()
+
+
+def generate_piece(model, prompt, num_patches):
+	"""
+	Generate up to num_patches patches of a piece with a float cache.
+	:return: the prompt patches, and the patches the session holds after them
+	"""
+	piece = PieceGeneration(*prompt, verbose=False)
+	session = GenerationSession(model)
+	prompt_patches = piece.prompt_patches()
+	session.reset(prompt_patches)
+	count = 0
+	while count < num_patches and not piece.stop_flag and len(session) < (PATCH_LENGTH - 1) * PATCH_SIZE:
+		predicted_patch = piece.next_patch(functools.partial(session.generate, top_k=TOP_K, top_p=TOP_P, temperature=TEMPERATURE))
+		piece.advance(session, predicted_patch)
+		count += 1
+	history = session.input_patches[0, len(prompt_patches) * PATCH_SIZE:session.num_patches * PATCH_SIZE]
+	return prompt_patches, history.reshape(-1, PATCH_SIZE).tolist()
+
+
+def replay(model, prompt_patches, patches, quantize_cache):
+	"""
+	Append the patches one by one to a session, as the generation loop does, and score the chars of each patch
+	from the feature of the patches before it.
+	:return: the char logits [num_patches, patch_size, vocab_size], the bytes of the cache, its length in patches,
+			 and the seconds taken
+	"""
+	session = GenerationSession(model, quantize_cache=quantize_cache)
+	session.reset(prompt_patches)
+	logits = []
+	start_time = time.time()
+	for patch in patches:
+		tokens = torch.tensor([[model.bos_token_id] + patch[:-1]], device=model.device)
+		logits.append(model.char_level_decoder.score(session.encoded_patch.unsqueeze(0), tokens)[0].float())
+		session.append(patch)
+	seconds = time.time() - start_time
+	return torch.stack(logits), session.batch.cache_bytes(), session.batch.attention_mask.shape[1], seconds
+
+
+@app.command()
+def main(
+	patches: int = typer.Option(256, help="Number of patches to generate and replay"),
+	period: str = typer.Option('Classical'),
+	composer: str = typer.Option('Beethoven, Ludwig van'),
+	instrumentation: str = typer.Option('Keyboard'),
+	seed: int = typer.Option(0),
+):
+	"""
+	Compare the float and int8 patch-level key/value caches: bytes per cached patch and lane, lanes of a full
+	PATCH_LENGTH context per GB, and the deviation of the char logits from those with the float cache while replaying
+	a generated piece (mean KL divergence, agreement of the most likely chars, largest logit difference).
+	"""
+	model = load_models()
+	random.seed(seed)
+	torch.manual_seed(seed)
+
+	with torch.inference_mode(), autocast(inference.device, inference.model_dtype()):
+		prompt_patches, piece_patches = generate_piece(model, (period, composer, instrumentation), patches)
+		results = {quantize_cache: replay(model, prompt_patches, piece_patches, quantize_cache) for quantize_cache in (False, True)}
+
+	reference_logits = results[False][0]
+	reference_log_probs = torch.log_softmax(reference_logits, dim=-1)
+	for quantize_cache, (logits, num_bytes, length, seconds) in results.items():
+		bytes_per_patch = num_bytes / length
+		log_probs = torch.log_softmax(logits, dim=-1)
+		kl = (reference_log_probs.exp() * (reference_log_probs - log_probs)).sum(-1).mean().item()
+		top1 = (reference_logits.argmax(-1) == logits.argmax(-1)).float().mean().item()
+		max_diff = (reference_logits - logits).abs().max().item()
+		print(f"{'int8' if quantize_cache else str(inference.model_dtype()).split('.')[-1]}"
+			f"\t{bytes_per_patch / 1024:.1f} KB/patch"
+			f"\tlanes per GB: {2 ** 30 / (bytes_per_patch * PATCH_LENGTH):.1f}"
+			f"\tsaving: {results[False][1] / num_bytes:.2f}x"
+			f"\t{seconds * 1000 / len(piece_patches):.1f} ms/patch"
+			f"\tKL: {kl:.5f}\ttop-1 agreement: {top1:.4f}\tmax logit difference: {max_diff:.3f}")
+
+
+if __name__ == "__main__":
+	app()
@@ -0,0 +1,91 @@
+
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+import typer
+
+
+
+app = typer.Typer()
+
+
+def legacy_load(inference):
+	"""
+	The previous startup: initialise the model, cast it to fp16, then torch.load the whole checkpoint and copy it in.
+	"""
+	import torch
+	from gradio_app.utils import NotaGenLMHeadModel
+
+	model = NotaGenLMHeadModel(encoder_config=inference.patch_config, decoder_config=inference.byte_config).to(inference.device)
+	model = model.to(dtype=torch.float16)
+	checkpoint = torch.load(os.path.join(inference.MODEL_CACHE_DIR, inference.INFERENCE_WEIGHTS_PATH), map_location=inference.device)
+	model.load_state_dict(checkpoint['model'])
+	return model.eval()
+
+
+@app.command()
+def measure(
+	loader: str = typer.Option('safetensors', help="'safetensors' for load_models(), 'pth' for the previous startup"),
+):
+	"""
+	Time the startup phases in this process and print them as JSON.
+	"""
+	start_time = time.time()
+	import torch
+	from gradio_app import inference
+	from gradio_app.utils import GenerationSession
+	import_time = time.time()
+
+	if loader == 'safetensors':
+		model = inference.load_models()
+	elif loader == 'pth':
+		model = legacy_load(inference)
+	else:
+		raise typer.BadParameter(f'Unknown loader: {loader}')
+	ready_time = time.time()
+
+	piece = inference.PieceGeneration('Classical', 'Beethoven, Ludwig van', 'Keyboard', verbose=False)
+	with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.float16):
+		session = GenerationSession(model)
+		session.reset(piece.prompt_patches())
+		session.generate(top_k=inference.TOP_K, top_p=inference.TOP_P, temperature=inference.TEMPERATURE)
+	if inference.device.type == 'cuda':
+		torch.cuda.synchronize()
+	first_patch_time = time.time()
+
+	print(json.dumps({
+		'import': import_time - start_time,
+		'ready': ready_time - start_time,
+		'first_patch': first_patch_time - start_time,
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+	}))
+
+
+@app.command()
+def main(
+	loaders: str = typer.Option('pth,safetensors', help="Comma separated loaders to compare"),
+	repeat: int = typer.Option(3, help="Number of fresh processes per loader"),
+):
+	"""
+	Compare the startup of fresh processes: seconds to import gradio_app.inference, to have the model ready to serve,
+	and to the first generated patch (each counted from the start of the process), with the peak resident memory.
+	The first safetensors run converts the checkpoint, so it is reported separately. Later runs read the files
+	from the page cache.
+	"""
+	for loader in loaders.split(','):
+		runs = []
+		for i in range(repeat):
+			output = subprocess.run([sys.executable, __file__, 'measure', '--loader', loader],
+									check=True, capture_output=True, text=True).stdout
+			runs.append(json.loads(output.strip().split('\n')[-1]))
+		best = {name: min(run[name] for run in runs) for name in runs[0]}
+		print(f"{loader}\timport: {best['import']:.2f} s\tready: {best['ready']:.2f} s"
+			f"\tfirst patch: {best['first_patch']:.2f} s\tpeak memory: {best['peak_rss_mb']:.0f} MB"
+			f"\t(first run ready: {runs[0]['ready']:.2f} s)")
+
+
+if __name__ == "__main__":
+	app()
@@ -3,6 +3,9 @@ import os
 # Configuration for the data
 DATA_TRAIN_INDEX_PATH = "" 
 DATA_EVAL_INDEX_PATH  = ""
+DATA_TRAIN_PACKED_PATH = ""                                     # Shards written by pack_data.py from the train index, "" to read the abc files
+DATA_EVAL_PACKED_PATH  = ""                                     # Shards written by pack_data.py from the eval index, "" to read the abc files
+PACKED_SHARD_PIECES = 1024                                      # Pieces per shard written by pack_data.py
 
 # Configuration for the model
 PATCH_STREAM = True                                             # Stream training / inference
@@ -0,0 +1,110 @@
+import os
+import json
+import numpy as np
+from utils import *
+from config import *
+from tqdm import tqdm
+from multiprocessing import Pool
+from abctoolkit.transpose import Key2index
+
+KEYS = list(Key2index.keys())
+
+patchilizer = Patchilizer()
+
+
+def patchilize_piece(entry):
+    """
+    Patchilize a piece in each key, as read by NotaGenDataset.
+    :return: per key, the metadata patch ids, the tunebody patch ids and the indexes after the tunebody patches ending
+             a line; None if a key is missing or the piece has chars beyond ascii
+    """
+    folder = os.path.dirname(entry['path'])
+    name = os.path.split(entry['path'])[-1]
+    piece = []
+    for key in KEYS:
+        filepath = os.path.join(folder, key, name + '_' + key + '.abc')
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath, 'r', encoding='utf-8') as f:
+            abc_text = f.read()
+
+        metadata_patches, tunebody_patches, _ = patchilizer.patchilize_train(abc_text)
+        cuts = [index + 1 for index, patch in enumerate(tunebody_patches) if '\n' in patch]
+        patches = []
+        for patch in metadata_patches + tunebody_patches:
+            id_patch = [ord(c) for c in patch] + [patchilizer.special_token_id] * (PATCH_SIZE - len(patch))
+            if max(id_patch) >= 128:
+                return None
+            patches.append(id_patch)
+        piece.append((np.array(patches, dtype=np.uint8), len(metadata_patches), np.array(cuts, dtype=np.int32)))
+    return piece
+
+
+class ShardWriter:
+    def __init__(self, path):
+        self.path = path
+        self.num_pieces = 0
+        self.shard = None
+
+    def write(self, piece):
+        if self.num_pieces % PACKED_SHARD_PIECES == 0:
+            self.close_shard()
+            self.name = os.path.join(self.path, 'shard_%05d' % (self.num_pieces // PACKED_SHARD_PIECES))
+            self.shard = open(self.name + '.bin', 'wb')
+            self.index = []
+            self.cuts = []
+            self.num_patches = 0
+            self.num_cuts = 0
+
+        for patches, num_metadata_patches, cuts in piece:
+            self.shard.write(patches.tobytes())
+            self.index.append([self.num_patches, num_metadata_patches, len(patches) - num_metadata_patches,
+                               self.num_cuts, len(cuts)])
+            self.cuts.append(cuts)
+            self.num_patches += len(patches)
+            self.num_cuts += len(cuts)
+        self.num_pieces += 1
+        return self.num_pieces - 1
+
+    def close_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+            np.save(self.name + '.index.npy', np.array(self.index, dtype=np.int64).reshape(-1, 5))
+            np.save(self.name + '.cuts.npy', np.concatenate(self.cuts).astype(np.int32))
+            self.shard = None
+
+    def close(self):
+        self.close_shard()
+        with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'patch_size': PATCH_SIZE, 'stream': patchilizer.stream, 'keys': KEYS,
+                       'num_pieces': self.num_pieces, 'pieces_per_shard': PACKED_SHARD_PIECES}, f)
+
+
+def pack(index_path, packed_path):
+    """
+    Write the pieces of a data index to shards under packed_path, with index.jsonl listing the packed entries and the
+    number of their piece.
+    """
+    with open(index_path, 'r', encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f]
+
+    os.makedirs(packed_path, exist_ok=True)
+    writer = ShardWriter(packed_path)
+    num_skipped = 0
+    with Pool(os.cpu_count()) as pool, open(os.path.join(packed_path, 'index.jsonl'), 'w', encoding='utf-8') as index:
+        for entry, piece in tqdm(zip(entries, pool.imap(patchilize_piece, entries, chunksize=16)), total=len(entries)):
+            if piece is None:
+                num_skipped += 1
+                continue
+            entry = dict(entry, piece=writer.write(piece))
+            index.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    writer.close()
+
+    print(f'Packed {writer.num_pieces} pieces into {packed_path}, skipped {num_skipped} with a missing key or non-ascii chars')
+
+
+if __name__ == '__main__':
+    for index_path, packed_path in [(DATA_TRAIN_INDEX_PATH, DATA_TRAIN_PACKED_PATH),
+                                    (DATA_EVAL_INDEX_PATH, DATA_EVAL_PACKED_PATH)]:
+        if packed_path != '':
+            pack(index_path, packed_path)
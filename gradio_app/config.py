@@ -5,6 +5,29 @@ INFERENCE_WEIGHTS_PATH = 'weights_notagenx_p_size_16_p_length_1024_p_layers_20_h
 TOP_K = 9                                                       # Top k for sampling
 TOP_P = 0.9                                                      # Top p for sampling
 TEMPERATURE = 1.2                                                 # Temperature for sampling
+BATCH_SIZE = 1                                                   # Number of pieces generated in lockstep
+PREFIX_CACHE_MB = 256                                            # Memory budget of the cached prompt prefixes
+KV_CACHE_INT8 = False                                            # Keep the keys and values of the generated pieces in int8, about half the memory of float16
+KV_CACHE_MB = 0                                                  # Memory of a paged key/value cache shared by the batch (0 for a cache padded to the longest piece)
+KV_BLOCK_SIZE = 16                                               # Patches per block of the paged key/value cache
+PREFIX_CACHE_WARM = False                                        # Encode the prefixes of all prompts in prompts.txt at startup
+STREAM_OVERLAP = 0.5                                             # Share of the tunebody lines kept when the stream window shifts
+VALIDATE_LINES = True                                            # Check each generated tunebody line and resample it if invalid
+LINE_RETRIES = 3                                                 # Number of times an invalid line is resampled before it is kept
+REQUEST_DEADLINE = None                                          # Seconds a served request may run before it is abandoned (None for no limit)
+
+# Configurations for cpu inference
+CPU_PRECISION = 'float32'                                       # Models on the cpu: 'float32', or the faster 'int8' (dynamic int8 linear layers) or 'bfloat16' (float32 where the cpu lacks native bf16), which shift the outputs slightly
+CPU_THREADS = 0                                                 # Intra-op threads on the cpu (0 for the torch default, one per physical core)
+
+# Configurations for speculative decoding
+DRAFT_WEIGHTS_PATH = ''                                         # Path to weights of a smaller NotaGen model drafting patches, e.g. NotaGen-small ('' to disable)
+NUM_DRAFT_PATCHES = 4                                           # Number of patches drafted per pass of the model
+DRAFT_PATCH_LENGTH = 2048                                       # Patch Length of the draft model
+DRAFT_CHAR_NUM_LAYERS = 3                                       # Number of layers in the decoder of the draft model
+DRAFT_PATCH_NUM_LAYERS = 12                                     # Number of layers in the encoder of the draft model
+DRAFT_HIDDEN_SIZE = 768                                         # Hidden Size of the draft model
+BAR_LOOKUP = False                                              # Without a draft model, propose the patches that followed earlier repeats of the latest patches
 
 # Configurations for model
 PATCH_STREAM = True                                             # Stream training / inference
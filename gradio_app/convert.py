@@ -3,7 +3,7 @@ import subprocess
 import fitz
 from PIL import Image
 
-from .ms import MSCORE
+from .ms import mscore
 
 
 def abc2xml(filename_base):
@@ -26,7 +26,7 @@ def xml2(filename_base, target_fmt):
         target_fmt = "." + target_fmt
 
     target_file = filename_base + target_fmt
-    command = [MSCORE, "-o", target_file, xml_file]
+    command = [mscore(), "-o", target_file, xml_file]
     result = subprocess.run(command)
     return target_file
 
@@ -4,6 +4,10 @@ import time
 import torch
 import difflib
 import json
+import copy
+import functools
+import threading
+from collections import deque, Counter, namedtuple
 
 from .utils import *
 from .config import *
@@ -36,11 +40,96 @@ byte_config = GPT2Config(num_hidden_layers=CHAR_NUM_LAYERS,
                          num_attention_heads=HIDDEN_SIZE // 64,
                          vocab_size=128)
 
-model = NotaGenLMHeadModel(encoder_config=patch_config, decoder_config=byte_config).to(device)
-
+draft_patch_config = GPT2Config(num_hidden_layers=DRAFT_PATCH_NUM_LAYERS,
+                                max_length=DRAFT_PATCH_LENGTH,
+                                max_position_embeddings=DRAFT_PATCH_LENGTH,
+                                n_embd=DRAFT_HIDDEN_SIZE,
+                                num_attention_heads=DRAFT_HIDDEN_SIZE // 64,
+                                vocab_size=1)
+draft_byte_config = GPT2Config(num_hidden_layers=DRAFT_CHAR_NUM_LAYERS,
+                               max_length=PATCH_SIZE + 1,
+                               max_position_embeddings=PATCH_SIZE + 1,
+                               hidden_size=DRAFT_HIDDEN_SIZE,
+                               num_attention_heads=DRAFT_HIDDEN_SIZE // 64,
+                               vocab_size=128)
 
 MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', './')
 
+# The models are loaded by load_models() at their first use, not at import
+model = None
+draft_model = None
+prefix_cache = None
+models_lock = threading.Lock()
+
+
+def model_dtype(target=None):
+    """
+    The dtype of the models on a device: float16 on gpus; on the cpu, bfloat16 with CPU_PRECISION = 'bfloat16'
+    where the cpu computes it natively, and float32 otherwise (the int8 layers of CPU_PRECISION = 'int8' take float32
+    activations).
+    :param target: the device, defaults to that of the models
+    """
+    if torch.device(target or device).type != 'cpu':
+        return torch.float16
+    if CPU_PRECISION == 'bfloat16' and cpu_supports_bf16():
+        return torch.bfloat16
+    return torch.float32
+
+
+def quantized(target=None):
+    """
+    Whether the linear layers of the models are quantized to int8 on a device (see quantize_int8()).
+    """
+    return torch.device(target or device).type == 'cpu' and CPU_PRECISION == 'int8'
+
+
+def weights_dtype(target=None):
+    """
+    The dtype of the safetensors files the models are loaded from on a device: that of the models, or float16 for
+    the models quantized from it.
+    """
+    return torch.float16 if quantized(target) else model_dtype(target)
+
+
+def load_models():
+    """
+    Load the model, and the draft model if DRAFT_WEIGHTS_PATH is set, at the first call; later calls return at once.
+    The checkpoints are converted to safetensors files in the dtype of the models at their first load (see
+    weights_file()), which are then memory-mapped into the models. On the cpu with CPU_PRECISION = 'int8', the float16
+    file is read and the linear layers are quantized (see quantize_int8()).
+    :return: the model
+    """
+    global model, draft_model, prefix_cache
+    with models_lock:
+        if model is not None:
+            return model
+
+        if CPU_PRECISION not in ('int8', 'bfloat16', 'float32'):
+            raise ValueError(f'Unknown CPU_PRECISION: {CPU_PRECISION}')
+        dtype = model_dtype()
+        if device.type == 'cpu' and CPU_THREADS:
+            torch.set_num_threads(CPU_THREADS)
+
+        loaded_model = load_model(lambda: NotaGenLMHeadModel(encoder_config=patch_config, decoder_config=byte_config),
+                                  weights_file(os.path.join(MODEL_CACHE_DIR, INFERENCE_WEIGHTS_PATH), dtype=weights_dtype()),
+                                  device, dtype)
+        print("Parameter Number: " + str(sum(p.numel() for p in loaded_model.parameters() if p.requires_grad)))
+        if quantized():
+            quantize_int8(loaded_model)
+
+        if DRAFT_WEIGHTS_PATH:
+            draft_model = load_model(lambda: NotaGenLMHeadModel(encoder_config=draft_patch_config, decoder_config=draft_byte_config),
+                                     weights_file(os.path.join(MODEL_CACHE_DIR, DRAFT_WEIGHTS_PATH), dtype=weights_dtype()),
+                                     device, dtype)
+            if quantized():
+                quantize_int8(draft_model)
+        prefix_cache = PrefixCache(loaded_model, max_bytes=PREFIX_CACHE_MB * 2 ** 20)
+        model = loaded_model    # last, so that other threads never see a partly loaded set
+
+    if PREFIX_CACHE_WARM:
+        warm_prefix_cache()
+    return model
+
 
 def postprocess_inst_names(abc_text):
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -79,42 +168,6 @@ def postprocess_inst_names(abc_text):
     return processed_abc_text
 
 
-def prepare_model_for_kbit_training(model, use_gradient_checkpointing=True):
-    """
-    Prepare model for k-bit training.
-    Features include:
-    1. Convert model to mixed precision (FP16).
-    2. Disable unnecessary gradient computations.
-    3. Enable gradient checkpointing (optional).
-    """
-    # Convert model to mixed precision
-    model = model.to(dtype=torch.float16)
-
-    # Disable gradients for embedding layers
-    for param in model.parameters():
-        if param.dtype == torch.float32:
-            param.requires_grad = False
-
-    # Enable gradient checkpointing
-    if use_gradient_checkpointing:
-        model.gradient_checkpointing_enable()
-
-    return model
-
-
-model = prepare_model_for_kbit_training(
-    model,
-    use_gradient_checkpointing=False  
-)
-
-print("Parameter Number: " + str(sum(p.numel() for p in model.parameters() if p.requires_grad)))
-
-checkpoint = torch.load(os.path.join(MODEL_CACHE_DIR, INFERENCE_WEIGHTS_PATH), map_location=torch.device(device))
-model.load_state_dict(checkpoint['model'])
-model = model.to(device)
-model.eval()
-
-
 def complete_brackets(s):
     stack = []
     bracket_map = {'{': '}', '[': ']', '(': ')'}
@@ -228,133 +281,1233 @@ def rest_unreduce(abc_lines):
     return unreduced_lines
 
 
-def inference_patch(period, composer, instrumentation):
-    print(f'{period=}, {composer=}, {instrumentation=}')
+def encode_lines(abc_code, patch_length=PATCH_LENGTH):
+    """
+    Patchilizer.encode_generate of text ending with a finished line. Its last bar is closed with eos, as the model
+    generates it, rather than left open to be continued: the tunebody rules start the next line in a new patch.
+    """
+    patches = patchilizer.encode_generate(abc_code, patch_length=patch_length)
+    if abc_code.endswith('\n') and len(patches[-1]) < PATCH_SIZE:
+        patches[-1] = patches[-1] + [patchilizer.eos_token_id] + [patchilizer.special_token_id] * (PATCH_SIZE - len(patches[-1]) - 1)
+    return patches
 
-    prompt_lines=[
-    '%' + period + '\n',
-    '%' + composer + '\n',
-    '%' + instrumentation + '\n']
 
-    while True:
+def split_piece(abc_text):
+    """
+    Split a piece into its prompt, metadata and tunebody lines in the notation the model generates. The piece may be
+    the raw text of a generation or the post-processed piece: its X: line is dropped, and the [r:i/j] counters of the
+    tunebody lines are renumbered (or restored).
+    :return: the prompt lines (period, composer and instrumentation), the metadata lines and the tunebody lines
+    """
+    lines = [line + '\n' for line in abc_text.split('\n') if line.strip()]
+    lines = [line for line in lines if not line.startswith('X:')]
+    tunebody_index = next((i for i, line in enumerate(lines) if line.startswith('[r:') or line.startswith('[V:')), len(lines))
+    header_lines, tunebody_lines = lines[:tunebody_index], lines[tunebody_index:]
+    num_prompt_lines = 0
+    while num_prompt_lines < len(header_lines) and header_lines[num_prompt_lines].startswith('%') and not header_lines[num_prompt_lines].startswith('%%'):
+        num_prompt_lines += 1
+    if num_prompt_lines != 3:
+        raise ValueError('The piece does not start with the period, composer and instrumentation lines')
 
-        failure_flag = False
+    return header_lines[:num_prompt_lines], header_lines[num_prompt_lines:], number_lines(tunebody_lines)
 
-        bos_patch = [patchilizer.bos_token_id] * (PATCH_SIZE - 1) + [patchilizer.eos_token_id]
 
-        start_time = time.time()
+def number_lines(tunebody_lines):
+    """
+    Set the [r:i/j] counters of tunebody lines: i counts the lines and j the lines left.
+    """
+    tunebody_lines = [re.sub(r'^\[r:[^\]]*\]', '', line) for line in tunebody_lines]
+    return ['[r:%d/%d]' % (i, len(tunebody_lines) - i - 1) + line for i, line in enumerate(tunebody_lines)]
 
-        prompt_patches = patchilizer.patchilize_metadata(prompt_lines)
-        byte_list = list(''.join(prompt_lines))
-        context_tunebody_byte_list = []
-        metadata_byte_list = []
 
-        print(''.join(byte_list), end='')
+class LineValidator:
+    """
+    Check a finished tunebody line against the metadata, catching the errors that make rest_unreduce fail or
+    the score inconsistent as soon as the line is generated.
+    """
+    line_pattern = re.compile(r'^\[r:\d+/\d+\]')
+    voice_pattern = re.compile(r'\[V:(\d+)\](.*?)(?=\[V:|$)')
+
+    def __init__(self, metadata_lines):
+        self.voices = set(line.split()[0][2:] for line in metadata_lines if line.startswith('V:'))
+
+    def check(self, line):
+        """
+        :param line: a tunebody line without its line break
+        :return: the reason why the line is invalid, or None if it is valid
+        """
+        if self.line_pattern.match(line) is None:
+            return 'line_tag'
+        line = self.line_pattern.sub('', line)
+
+        matches = self.voice_pattern.findall(line)
+        if len(matches) == 0:
+            return 'no_voice'
+        voices = [voice for voice, _ in matches]
+        if len(set(voices)) < len(voices):
+            return 'duplicate_voice'
+        if len(self.voices) > 0 and not set(voices) <= self.voices:
+            return 'undeclared_voice'
+
+        durations = set()
+        for _, bartext in matches:
+            bartext_split = re.split(Barline_regexPattern, bartext)
+            if len(bartext_split) < 3:
+                return 'missing_barline'
+            # a line holds one bar of every voice, the bar may open with a left barline
+            if len(bartext_split) > 5 or (len(bartext_split) == 5 and bartext_split[0].strip() != ''):
+                return 'bar_count'
+            right_barline = ''.join(bartext_split[-2:])
+            try:
+                durations.add(calculate_bartext_duration(bartext[:-len(right_barline)]))
+            except:
+                pass
+        durations.discard(None)
+        if len(durations) > 1:
+            return 'bar_duration'
+
+        return None
+
+
+# What PieceGeneration streams to its on_event callback. kind is one of:
+# 'prompt' - the prompt lines, 'patch' - the text of a generated patch, 'line' - a finished line of the piece,
+# 'message' - a status message (e.g. of the stream window); time is when the text was generated
+GenerationEvent = namedtuple('GenerationEvent', ['kind', 'text', 'time'])
+
+SAMPLING_PARAMS = ('top_k', 'top_p', 'temperature')     # the parameters a request can override
+failure_reasons = Counter()     # reason -> number of rejected lines or failed pieces, of all generations
+
+
+def sampling_params(params=None):
+    """
+    The sampling parameters of a piece: those of the config, overridden by params.
+    """
+    params = params or {}
+    unknown = set(params) - set(SAMPLING_PARAMS)
+    if len(unknown) > 0:
+        raise ValueError('Unknown sampling parameters: ' + ', '.join(sorted(unknown)))
+    return dict({'top_k': TOP_K, 'top_p': TOP_P, 'temperature': TEMPERATURE}, **params)
+
+
+class CancellationToken:
+    """
+    Abandon a generation from another thread: cancel() it, or let its deadline pass.
+    The generation checks the token between patches (and between chars in BatchGenerator) and frees its lane at once.
+    :param timeout: seconds from now to the deadline, None for no deadline
+    """
+    def __init__(self, timeout=None):
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @property
+    def reason(self):
+        """
+        'cancelled', 'deadline' once the deadline has passed, or None.
+        """
+        if self.cancelled.is_set():
+            return 'cancelled'
+        if self.deadline is not None and time.time() > self.deadline:
+            return 'deadline'
+        return None
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised for a generation abandoned through its CancellationToken.
+    """
+    def __init__(self, reason):
+        super().__init__('The generation was cancelled' if reason == 'cancelled' else 'The generation deadline has passed')
+        self.reason = reason
+
+
+def warm_prefix_cache(prompts_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts.txt')):
+    """
+    Encode the prompt prefix of every period, composer and instrumentation combination in the prompts list.
+    """
+    with open(prompts_path, 'r') as f:
+        prompt_list = [line.strip().split('_') for line in f if line.strip()]
+
+    load_models()
+    with torch.inference_mode(), autocast(device, model_dtype()):
+        prefix_cache.warm(PieceGeneration(*prompt, verbose=False).prompt_patches() for prompt in prompt_list)
+
+
+class PieceGeneration:
+    """
+    The text-level state of one piece generated by inference_patch: the generated chars, the entry into the
+    tunebody, the stream window, and the end and failure conditions.
+    """
+    def __init__(self, period, composer, instrumentation, verbose=True, write=None, on_event=None,
+                 stream_overlap=STREAM_OVERLAP, params=None, token=None):
+        self.prompt_lines = [
+            '%' + period + '\n',
+            '%' + composer + '\n',
+            '%' + instrumentation + '\n']
+        self.verbose = verbose
+        self.write = write      # receives the generated text instead of stdout
+        self.on_event = on_event    # receives a GenerationEvent for every patch, line and message instead of stdout
+        self.event_line = ''        # the unfinished line of the events
+        self.stream_overlap = stream_overlap
+        self.sampling_params = sampling_params(params)
+        self.token = token          # a CancellationToken to abandon the generation with
+        self.cancel_reason = None   # the reason of the token, once the generation has been abandoned
+        self.num_metadata_patches = None    # the bos and metadata patches at the start of the stream window
+        self.window_shifts = []
+
+        self.start_time = time.time()
+        self.byte_list = list(''.join(self.prompt_lines))
+        self.context_tunebody_byte_list = []
+        self.metadata_byte_list = []
+
+        self.tunebody_flag = False
+        self.end_flag = False
+        self.failure_flag = False
+        self.stop_flag = False      # the generation has ended, failed or been abandoned
+        self.rules = TunebodyRules(patchilizer.bos_token_id, patchilizer.eos_token_id)
+
+        self.validator = None       # a LineValidator once the tunebody starts, with VALIDATE_LINES
+        self.line = ''              # the unfinished tunebody line
+        self.num_lines = 0          # the finished tunebody lines
+        self.pending_patches = []   # (text, time) of the tunebody patches held back until they cannot be rolled back
+        self.checkpoint = None      # the state after the last valid line ending with a patch
+        self.checkpoint_pending = False     # the accepted patch ended a line, save_checkpoint() once it is appended
+        self.rollback = None        # (num_patches, encoded_patch) to truncate the session to, instead of appending
+        self.line_retries = 0       # rollbacks since the last checkpoint
+        self.num_rollbacks = 0
+
+        self.output(''.join(self.byte_list), 'prompt')
+
+    def output(self, text, kind='message', timestamp=None):
+        """
+        Send text to write and an event to on_event, or print the text if neither is given and verbose.
+        A 'line' event follows each line that the text of the piece finishes.
+        """
+        if self.write is not None:
+            self.write(text)
+        elif self.verbose and self.on_event is None:
+            print(text, end='')
+
+        if self.on_event is not None:
+            timestamp = time.time() if timestamp is None else timestamp
+            self.on_event(GenerationEvent(kind, text, timestamp))
+            if kind != 'message':
+                lines = (self.event_line + text).split('\n')
+                for line in lines[:-1]:
+                    self.on_event(GenerationEvent('line', line + '\n', timestamp))
+                self.event_line = lines[-1]
+
+    def flush_patches(self):
+        for text, timestamp in self.pending_patches:
+            self.output(text, 'patch', timestamp)
+        self.pending_patches = []
+
+    def check_cancelled(self):
+        """
+        Stop the generation if its token has been cancelled or its deadline has passed.
+        :return: the reason, 'cancelled' or 'deadline', or None
+        """
+        if self.cancel_reason is None and self.token is not None:
+            reason = self.token.reason
+            if reason is not None:
+                failure_reasons[reason] += 1
+                self.cancel_reason = reason
+                self.stop_flag = True
+        return self.cancel_reason
+
+    def prompt_patches(self):
+        """
+        The bos patch followed by the patches of the prompt lines.
+        """
+        bos_patch = [patchilizer.bos_token_id] * (PATCH_SIZE - 1) + [patchilizer.eos_token_id]
 
+        prompt_patches = patchilizer.patchilize_metadata(self.prompt_lines)
         prompt_patches = [[ord(c) for c in patch] + [patchilizer.special_token_id] * (PATCH_SIZE - len(patch)) for patch
                           in prompt_patches]
         prompt_patches.insert(0, bos_patch)
 
-        input_patches = torch.tensor(prompt_patches, device=device).reshape(1, -1)
-
-        end_flag = False
-        cut_index = None
-
-        tunebody_flag = False
-
-        with torch.inference_mode():
-            
-            while True:
-                with torch.autocast(device_type='cuda', dtype=torch.float16):
-                    predicted_patch = model.generate(input_patches.unsqueeze(0),
-                                                    top_k=TOP_K,
-                                                    top_p=TOP_P,
-                                                    temperature=TEMPERATURE)
-                if not tunebody_flag and patchilizer.decode([predicted_patch]).startswith('[r:'):  # 初次进入tunebody，必须以[r:0/开头
-                    tunebody_flag = True
-                    r0_patch = torch.tensor([ord(c) for c in '[r:0/']).unsqueeze(0).to(device)
-                    temp_input_patches = torch.concat([input_patches, r0_patch], axis=-1)
-                    predicted_patch = model.generate(temp_input_patches.unsqueeze(0),
-                                                    top_k=TOP_K,
-                                                    top_p=TOP_P,
-                                                    temperature=TEMPERATURE)
-                    predicted_patch = [ord(c) for c in '[r:0/'] + predicted_patch
-                if predicted_patch[0] == patchilizer.bos_token_id and predicted_patch[1] == patchilizer.eos_token_id:
-                    end_flag = True
+        return prompt_patches
+
+    def prefill(self, metadata_lines, tunebody_lines):
+        """
+        Take metadata and tunebody lines as if they had been generated, to go on generating after them.
+        num_metadata_patches is set to the patches before the tunebody lines, which requests share in prefix_cache.
+        :return: the patches to reset the session with: the prompt and all the lines, or, if they leave no room in the
+                 stream window, the metadata and the last tunebody lines that fit, as after a window shift
+        """
+        metadata, tunebody = ''.join(metadata_lines), ''.join(tunebody_lines)
+        metadata_patches = patchilizer.patchilize_metadata(metadata_lines)
+        self.num_metadata_patches = len(self.prompt_patches()) + len(metadata_patches)
+        self.byte_list += list(metadata + tunebody)
+        self.metadata_byte_list = list(metadata)
+        if len(tunebody_lines) > 0:
+            self.tunebody_flag = True
+            self.rules.feed(tunebody)
+            self.num_lines = len(tunebody_lines)
+            if VALIDATE_LINES:
+                self.validator = LineValidator(metadata.split('\n'))
+        self.output(metadata + tunebody, 'prompt')
+        if len(tunebody_lines) == 0:
+            return self.prompt_patches() + [[ord(c) for c in patch] + [patchilizer.special_token_id] * (PATCH_SIZE - len(patch))
+                                            for patch in metadata_patches]
+
+        window_lines = tunebody_lines
+        patches = encode_lines(''.join(self.prompt_lines) + metadata + tunebody, patch_length=None)
+        while len(patches) >= PATCH_LENGTH:
+            if len(window_lines) <= 1:
+                raise ValueError('The lines before the range do not fit in the context of the model')
+            window_lines = window_lines[-max(1, int(len(window_lines) * self.stream_overlap)):]
+            patches = encode_lines(metadata + ''.join(window_lines), patch_length=None)
+            self.num_metadata_patches = 1 + len(metadata_patches)
+        self.context_tunebody_byte_list = list(''.join(window_lines))
+        return patches
+
+    def tunebody_prefix(self, predicted_patch):
+        """
+        The first tunebody patch must start with [r:0/.
+        Returns that prefix if the patch has to be regenerated with it, otherwise None.
+        """
+        if not self.tunebody_flag and patchilizer.decode([predicted_patch]).startswith('[r:'):  # 初次进入tunebody，必须以[r:0/开头
+            self.tunebody_flag = True
+            if VALIDATE_LINES:
+                self.validator = LineValidator(''.join(self.metadata_byte_list).split('\n'))
+            return [ord(c) for c in '[r:0/']
+        return None
+
+    def next_patch(self, generate):
+        """
+        Generate the next patch, forcing the chars the tunebody rules predict.
+        :param generate: a callable generating the rest of a patch after the given prefix, e.g. session.generate
+        """
+        prefix = self.rules.next_prefix() if self.tunebody_flag else None
+        if prefix is not None:
+            if len(prefix) == PATCH_SIZE:
+                return prefix   # fully predicted, skip the model
+            return prefix + generate(prefix=prefix)
+
+        predicted_patch = generate()
+        prefix = self.tunebody_prefix(predicted_patch)
+        if prefix is not None:
+            predicted_patch = prefix + generate(prefix=prefix)
+        return predicted_patch
+
+    def accept(self, predicted_patch):
+        """
+        Take the next generated patch.
+        Returns the ids to append to the session, or None if the generation stops here.
+        """
+        if predicted_patch[0] == patchilizer.bos_token_id and predicted_patch[1] == patchilizer.eos_token_id:
+            self.end_flag = True
+            self.stop_flag = True
+            self.flush_patches()
+            return None
+        next_patch = patchilizer.decode([predicted_patch])
+
+        if self.validator is not None:
+            reason = self.check_lines(next_patch)
+            if reason is not None:
+                failure_reasons[reason] += 1
+                if self.checkpoint is not None and self.line_retries < LINE_RETRIES:
+                    self.restore_checkpoint()
+                    return None
+
+        for char in next_patch:
+            self.byte_list.append(char)
+            if self.tunebody_flag:
+                self.context_tunebody_byte_list.append(char)
+            else:
+                self.metadata_byte_list.append(char)
+        if self.tunebody_flag:
+            self.rules.feed(next_patch)
+            self.num_lines += next_patch.count('\n')
+        if self.validator is not None:
+            self.pending_patches.append((next_patch, time.time()))
+            if self.checkpoint_pending:
+                self.flush_patches()    # the next checkpoint is after this patch
+        else:
+            self.output(next_patch, 'patch')
+
+        patch_end_flag = False
+        for j in range(len(predicted_patch)):
+            if patch_end_flag:
+                predicted_patch[j] = patchilizer.special_token_id
+            if predicted_patch[j] == patchilizer.eos_token_id:
+                patch_end_flag = True
+
+        if len(self.byte_list) > 102400:
+            failure_reasons['too_long'] += 1
+            self.failure_flag = True
+            self.stop_flag = True
+            return None
+        if time.time() - self.start_time > 10 * 60: 
+            failure_reasons['timeout'] += 1
+            self.failure_flag = True
+            self.stop_flag = True
+            return None
+
+        return predicted_patch
+
+    def check_lines(self, next_patch):
+        """
+        Validate the tunebody lines finished by the next patch, and mark a checkpoint if the patch ends a line.
+        :return: the reason why a line is invalid, or None
+        """
+        lines = (self.line + next_patch).split('\n')
+        self.line = lines[-1]
+        self.checkpoint_pending = len(lines) > 1 and self.line == ''
+        for line in lines[:-1]:
+            reason = self.validator.check(line)
+            if reason is not None:
+                return reason
+        return None
+
+    def save_checkpoint(self, num_patches, encoded_patch):
+        """
+        Remember the state after a valid line, once its last patch has been appended to the session.
+        :param num_patches: the number of patches in the session
+        :param encoded_patch: the feature of the last patch in the session
+        """
+        self.checkpoint = {'num_patches': num_patches,
+                           'encoded_patch': encoded_patch.clone(),
+                           'byte_list': len(self.byte_list),
+                           'context_tunebody_byte_list': len(self.context_tunebody_byte_list),
+                           'num_lines': self.num_lines,
+                           'rules': copy.deepcopy(self.rules)}
+        self.checkpoint_pending = False
+        self.line_retries = 0
+
+    def restore_checkpoint(self):
+        """
+        Drop the text generated after the last valid line, and set the session state to roll back to.
+        """
+        checkpoint = self.checkpoint
+        del self.byte_list[checkpoint['byte_list']:]
+        del self.context_tunebody_byte_list[checkpoint['context_tunebody_byte_list']:]
+        self.rules = copy.deepcopy(checkpoint['rules'])
+        self.num_lines = checkpoint['num_lines']
+        self.line = ''
+        self.pending_patches = []
+        self.checkpoint_pending = False
+        self.rollback = (checkpoint['num_patches'], checkpoint['encoded_patch'])
+        self.line_retries += 1
+        self.num_rollbacks += 1
+
+    @property
+    def at_line_end(self):
+        """
+        Whether the text of the piece ends with a finished tunebody line, so that it can be forked there.
+        """
+        return self.tunebody_flag and not self.stop_flag and self.byte_list[-1] == '\n'
+
+    def fork(self, write=None, on_event=None, params=None, token=None):
+        """
+        A copy of the piece that continues independently from its current text, e.g. in a lane forked from the lane
+        of this piece. The copy does not repeat the text so far to its sinks.
+        :param write: a callable receiving the text generated by the copy
+        :param on_event: a callable receiving the GenerationEvents of the copy
+        :param params: sampling parameters overriding the config, those of this piece if None
+        :param token: a CancellationToken to abandon the copy with
+        """
+        sinks = (self.write, self.on_event, self.token)
+        self.write, self.on_event, self.token = None, None, None    # not copied, they may hold locks
+        try:
+            piece = copy.deepcopy(self)
+        finally:
+            self.write, self.on_event, self.token = sinks
+        piece.write, piece.on_event, piece.token = write, on_event, token
+        if params is not None:
+            piece.sampling_params = sampling_params(params)
+        return piece
+
+    def state_dict(self):
+        """
+        The state of the piece as plain values and tensors, to save with torch.save and resume with load_state_dict(),
+        e.g. after a restart. The patches held back for validation are saved as part of the text.
+        """
+        checkpoint = None
+        if self.checkpoint is not None:
+            checkpoint = dict(self.checkpoint, encoded_patch=self.checkpoint['encoded_patch'].cpu(),
+                              rules=self.checkpoint['rules'].state_dict())
+        return {'stream_overlap': self.stream_overlap,
+                'sampling_params': self.sampling_params,
+                'num_metadata_patches': self.num_metadata_patches,
+                'window_shifts': self.window_shifts,
+                'elapsed': time.time() - self.start_time,
+                'byte_list': ''.join(self.byte_list),
+                'context_tunebody_byte_list': ''.join(self.context_tunebody_byte_list),
+                'metadata_byte_list': ''.join(self.metadata_byte_list),
+                'tunebody_flag': self.tunebody_flag,
+                'end_flag': self.end_flag,
+                'failure_flag': self.failure_flag,
+                'stop_flag': self.stop_flag,
+                'rules': self.rules.state_dict(),
+                'validate': self.validator is not None,
+                'line': self.line,
+                'num_lines': self.num_lines,
+                'checkpoint': checkpoint,
+                'checkpoint_pending': self.checkpoint_pending,
+                'line_retries': self.line_retries,
+                'num_rollbacks': self.num_rollbacks}
+
+    def load_state_dict(self, state):
+        """
+        Take the state saved by state_dict() into this piece, created with the same prompt, and output the text
+        after the prompt as a 'prompt'. The time limit counts the time generated before the save.
+        """
+        self.stream_overlap = state['stream_overlap']
+        self.sampling_params = sampling_params(state['sampling_params'])
+        self.num_metadata_patches = state['num_metadata_patches']
+        self.window_shifts = list(state['window_shifts'])
+        self.start_time = time.time() - state['elapsed']
+        prompt_length = len(self.byte_list)
+        self.byte_list = list(state['byte_list'])
+        self.context_tunebody_byte_list = list(state['context_tunebody_byte_list'])
+        self.metadata_byte_list = list(state['metadata_byte_list'])
+        for name in ('tunebody_flag', 'end_flag', 'failure_flag', 'stop_flag', 'line', 'num_lines',
+                     'checkpoint_pending', 'line_retries', 'num_rollbacks'):
+            setattr(self, name, state[name])
+        self.rules.load_state_dict(state['rules'])
+        self.validator = LineValidator(''.join(self.metadata_byte_list).split('\n')) if state['validate'] else None
+        self.pending_patches = []
+        self.checkpoint = None
+        if state['checkpoint'] is not None:
+            rules = TunebodyRules(patchilizer.bos_token_id, patchilizer.eos_token_id)
+            rules.load_state_dict(state['checkpoint']['rules'])
+            self.checkpoint = dict(state['checkpoint'], encoded_patch=state['checkpoint']['encoded_patch'].to(device),
+                                   rules=rules)
+        self.output(''.join(self.byte_list[prompt_length:]), 'prompt')
+
+    def advance(self, session, predicted_patch):
+        """
+        Accept the next patch into a GenerationSession or SpeculativeGenerationSession: append it, or roll the
+        session back to the last valid line.
+        """
+        predicted_patch = self.accept(predicted_patch)
+        if predicted_patch is not None:
+            session.append(predicted_patch)
+            if self.checkpoint_pending:
+                self.save_checkpoint(session.num_patches, session.encoded_patch)
+        elif self.rollback is not None:
+            session.truncate(*self.rollback)
+            self.rollback = None
+
+    def stream_patches(self):
+        """
+        Re-encode the metadata and the last part of the tunebody (stream_overlap of its lines) once the context
+        reaches the patch length.
+        Returns the patches to reset the session with, or None if the generation stops here.
+        """
+        self.output('Stream generating...\n')
+
+        metadata = ''.join(self.metadata_byte_list)
+        context_tunebody = ''.join(self.context_tunebody_byte_list)
+
+        if '\n' not in context_tunebody:
+            failure_reasons['no_tunebody'] += 1
+            self.stop_flag = True
+            return None     # Generated content is all metadata, abandon
+
+        self.checkpoint = None      # the session is re-encoded, so it cannot be rolled back across the shift
+        self.flush_patches()
+
+        context_tunebody_lines = context_tunebody.split('\n')
+        if not context_tunebody.endswith('\n'):
+            context_tunebody_lines = [context_tunebody_lines[i] + '\n' for i in range(len(context_tunebody_lines) - 1)] + [context_tunebody_lines[-1]]
+        else:
+            context_tunebody_lines = [context_tunebody_lines[i] + '\n' for i in range(len(context_tunebody_lines))]
+
+        cut_index = max(1, int(len(context_tunebody_lines) * self.stream_overlap))
+        abc_code_slice = metadata + ''.join(context_tunebody_lines[-cut_index:])
+
+        self.context_tunebody_byte_list = list(''.join(context_tunebody_lines[-cut_index:]))
+
+        metadata_lines = [line + '\n' for line in metadata.split('\n') if line]
+        self.num_metadata_patches = 1 + len(patchilizer.patchilize_metadata(metadata_lines))
+
+        return encode_lines(abc_code_slice)
+
+    def shift_window(self, reset):
+        """
+        Move the stream window: the metadata is forked from prefix_cache (encoded at the first shift of the piece),
+        so only the retained tunebody is re-encoded. The cost of the shift is reported with the generated text.
+        :param reset: the reset function of the session, taking the patches, prefix_cache and num_prefix_patches
+        :return: the stats of the shift, or None if the generation stops here
+        """
+        input_patches = self.stream_patches()
+        if input_patches is None:
+            return None
+
+        num_patches = sum(len(patch) == PATCH_SIZE for patch in input_patches)
+        num_cached_patches = self.num_metadata_patches if input_patches[:self.num_metadata_patches] in prefix_cache else 0
+
+        start_time = time.time()
+        reset(input_patches, prefix_cache=prefix_cache, num_prefix_patches=self.num_metadata_patches)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+        shift = {'encoded_patches': num_patches - num_cached_patches,
+                 'cached_patches': num_cached_patches,
+                 'seconds': time.time() - start_time}
+        self.window_shifts.append(shift)
+        self.output('Re-encoded %d patches (%d cached) in %.0f ms\n' % (shift['encoded_patches'], shift['cached_patches'], shift['seconds'] * 1000))
+
+        return shift
+
+    def result(self):
+        """
+        The post-processed piece, or None if the generation failed.
+        """
+        if self.failure_flag:
+            return None
+
+        abc_text = ''.join(self.byte_list)
+
+        # unreduce
+        abc_lines = abc_text.split('\n')
+        abc_lines = list(filter(None, abc_lines))
+        abc_lines = [line + '\n' for line in abc_lines]
+        try:
+            unreduced_abc_lines = rest_unreduce(abc_lines)
+        except:
+            failure_reasons['rest_unreduce'] += 1
+            self.failure_flag = True
+            return None
+        else:
+            unreduced_abc_lines = self.prompt_lines + [line for line in unreduced_abc_lines if not(line.startswith('%') and not line.startswith('%%'))]
+            unreduced_abc_lines = ['X:1\n'] + unreduced_abc_lines
+            unreduced_abc_text = ''.join(unreduced_abc_lines)
+            return unreduced_abc_text
+
+
+def batch_session(batch_size):
+    """
+    A BatchGenerationSession of the model, paged in a pool of KV_CACHE_MB if set (see PagedBatchGenerationSession).
+    """
+    model = load_models()
+    if KV_CACHE_MB > 0:
+        num_blocks = KVBlockPool.num_blocks_for(model, KV_CACHE_MB * 2 ** 20, KV_BLOCK_SIZE, quantize=KV_CACHE_INT8)
+        pool = KVBlockPool(model, num_blocks, KV_BLOCK_SIZE, quantize=KV_CACHE_INT8)
+        return PagedBatchGenerationSession(model, batch_size, pool)
+    return BatchGenerationSession(model, batch_size, quantize_cache=KV_CACHE_INT8)
+
+
+class Variations:
+    """
+    The key of a piece in BatchGenerator until it branches into its variations (see BatchGenerator.submit_variations).
+    :param keys: the key of each variation
+    :param num_lines: the tunebody lines the variations share
+    """
+    def __init__(self, keys, num_lines, write=None, on_event=None):
+        self.keys = list(keys)
+        self.num_lines = num_lines
+        self.write = write
+        self.on_event = on_event
+
+    def sinks(self, key):
+        """
+        The write and on_event of the variation of key.
+        """
+        return (functools.partial(self.write, key) if self.write is not None else None,
+                functools.partial(self.on_event, key) if self.on_event is not None else None)
+
+    def broadcast(self, sink):
+        """
+        A sink passing the text or events of the shared prefix to that of every variation.
+        """
+        if sink is None:
+            return None
+        return lambda arg: [sink(key, arg) for key in self.keys]
+
+
+def expand_keys(key):
+    """
+    The keys of the pieces a lane or queue entry of BatchGenerator stands for.
+    """
+    return key.keys if isinstance(key, Variations) else [key]
+
+
+class BatchGenerator:
+    """
+    Generate pieces in lockstep on one BatchGenerationSession.
+    Each lane holds one piece; a failed piece is restarted in its lane as inference_patch does,
+    and the lanes of finished pieces are refilled from the queue of submitted prompts.
+    Pieces whose CancellationToken is cancelled or expired leave their lane (or the queue) at once, and are reported
+    by pop_cancelled() instead of step().
+    With a paged cache, a piece is admitted only while the pool keeps a free block for each running piece, and when
+    the pool runs out, the latest started piece is preempted: its blocks are freed, and it resumes before the queued
+    pieces by re-encoding its patches.
+    Variations of a piece (see submit_variations()) share the lane of their prefix until it branches: the lane is then
+    forked into idle lanes with fork_lane(), so that the prefix is generated and encoded once.
+    The pieces in progress can be saved between steps with state_dict(), and resumed after a restart with
+    load_state_dict().
+    """
+    def __init__(self, batch_size=BATCH_SIZE, verbose=False):
+        self.batch_size = batch_size
+        self.verbose = verbose
+        self.session = None     # a BatchGenerationSession, created at the first step so that the model loads lazily
+        self.queue = deque()
+        self.lanes = [None] * batch_size    # (key, prompt, piece) of each lane
+        self.start_order = [0] * batch_size     # when the piece of each lane was started or resumed
+        self.num_starts = 0
+        self.preempted = deque()    # (key, prompt, piece, patches, cache) of the pieces waiting to resume
+        self.num_preemptions = 0
+        self.branch_points = {}     # key -> (piece, patches) at the branch point of each variation, to restart it from
+        self.cancelled = []     # (key, reason) of the pieces abandoned since the last pop_cancelled()
+        self.window_stats = {'shifts': 0, 'encoded_patches': 0, 'cached_patches': 0, 'seconds': 0.0}
+
+    def submit(self, key, period, composer, instrumentation, write=None, on_event=None, params=None, token=None):
+        """
+        Queue a piece to generate, step() returns it with the given key once finished.
+        :param write: a callable receiving the generated text of the piece as it is produced
+        :param on_event: a callable receiving the GenerationEvents of the piece
+        :param params: sampling parameters overriding the config, e.g. {'temperature': 1.0}
+        :param token: a CancellationToken to abandon the piece with
+        """
+        sampling_params(params)     # fail here rather than in step()
+        self.queue.append((key, (period, composer, instrumentation), write, on_event, params, token))
+
+    def submit_variations(self, keys, period, composer, instrumentation, num_lines, write=None, on_event=None,
+                          params=None, token=None):
+        """
+        Queue a piece that branches into a variation for each key after its first num_lines tunebody lines (its first
+        bars, in the interleaved notation of the model). The shared prefix is generated once, in one lane; at its end,
+        the lane is forked for every variation, copy-on-write with a paged cache, and each variation goes on with its
+        own sampling. step() returns every variation with its key. Variations for which no lane is idle wait before
+        the queued pieces, and resume by re-encoding the prefix. A failed variation restarts from the branch point.
+        If the piece ends before the branch point, every key receives it.
+        :param keys: the key of each variation
+        :param num_lines: the tunebody lines shared by the variations
+        :param write: a callable receiving the key of a variation and its generated text; the text of the prefix is
+                      received for every key
+        :param on_event: a callable receiving the key of a variation and a GenerationEvent of its piece
+        :param params: sampling parameters overriding the config, e.g. {'temperature': 1.0}
+        :param token: a CancellationToken to abandon all the variations with
+        """
+        if len(keys) == 0:
+            raise ValueError('No variations to generate')
+        if num_lines < 1:
+            raise ValueError('The variations must share at least one tunebody line')
+        sampling_params(params)
+        variations = Variations(keys, num_lines, write, on_event)
+        self.queue.append((variations, (period, composer, instrumentation), variations.broadcast(write),
+                           variations.broadcast(on_event), params, token))
+
+    def pop_cancelled(self):
+        """
+        :return: a list of (key, reason) of the pieces abandoned since the last call
+        """
+        cancelled, self.cancelled = self.cancelled, []
+        return cancelled
+
+    def state_dict(self, cache=False):
+        """
+        The pieces in progress as plain values and tensors, to write with save_generation() and resume with
+        load_state_dict(), e.g. after a restart: the text-level state and the patch history of the running and
+        preempted pieces, the branch points of the variations, the queued prompts, and the state of the random
+        generators. The keys of the pieces must be plain values; their sinks and cancellation tokens are not saved.
+        Call it between steps.
+        :param cache: also save the keys and values of the running pieces, so that they resume without re-encoding
+                      their patches
+        """
+        pieces = []
+        for lane, entry in enumerate(self.lanes):
+            if entry is None:
+                continue
+            key, prompt, piece = entry
+            state = dict(self._key_state(key), prompt=prompt, piece=piece.state_dict(),
+                         patches=self.session.lane_patches(lane)[0].to('cpu', torch.uint8))
+            if cache:
+                past_key_values, encoded_patch = self.session.lane_cache(lane)
+                state['cache'] = (tuple(tuple(tensor.cpu() for tensor in layer) for layer in past_key_values),
+                                  encoded_patch.cpu())
+            pieces.append(state)
+        for key, prompt, piece, patches, piece_cache in self.preempted:
+            state = dict(self._key_state(key), prompt=prompt, piece=piece.state_dict(),
+                         patches=torch.tensor(patches, dtype=torch.uint8))
+            if cache and piece_cache is not None:
+                state['cache'] = piece_cache
+            pieces.append(state)
+
+        branch_points = [{'key': key, 'prompt': tuple(line[1:-1] for line in piece.prompt_lines), 'piece': piece.state_dict(),
+                          'patches': torch.tensor(patches, dtype=torch.uint8)}
+                         for key, (piece, patches) in self.branch_points.items()]
+        queue = [dict(self._key_state(key), prompt=prompt, params=params) for key, prompt, _, _, params, _ in self.queue]
+        return {'pieces': pieces, 'branch_points': branch_points, 'queue': queue, 'rng': rng_state()}
+
+    def load_state_dict(self, state, write=None, on_event=None):
+        """
+        Resume the pieces saved by state_dict() in this idle generator. The running and preempted pieces resume before
+        the queued ones, in their order, and output their text so far as a 'prompt'. The random generators are
+        restored as well, so that a piece resumed alone goes on as it would have.
+        :param write: a callable receiving the key of a piece and its generated text, as in submit_variations()
+        :param on_event: a callable receiving the key of a piece and a GenerationEvent of it
+        """
+        if self.busy:
+            raise RuntimeError('Pieces can only be resumed in an idle generator')
+        for entry in state['branch_points']:
+            piece = PieceGeneration(*entry['prompt'], verbose=False)
+            piece.load_state_dict(entry['piece'])
+            self.branch_points[entry['key']] = (piece, entry['patches'].tolist())
+        for entry in state['pieces']:
+            key, piece_write, piece_on_event = self._restore_key(entry, write, on_event)
+            piece = PieceGeneration(*entry['prompt'], verbose=self.verbose, write=piece_write, on_event=piece_on_event,
+                                    params=entry['piece']['sampling_params'])
+            piece.load_state_dict(entry['piece'])
+            self.preempted.append((key, tuple(entry['prompt']), piece, entry['patches'].tolist(), entry.get('cache')))
+        for entry in state['queue']:
+            key, piece_write, piece_on_event = self._restore_key(entry, write, on_event)
+            self.queue.append((key, tuple(entry['prompt']), piece_write, piece_on_event, entry['params'], None))
+        set_rng_state(state['rng'])
+
+    @staticmethod
+    def _key_state(key):
+        if isinstance(key, Variations):
+            return {'key': key.keys, 'num_lines': key.num_lines}
+        return {'key': key, 'num_lines': None}
+
+    @staticmethod
+    def _restore_key(entry, write, on_event):
+        """
+        The key of a saved piece, and the write and on_event of its piece.
+        """
+        if entry['num_lines'] is not None:
+            variations = Variations(entry['key'], entry['num_lines'], write, on_event)
+            return variations, variations.broadcast(write), variations.broadcast(on_event)
+        key = entry['key']
+        return (key, functools.partial(write, key) if write is not None else None,
+                functools.partial(on_event, key) if on_event is not None else None)
+
+    @property
+    def busy(self):
+        return len(self.queue) > 0 or len(self.preempted) > 0 or any(lane is not None for lane in self.lanes)
+
+    @property
+    def num_active_lanes(self):
+        return sum(lane is not None for lane in self.lanes)
+
+    def _start(self, lane, key, prompt, write=None, on_event=None, params=None, token=None):
+        piece = PieceGeneration(*prompt, verbose=self.verbose, write=write, on_event=on_event, params=params,
+                                token=token)
+        self.session.reset_lane(lane, piece.prompt_patches(), prefix_cache=prefix_cache)
+        self.lanes[lane] = (key, prompt, piece)
+        self.start_order[lane] = self.num_starts
+        self.num_starts += 1
+
+    def _branch(self, lane):
+        """
+        Fork the piece of a lane, at the end of its shared prefix, into its variations: the first takes over the lane,
+        the others take idle lanes forked from it, or wait for one.
+        :return: the forked lanes
+        """
+        variations, prompt, piece = self.lanes[lane]
+        patches = self.session.lane_patches(lane)[0].tolist()
+        branch_point = piece.fork(params=piece.sampling_params)
+        idle_lanes = [idle_lane for idle_lane in range(self.batch_size) if self.lanes[idle_lane] is None]
+        forked_lanes = []
+        for index, key in enumerate(variations.keys):
+            self.branch_points[key] = (branch_point, patches)
+            variation = branch_point.fork(*variations.sinks(key), params=piece.sampling_params, token=piece.token)
+            if index > 0 and len(idle_lanes) == 0:
+                self.preempted.append((key, prompt, variation, patches, None))
+                continue
+            if index > 0:
+                variation_lane = idle_lanes.pop(0)
+                self.session.fork_lane(variation_lane, lane)
+                forked_lanes.append(variation_lane)
+            else:
+                variation_lane = lane
+            self.lanes[variation_lane] = (key, prompt, variation)
+            self.start_order[variation_lane] = self.num_starts
+            self.num_starts += 1
+        return forked_lanes
+
+    def _restart(self, lane):
+        """
+        Start the failed piece of a lane over, a variation from its branch point.
+        """
+        key, prompt, piece = self.lanes[lane]
+        if key not in self.branch_points:
+            self._start(lane, key, prompt, piece.write, piece.on_event, piece.sampling_params, piece.token)
+            return
+        branch_point, patches = self.branch_points[key]
+        variation = branch_point.fork(piece.write, piece.on_event, piece.sampling_params, piece.token)
+        variation.output(''.join(variation.byte_list), 'prompt')
+        self.session.reset_lane(lane, patches)
+        self.lanes[lane] = (key, prompt, variation)
+
+    def _admit(self, lane):
+        """
+        Resume a preempted piece, or start a queued one, in an idle lane if the cache has room for it.
+        :return: whether a piece was admitted
+        """
+        if len(self.preempted) > 0:
+            num_patches = len(self.preempted[0][3]) // PATCH_SIZE
+        elif len(self.queue) > 0:
+            # the bos patch and the prompt lines, as in PieceGeneration.prompt_patches()
+            num_patches = 1 + len(patchilizer.patchilize_metadata(['%' + item + '\n' for item in self.queue[0][1]]))
+        else:
+            return False
+        if not self.session.can_reset(num_patches, reserve=self.num_active_lanes + 1):
+            if self.num_active_lanes == 0:
+                raise RuntimeError('The key/value cache pool cannot hold one piece, raise KV_CACHE_MB')
+            return False
+
+        if len(self.preempted) > 0:
+            key, prompt, piece, patches, cache = self.preempted.popleft()
+            self.session.reset_lane(lane, patches, cache=cache)
+            self.lanes[lane] = (key, prompt, piece)
+            self.start_order[lane] = self.num_starts
+            self.num_starts += 1
+        else:
+            self._start(lane, *self.queue.popleft())
+        return True
+
+    def _preempt(self, lanes):
+        """
+        Free the cache of the latest started of the pieces in lanes, to make room for the next patches of the others.
+        The piece resumes later by re-encoding its patches.
+        """
+        if len(lanes) == 1:
+            raise RuntimeError('The key/value cache pool cannot hold one piece, raise KV_CACHE_MB')
+        lane = max(lanes, key=lambda lane: self.start_order[lane])
+        lanes.remove(lane)
+        key, prompt, piece = self.lanes[lane]
+        patches = self.session.lane_patches(lane)[0].tolist()
+        self.session.retire_lane(lane)
+        self.lanes[lane] = None
+        self.preempted.appendleft((key, prompt, piece, patches, None))
+        self.num_preemptions += 1
+
+    def _cancel(self, lane):
+        key, _, piece = self.lanes[lane]
+        self.session.retire_lane(lane)
+        self.lanes[lane] = None
+        self._report_cancelled(key, piece.cancel_reason)
+
+    def _report_cancelled(self, key, reason):
+        for key in expand_keys(key):
+            self.branch_points.pop(key, None)
+            self.cancelled.append((key, reason))
+
+    def _cancelled_lanes(self, lanes):
+        return [lane for lane in lanes if self.lanes[lane][2].check_cancelled() is not None]
+
+    def _sampling_params(self, lanes):
+        """
+        The sampling parameters of the pieces in lanes, one value per lane.
+        """
+        return {name: [self.lanes[lane][2].sampling_params[name] for lane in lanes] for name in SAMPLING_PARAMS}
+
+    def step(self):
+        """
+        Fill idle lanes from the queue, then generate one patch for every lane.
+        :return: a list of (key, abc_text) of the pieces finished in this step
+        """
+        finished = []
+        if self.session is None:
+            self.session = batch_session(self.batch_size)
+
+        with torch.inference_mode(), autocast(device, model_dtype()):
+            for lane in self._cancelled_lanes([lane for lane in range(self.batch_size) if self.lanes[lane] is not None]):
+                self._cancel(lane)
+            queue = deque()
+            for entry in self.queue:
+                token = entry[-1]
+                reason = token.reason if token is not None else None
+                if reason is None:
+                    queue.append(entry)
+                else:
+                    failure_reasons[reason] += 1
+                    self._report_cancelled(entry[0], reason)
+            self.queue = queue
+            preempted = deque()
+            for entry in self.preempted:
+                piece = entry[2]
+                if piece.check_cancelled() is None:
+                    preempted.append(entry)
+                else:
+                    self._report_cancelled(entry[0], piece.cancel_reason)
+            self.preempted = preempted
+            # room for the next patch of every running piece, then for new pieces
+            lanes = [lane for lane in range(self.batch_size) if self.lanes[lane] is not None]
+            while not self.session.can_extend(lanes):
+                self._preempt(lanes)
+            for lane in range(self.batch_size):
+                if self.lanes[lane] is None and not self._admit(lane):
                     break
-                next_patch = patchilizer.decode([predicted_patch])
 
-                for char in next_patch:
-                    byte_list.append(char)
-                    if tunebody_flag:
-                        context_tunebody_byte_list.append(char)
+            lanes = [lane for lane in range(self.batch_size) if self.lanes[lane] is not None]
+            if len(lanes) == 0:
+                return finished
+
+            # chars predicted by the tunebody rules are forced, lanes with a fully predicted patch skip the model
+            predicted_patches = {}
+            forced_prefixes = {}
+            for lane in lanes:
+                piece = self.lanes[lane][2]
+                prefix = piece.rules.next_prefix() if piece.tunebody_flag else None
+                if prefix is None:
+                    continue
+                if len(prefix) == PATCH_SIZE:
+                    predicted_patches[lane] = prefix
+                else:
+                    forced_prefixes[lane] = prefix
+
+            generate_lanes = [lane for lane in lanes if lane not in predicted_patches]
+            if len(generate_lanes) > 0:
+                generated_patches = self.session.generate(generate_lanes, forced_prefixes,
+                                                          cancelled=functools.partial(self._cancelled_lanes, generate_lanes),
+                                                          **self._sampling_params(generate_lanes))
+                for lane, predicted_patch in zip(generate_lanes, generated_patches):
+                    predicted_patches[lane] = forced_prefixes.get(lane, []) + predicted_patch
+            predicted_patches = [predicted_patches[lane] for lane in lanes]
+
+            prefixes = {}
+            for lane, predicted_patch in zip(lanes, predicted_patches):
+                if self.lanes[lane][2].stop_flag:
+                    continue    # cancelled while its patch was generated
+                prefix = self.lanes[lane][2].tunebody_prefix(predicted_patch)
+                if prefix is not None:
+                    prefixes[lane] = prefix
+            if len(prefixes) > 0:
+                regenerated_patches = self.session.generate(list(prefixes), prefixes,
+                                                            cancelled=functools.partial(self._cancelled_lanes, list(prefixes)),
+                                                            **self._sampling_params(list(prefixes)))
+                for lane, predicted_patch in zip(prefixes, regenerated_patches):
+                    predicted_patches[lanes.index(lane)] = prefixes[lane] + predicted_patch
+
+            lane_tokens = {}
+            for lane, predicted_patch in zip(lanes, predicted_patches):
+                piece = self.lanes[lane][2]
+                if piece.cancel_reason is not None:
+                    continue
+                predicted_patch = piece.accept(predicted_patch)
+                if predicted_patch is not None:
+                    lane_tokens[lane] = predicted_patch
+                elif piece.rollback is not None:
+                    self.session.truncate_lane(lane, *piece.rollback)
+                    piece.rollback = None
+            self.session.append(lane_tokens)    # encodes only the new patches
+            for lane in lane_tokens:
+                key, _, piece = self.lanes[lane]
+                if piece.checkpoint_pending:
+                    piece.save_checkpoint(self.session.num_patches[lane], self.session.encoded_patches[lane])
+                if isinstance(key, Variations) and piece.num_lines >= key.num_lines and piece.at_line_end:
+                    lanes += self._branch(lane)     # the forked lanes may shift their window below
+
+            for lane in lanes:
+                key, prompt, piece = self.lanes[lane]
+                if piece.cancel_reason is not None:
+                    self._cancel(lane)
+                    continue
+                if not piece.stop_flag and self.session.lane_length(lane) >= PATCH_LENGTH * PATCH_SIZE:
+                    shift = piece.shift_window(functools.partial(self.session.reset_lane, lane))
+                    if shift is not None:
+                        self.window_stats['shifts'] += 1
+                        for name in ('encoded_patches', 'cached_patches', 'seconds'):
+                            self.window_stats[name] += shift[name]
+                if piece.stop_flag:
+                    abc_text = piece.result()
+                    if abc_text is None:
+                        self._restart(lane)
                     else:
-                        metadata_byte_list.append(char)
-                    print(char, end='')
+                        self.session.retire_lane(lane)
+                        self.lanes[lane] = None
+                        for key in expand_keys(key):
+                            self.branch_points.pop(key, None)
+                            finished.append((key, abc_text))
 
-                patch_end_flag = False
-                for j in range(len(predicted_patch)):
-                    if patch_end_flag:
-                        predicted_patch[j] = patchilizer.special_token_id
-                    if predicted_patch[j] == patchilizer.eos_token_id:
-                        patch_end_flag = True
+        return finished
 
-                predicted_patch = torch.tensor([predicted_patch], device=device)  # (1, 16)
-                input_patches = torch.cat([input_patches, predicted_patch], dim=1)  # (1, 16 * patch_len)
 
-                if len(byte_list) > 102400:
-                    failure_flag = True
-                    break
-                if time.time() - start_time > 10 * 60: 
-                    failure_flag = True
-                    break
+class LineProgress:
+    """
+    An on_event callback showing the number of generated lines on one console line, in place of the text.
+    With generate_pieces, it counts the lines of all pieces.
+    """
+    def __init__(self, label='Generating'):
+        self.label = label
+        self.num_lines = 0
 
-                if input_patches.shape[1] >= PATCH_LENGTH * PATCH_SIZE and not end_flag:
-                    print('Stream generating...')
+    def __call__(self, *args):
+        event = args[-1]    # generate_pieces passes the index of the prompt first
+        if event.kind == 'line':
+            self.num_lines += 1
+            print(f'\r{self.label}: {self.num_lines} lines', end='', flush=True)
 
-                    metadata = ''.join(metadata_byte_list)
-                    context_tunebody = ''.join(context_tunebody_byte_list)
+    def close(self):
+        if self.num_lines > 0:
+            print()
+        self.num_lines = 0
 
-                    if '\n' not in context_tunebody:
-                        break   # Generated content is all metadata, abandon
 
-                    context_tunebody_lines = context_tunebody.split('\n')
-                    if not context_tunebody.endswith('\n'):
-                        context_tunebody_lines = [context_tunebody_lines[i] + '\n' for i in range(len(context_tunebody_lines) - 1)] + [context_tunebody_lines[-1]]
-                    else:
-                        context_tunebody_lines = [context_tunebody_lines[i] + '\n' for i in range(len(context_tunebody_lines))]
+def speculative_inference_patch(period, composer, instrumentation, proposer, num_draft_patches=NUM_DRAFT_PATCHES, verbose=True,
+                                write=None, on_event=None, params=None, token=None):
+    """
+    Generate a piece with a SpeculativeGenerationSession.
+    :param proposer: the proposer of speculative patches, e.g. DraftModelProposer(draft_model)
+    :param num_draft_patches: the number of patches proposed per pass of the model
+    :param write: a callable receiving the generated text as it is produced
+    :param on_event: a callable receiving the GenerationEvents of the piece
+    :param params: sampling parameters overriding the config
+    :param token: a CancellationToken, checked between patches
+    :return: the post-processed piece, and the session (for its acceptance statistics)
+    :raise GenerationCancelled: when the token is cancelled or its deadline passes
+    """
+    session = SpeculativeGenerationSession(load_models(), proposer, num_draft_patches, quantize_cache=KV_CACHE_INT8)
 
-                    cut_index = len(context_tunebody_lines) // 2
-                    abc_code_slice = metadata + ''.join(context_tunebody_lines[-cut_index:])
+    with torch.inference_mode(), autocast(device, model_dtype()):
+        while True:
+            piece = PieceGeneration(period, composer, instrumentation, verbose=verbose, write=write, on_event=on_event,
+                                    params=params, token=token)
+            session.reset(piece.prompt_patches(), prefix_cache=prefix_cache)
 
-                    input_patches = patchilizer.encode_generate(abc_code_slice)
+            while not piece.stop_flag and piece.check_cancelled() is None:
+                predicted_patch = piece.next_patch(functools.partial(session.generate, **piece.sampling_params))
+                piece.advance(session, predicted_patch)
 
-                    input_patches = [item for sublist in input_patches for item in sublist]
-                    input_patches = torch.tensor([input_patches], device=device)
-                    input_patches = input_patches.reshape(1, -1)
+                if not piece.stop_flag and len(session) >= PATCH_LENGTH * PATCH_SIZE:
+                    piece.shift_window(session.reset)
 
-                    context_tunebody_byte_list = list(''.join(context_tunebody_lines[-cut_index:]))
+            if piece.cancel_reason is not None:
+                raise GenerationCancelled(piece.cancel_reason)
+            abc_text = piece.result()
+            if abc_text is not None:
+                return abc_text, session
 
-            if not failure_flag:
-                abc_text = ''.join(byte_list)
 
-                # unreduce
-                abc_lines = abc_text.split('\n')
-                abc_lines = list(filter(None, abc_lines))
-                abc_lines = [line + '\n' for line in abc_lines]
-                try:
-                    unreduced_abc_lines = rest_unreduce(abc_lines)
-                except:
-                    failure_flag = True
-                    pass
-                else:
-                    unreduced_abc_lines = prompt_lines + [line for line in unreduced_abc_lines if not(line.startswith('%') and not line.startswith('%%'))]
-                    unreduced_abc_lines = ['X:1\n'] + unreduced_abc_lines
-                    unreduced_abc_text = ''.join(unreduced_abc_lines)
-                    return unreduced_abc_text
+def inference_patch(period, composer, instrumentation, write=None, on_event=None, params=None, token=None):
+    """
+    Generate a piece, printing it as it is generated unless a sink is given.
+    :param write: a callable receiving the generated text as it is produced
+    :param on_event: a callable receiving the GenerationEvents of the piece
+    :param params: sampling parameters overriding the config, e.g. {'temperature': 1.0}
+    :param token: a CancellationToken, checked between patches
+    :return: the post-processed piece
+    :raise GenerationCancelled: when the token is cancelled or its deadline passes
+    """
+    verbose = write is None and on_event is None
+    if verbose:
+        print(f'{period=}, {composer=}, {instrumentation=}')
+
+    load_models()
+    if draft_model is not None or BAR_LOOKUP:
+        proposer = DraftModelProposer(draft_model) if draft_model is not None else BarLookupProposer()
+        abc_text, session = speculative_inference_patch(period, composer, instrumentation, proposer,
+                                                        verbose=verbose, write=write, on_event=on_event, params=params,
+                                                        token=token)
+        if verbose:
+            print(f'acceptance rate: {session.acceptance_rate:.2f}, patches per pass: {session.patches_per_round:.2f}')
+        return abc_text
+
+    generator = BatchGenerator(batch_size=1, verbose=verbose)
+    generator.submit(None, period, composer, instrumentation, write=write, on_event=on_event, params=params, token=token)
+
+    while True:
+        for _, abc_text in generator.step():
+            return abc_text
+        for _, reason in generator.pop_cancelled():
+            raise GenerationCancelled(reason)
 
 
-        
+def infill_patch(abc_text, start_line, end_line, write=None, on_event=None, params=None, token=None):
+    """
+    Regenerate tunebody lines start_line to end_line - 1 of a piece (its bars, in the interleaved notation), keeping
+    the others. The prompt and metadata patches are forked from prefix_cache, which is shared with the other requests,
+    the lines before the range are prefilled after them in one pass (they are unique to the piece, so they are not
+    cached), and only the lines of the range are generated. They are spliced back between the
+    lines around the range with the [r:i/j] counters renumbered. The model sees only the lines before the range, so
+    the new lines are not conditioned on those after it.
+    :param abc_text: the piece, as generated or post-processed
+    :param start_line: the index of the first tunebody line to regenerate
+    :param end_line: the index after the last tunebody line to regenerate
+    :param write: a callable receiving the text of the prefilled and generated lines as it is produced
+    :param on_event: a callable receiving the GenerationEvents of the piece
+    :param params: sampling parameters overriding the config, e.g. {'temperature': 1.0}
+    :param token: a CancellationToken, checked between patches
+    :return: the post-processed piece
+    :raise ValueError: when the piece has no prompt lines, or the range is not within its tunebody lines
+    :raise GenerationCancelled: when the token is cancelled or its deadline passes
+    """
+    prompt_lines, metadata_lines, tunebody_lines = split_piece(abc_text)
+    if not 0 <= start_line < end_line <= len(tunebody_lines):
+        raise ValueError('Lines %d to %d are not within the %d tunebody lines' % (start_line, end_line, len(tunebody_lines)))
+    prompt = [line[1:-1] for line in prompt_lines]
+    verbose = write is None and on_event is None
+
+    session = GenerationSession(load_models(), quantize_cache=KV_CACHE_INT8)
+    with torch.inference_mode(), autocast(device, model_dtype()):
+        while True:
+            piece = PieceGeneration(*prompt, verbose=verbose, write=write, on_event=on_event, params=params, token=token)
+            input_patches = piece.prefill(metadata_lines, tunebody_lines[:start_line])
+            prefix_length = len(piece.byte_list)
+
+            num_hits = prefix_cache.hits
+            start_time = time.time()
+            session.reset(input_patches, prefix_cache=prefix_cache, num_prefix_patches=piece.num_metadata_patches)
+            piece.output('Prefilled %d patches%s in %.0f ms\n' % (len(input_patches), ' (cached)' if prefix_cache.hits > num_hits else '',
+                                                                 (time.time() - start_time) * 1000))
+
+            while not piece.stop_flag and piece.check_cancelled() is None:
+                predicted_patch = piece.next_patch(functools.partial(session.generate, **piece.sampling_params))
+                piece.advance(session, predicted_patch)
+                if piece.num_lines >= end_line and piece.at_line_end:
+                    break
+
+                if not piece.stop_flag and len(session) >= PATCH_LENGTH * PATCH_SIZE:
+                    piece.shift_window(session.reset)
+
+            if piece.cancel_reason is not None:
+                raise GenerationCancelled(piece.cancel_reason)
+            if piece.stop_flag:
+                continue    # failed or ended within the range, start over
+
+            new_lines = [line + '\n' for line in ''.join(piece.byte_list[prefix_length:]).split('\n')[:-1]]
+            new_lines = [line for line in new_lines if line.startswith('[r:') or line.startswith('[V:')]
+            lines = tunebody_lines[:start_line] + new_lines[:end_line - start_line] + tunebody_lines[end_line:]
+            piece.byte_list = list(''.join(prompt_lines + metadata_lines + number_lines(lines)))
+            abc_text = piece.result()
+            if abc_text is not None:
+                return abc_text
+
+
+def generate_pieces(prompts, batch_size=BATCH_SIZE, on_event=None):
+    """
+    Generate a piece for each (period, composer, instrumentation) prompt, advancing up to batch_size pieces in lockstep.
+    :param prompts: a list of (period, composer, instrumentation)
+    :param batch_size: the number of lanes
+    :param on_event: a callable receiving the index of the prompt and a GenerationEvent of its piece
+    :return: an iterator of (index of the prompt, abc_text), in the order the pieces finish
+    """
+    generator = BatchGenerator(batch_size=batch_size)
+    for index, prompt in enumerate(prompts):
+        generator.submit(index, *prompt, on_event=functools.partial(on_event, index) if on_event is not None else None)
+
+    while generator.busy:
+        for index, abc_text in generator.step():
+            yield index, abc_text
+
+
+def generate_variations(period, composer, instrumentation, num_variations, num_lines, batch_size=None, on_event=None,
+                        params=None):
+    """
+    Generate num_variations pieces sharing their first num_lines tunebody lines, e.g. alternatives of a piece from
+    bar num_lines + 1 onward. The shared lines are generated once, then the variations are sampled in lockstep from
+    copies of their cache (see BatchGenerator.submit_variations).
+    :param batch_size: the number of lanes, defaults to num_variations
+    :param on_event: a callable receiving the index of the variation and a GenerationEvent of its piece
+    :param params: sampling parameters overriding the config, e.g. {'temperature': 1.0}
+    :return: an iterator of (index of the variation, abc_text), in the order the variations finish
+    """
+    generator = BatchGenerator(batch_size=batch_size or num_variations)
+    generator.submit_variations(list(range(num_variations)), period, composer, instrumentation, num_lines,
+                                on_event=on_event, params=params)
+
+    while generator.busy:
+        for index, abc_text in generator.step():
+            yield index, abc_text
 
 
 
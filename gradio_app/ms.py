@@ -2,6 +2,7 @@ import os
 import requests
 import subprocess
 import time
+import threading
 from tqdm import tqdm
 
 def download(filename, url):
@@ -29,15 +30,25 @@ def download(filename, url):
 apkname = "MuseScore.AppImage"
 extra_dir = "squashfs-root"
 
-if not os.path.exists(apkname):
-    download(
-        filename=apkname,
-        url="https://master.dl.sourceforge.net/project/musescore-linux-mirror/MuseScore.AppImage?viasf=1",
-    )
-    
-if not os.path.exists(extra_dir):
-    subprocess.run(["chmod", "+x", f"./{apkname}"])
-    subprocess.run([f"./{apkname}", "--appimage-extract"])
-
 MSCORE = f"./{extra_dir}/AppRun"
 os.environ["QT_QPA_PLATFORM"] = "offscreen"
+
+mscore_lock = threading.Lock()
+
+
+def mscore():
+    """
+    The path of the MuseScore executable, downloaded and extracted at the first call rather than at import.
+    """
+    with mscore_lock:
+        if not os.path.exists(apkname):
+            download(
+                filename=apkname,
+                url="https://master.dl.sourceforge.net/project/musescore-linux-mirror/MuseScore.AppImage?viasf=1",
+            )
+
+        if not os.path.exists(extra_dir):
+            subprocess.run(["chmod", "+x", f"./{apkname}"])
+            subprocess.run([f"./{apkname}", "--appimage-extract"])
+
+    return MSCORE
@@ -0,0 +1,281 @@
+import time
+import queue
+import asyncio
+import threading
+import itertools
+from collections import deque
+
+from .config import *
+from .inference import BatchGenerator, CancellationToken, GenerationCancelled, failure_reasons, sampling_params
+
+
+class GenerationRequest:
+    """
+    A piece requested from a GenerationScheduler.
+    Iterating over it yields the generated text as the scheduler produces it, and `async for` over it yields
+    the GenerationEvents of the piece; result() waits for the final piece, and `await request.wait()` does so
+    without blocking the event loop. cancel() abandons the piece, which then fails with GenerationCancelled.
+    :param timeout: seconds from submission after which the piece is abandoned, None for no deadline
+    """
+    def __init__(self, key, period, composer, instrumentation, params=None, timeout=None):
+        self.key = key
+        self.prompt = (period, composer, instrumentation)
+        self.params = params
+        self.token = CancellationToken(timeout)
+
+        self.submit_time = time.time()
+        self.start_time = None          # joined the running batch
+        self.first_output_time = None   # the first patch has been generated
+        self.finish_time = None
+
+        self.abc_text = None
+        self.error = None
+        self.chunks = queue.Queue()
+        self.done = threading.Event()
+        self.events = []            # the events so far, replayed to async iterators joining late
+        self.listeners = []         # (loop, asyncio.Queue) of the async iterators
+        self.done_callbacks = []
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        if self.start_time is None:
+            self.start_time = time.time()   # the prompt is written as the piece joins the batch
+        elif self.first_output_time is None:
+            self.first_output_time = time.time()
+        self.chunks.put(text)
+
+    def event(self, event):
+        self._publish(event)
+
+    def cancel(self):
+        """
+        Abandon the piece: its lane is freed before the next patch, or before the next char of the current one.
+        """
+        self.token.cancel()
+
+    def finish(self, abc_text=None, error=None):
+        self.abc_text = abc_text
+        self.error = error
+        self.finish_time = time.time()
+        self.done.set()
+        self.chunks.put(None)
+        self._publish(None)
+        with self.lock:
+            callbacks, self.done_callbacks = self.done_callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(request) once the generation has finished, from the thread finishing it, or right away if it
+        already has.
+        """
+        with self.lock:
+            if not self.done.is_set():
+                self.done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def _publish(self, event):
+        with self.lock:
+            self.events.append(event)
+            for loop, events in self.listeners:
+                try:
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+                except RuntimeError:
+                    pass    # an iterator abandoned with its closed loop
+
+    def __iter__(self):
+        while True:
+            text = self.chunks.get()
+            if text is None:
+                return
+            yield text
+
+    async def __aiter__(self):
+        events = asyncio.Queue()
+        with self.lock:
+            for event in self.events:
+                events.put_nowait(event)
+            self.listeners.append((asyncio.get_running_loop(), events))
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            with self.lock:
+                self.listeners = [listener for listener in self.listeners if listener[1] is not events]
+
+    def result(self, timeout=None):
+        """
+        Wait for the generation to finish.
+        :return: the post-processed piece
+        """
+        if not self.done.wait(timeout):
+            raise TimeoutError('The generation has not finished')
+        if self.error is not None:
+            raise self.error
+        return self.abc_text
+
+    async def wait(self):
+        """
+        Wait for the generation to finish without blocking the event loop.
+        :return: the post-processed piece
+        """
+        async for _ in self:
+            pass
+        return self.result()
+
+    @property
+    def queue_time(self):
+        """
+        Seconds waited for a lane, None while still queued.
+        """
+        return None if self.start_time is None else self.start_time - self.submit_time
+
+    @property
+    def latency(self):
+        """
+        Seconds from submission to the finished piece, None while in flight.
+        """
+        return None if self.finish_time is None else self.finish_time - self.submit_time
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class GenerationScheduler:
+    """
+    Serve generation requests from many callers with continuous batching.
+    A worker thread owns the model through a BatchGenerator: new requests join the running batch and finished ones
+    leave it between patch steps, so a request never waits for the whole batch to finish.
+    :param max_pending: the most requests waiting for a lane before submit() refuses new ones, None for no bound
+    """
+    def __init__(self, batch_size=BATCH_SIZE, history_size=1000, max_pending=None):
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.generator = BatchGenerator(batch_size=batch_size)
+        self.condition = threading.Condition()
+        self.pending = deque()      # requests submitted since the last step
+        self.requests = {}          # key -> request, of the requests handed to the generator
+        self.keys = itertools.count()
+        self.thread = None
+
+        self.num_steps = 0
+        self.num_lane_steps = 0     # sum of the active lanes over the steps
+        self.num_completed = 0
+        self.num_failed = 0
+        self.num_cancelled = 0
+        self.num_expired = 0        # abandoned at their deadline
+        self.queue_times = deque(maxlen=history_size)
+        self.first_output_times = deque(maxlen=history_size)
+        self.latencies = deque(maxlen=history_size)
+
+    def submit(self, period, composer, instrumentation, params=None, timeout=REQUEST_DEADLINE):
+        """
+        Queue a piece to generate.
+        :param params: sampling parameters overriding the config, e.g. {'temperature': 1.0}
+        :param timeout: seconds after which the piece is abandoned, None for no deadline
+        :return: a GenerationRequest streaming the generated text
+        :raise queue.Full: when max_pending requests are already waiting for a lane
+        """
+        sampling_params(params)     # raise the ValueError of unknown parameters to the caller
+        with self.condition:
+            if self.max_pending is not None and self.queue_depth >= self.max_pending:
+                raise queue.Full(f'{self.queue_depth} requests are already waiting')
+            request = GenerationRequest(next(self.keys), period, composer, instrumentation, params=params,
+                                        timeout=timeout)
+            self.pending.append(request)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return request
+
+    @property
+    def queue_depth(self):
+        """
+        The number of requests waiting for a lane.
+        """
+        return len(self.pending) + len(self.generator.queue)
+
+    def metrics(self):
+        """
+        A snapshot of the queue depth, batch occupancy, request outcomes and latencies (in seconds), the pieces
+        preempted by a full paged cache, and the histogram of the reasons of rejected lines and failed or abandoned
+        pieces.
+        """
+        with self.condition:
+            num_active_lanes = self.generator.num_active_lanes
+            return {
+                'queue_depth': self.queue_depth,
+                'active_lanes': num_active_lanes,
+                'batch_size': self.batch_size,
+                'occupancy': num_active_lanes / self.batch_size,
+                'mean_occupancy': self.num_lane_steps / (self.num_steps * self.batch_size) if self.num_steps > 0 else None,
+                'steps': self.num_steps,
+                'completed': self.num_completed,
+                'failed': self.num_failed,
+                'cancelled': self.num_cancelled,
+                'expired': self.num_expired,
+                'preempted': self.generator.num_preemptions,
+                'queue_time_p50': percentile(self.queue_times, 0.5),
+                'queue_time_p95': percentile(self.queue_times, 0.95),
+                'first_output_p50': percentile(self.first_output_times, 0.5),
+                'first_output_p95': percentile(self.first_output_times, 0.95),
+                'latency_p50': percentile(self.latencies, 0.5),
+                'latency_p95': percentile(self.latencies, 0.95),
+                'failure_reasons': dict(failure_reasons),
+            }
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and not self.generator.busy:
+                    self.condition.wait()
+                while len(self.pending) > 0:
+                    request = self.pending.popleft()
+                    self.requests[request.key] = request
+                    self.generator.submit(request.key, *request.prompt, write=request.write, on_event=request.event,
+                                          params=request.params, token=request.token)
+
+            try:
+                finished = self.generator.step()
+            except Exception as e:
+                self._fail(e)
+                continue
+
+            with self.condition:
+                self.num_steps += 1
+                self.num_lane_steps += self.generator.num_active_lanes + len(finished)
+                for key, abc_text in finished:
+                    request = self.requests.pop(key)
+                    request.finish(abc_text)
+                    self.num_completed += 1
+                    self.queue_times.append(request.queue_time)
+                    if request.first_output_time is not None:
+                        self.first_output_times.append(request.first_output_time - request.submit_time)
+                    self.latencies.append(request.latency)
+                for key, reason in self.generator.pop_cancelled():
+                    self.requests.pop(key).finish(error=GenerationCancelled(reason))
+                    if reason == 'deadline':
+                        self.num_expired += 1
+                    else:
+                        self.num_cancelled += 1
+
+    def _fail(self, error):
+        """
+        Fail every request in flight and start over with a fresh batch.
+        """
+        with self.condition:
+            for request in self.requests.values():
+                request.finish(error=error)
+            self.num_failed += len(self.requests)
+            self.requests = {}
+            self.generator = BatchGenerator(batch_size=self.batch_size)
@@ -0,0 +1,100 @@
+import queue
+import asyncio
+
+from .config import *
+from .scheduler import GenerationScheduler
+
+
+class GenerationService:
+    """
+    An asyncio front end of the model: `await service.generate(prompt, params)` from any number of coroutines.
+    The pieces are generated by the single worker thread of a GenerationScheduler, which owns the model, so the model
+    runs one batch step at a time however many callers there are, and the event loop never waits for it.
+    Backpressure: at most max_in_flight requests are handed to the scheduler, up to max_waiting more callers wait for
+    a slot, and further callers are refused with a RuntimeError rather than queued without bound.
+    A piece whose caller goes away (its task is cancelled) or whose deadline passes frees its lane at once.
+    """
+    def __init__(self, batch_size=BATCH_SIZE, max_in_flight=None, max_waiting=None, scheduler=None):
+        self.scheduler = scheduler or GenerationScheduler(batch_size=batch_size)
+        self.max_in_flight = max_in_flight or 2 * self.scheduler.batch_size
+        self.max_waiting = max_waiting if max_waiting is not None else 4 * self.scheduler.batch_size
+        self.slots = None           # asyncio.Semaphore of the requests in flight, created on the loop of the first call
+        self.loop = None
+        self.num_waiting = 0
+        self.num_in_flight = 0
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            if self.num_in_flight > 0:
+                raise RuntimeError('GenerationService is in use by another event loop')
+            self.loop = loop
+            self.slots = asyncio.Semaphore(self.max_in_flight)
+
+    async def submit(self, prompt, params=None, timeout=REQUEST_DEADLINE):
+        """
+        Hand a piece to the scheduler once a slot is free.
+        :param prompt: (period, composer, instrumentation)
+        :param params: sampling parameters overriding the config, e.g. {'temperature': 1.0}
+        :param timeout: seconds from submission after which the piece is abandoned, None for no deadline
+        :return: the GenerationRequest, to `async for` over its events
+        :raise RuntimeError: when max_waiting callers are already waiting for a slot
+        :raise ValueError: on unknown sampling parameters
+        """
+        self._bind()
+        if self.slots.locked() and self.num_waiting >= self.max_waiting:
+            raise RuntimeError('The generation queue is full, please try again later')
+
+        self.num_waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.num_waiting -= 1
+
+        try:
+            request = self.scheduler.submit(*prompt, params=params, timeout=timeout)
+        except (ValueError, queue.Full):
+            self.slots.release()
+            raise
+        self.num_in_flight += 1
+        # the request finishes on the worker thread, its slot is released on the loop
+        loop = self.loop
+
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(self._release)
+            except RuntimeError:
+                pass    # the loop has been closed
+
+        request.add_done_callback(release)
+        return request
+
+    def _release(self):
+        self.num_in_flight -= 1
+        self.slots.release()
+
+    async def generate(self, prompt, params=None, on_event=None, timeout=REQUEST_DEADLINE):
+        """
+        Generate a piece without blocking the event loop. Cancelling the awaiting task cancels the piece.
+        :param on_event: a callable receiving the GenerationEvents of the piece as they come
+        :param timeout: seconds from submission after which the piece is abandoned, None for no deadline
+        :return: the post-processed piece
+        :raise GenerationCancelled: when the deadline passes
+        """
+        request = await self.submit(prompt, params, timeout)
+        try:
+            async for event in request:
+                if on_event is not None:
+                    on_event(event)
+        finally:
+            request.cancel()    # no-op once finished
+        return request.result()
+
+    def metrics(self):
+        """
+        The metrics of the scheduler, with the number of requests in flight and of callers waiting for a slot.
+        """
+        metrics = self.scheduler.metrics()
+        metrics['in_flight'] = self.num_in_flight
+        metrics['waiting'] = self.num_waiting
+        return metrics
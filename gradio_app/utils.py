@@ -1,10 +1,19 @@
 import torch
+import time
 import random
 import bisect
 import re
+import os
+import json
+import contextlib
+import functools
+import threading
+from collections import OrderedDict
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
 from .config import *
 from transformers import GPT2Model, GPT2LMHeadModel, LlamaModel, LlamaForCausalLM, PreTrainedModel
-from samplings import top_p_sampling, top_k_sampling, temperature_sampling
+from transformers.pytorch_utils import Conv1D
 
 
 class Patchilizer:
@@ -216,6 +225,66 @@ class Patchilizer:
         
 
 
+class TunebodyRules:
+    """
+    Predict the deterministic markup at the start of the next patch of a generated tunebody, so that those chars
+    are forced into the char-level decoder instead of sampled. In the format of Patchilizer.encode_train:
+    - every line starts with [r:i/j], where i counts the lines and j the lines left, so it follows from the last line;
+    - after the line with j = 0 comes the eos patch.
+    The voice tags are left to the model: the training data is rest reduced, so a line may omit any voice resting
+    for the whole bar, the first one included.
+    """
+    line_pattern = re.compile(r'^\[r:(\d+)/(\d+)\]')
+
+    def __init__(self, bos_token_id=1, eos_token_id=2, patch_size=PATCH_SIZE):
+        self.bos_token_id = bos_token_id
+        self.eos_token_id = eos_token_id
+        self.patch_size = patch_size
+        self.line = ''              # the incomplete last line
+        self.last_counters = None   # (i, j) of the last complete line
+        self.forced_chars = 0
+
+    def feed(self, text):
+        """
+        Take generated tunebody text.
+        """
+        lines = (self.line + text).split('\n')
+        for line in lines[:-1]:
+            match = self.line_pattern.match(line)
+            if match is None:
+                self.last_counters = None   # the format is broken, stop predicting
+                continue
+            self.last_counters = (int(match.group(1)), int(match.group(2)))
+        self.line = lines[-1]
+
+    def next_prefix(self):
+        """
+        The known chars at the start of the next patch, or None if nothing is known.
+        """
+        if self.line != '' or self.last_counters is None:
+            return None
+        i, j = self.last_counters
+        if j == 0:
+            prefix = [self.bos_token_id] + [self.eos_token_id] * (self.patch_size - 1)
+        else:
+            prefix = [ord(c) for c in '[r:%d/%d]' % (i + 1, j - 1)][:self.patch_size]
+        self.forced_chars += len(prefix)
+        return prefix
+
+    def state_dict(self):
+        """
+        The state of the rules as plain values, e.g. to save a generation in progress.
+        """
+        return {'line': self.line,
+                'last_counters': self.last_counters,
+                'forced_chars': self.forced_chars}
+
+    def load_state_dict(self, state):
+        self.line = state['line']
+        self.last_counters = None if state['last_counters'] is None else tuple(state['last_counters'])
+        self.forced_chars = state['forced_chars']
+
+
 class PatchLevelDecoder(PreTrainedModel):
     """
     A Patch-level Decoder model for generating patch features in an auto-regressive manner. 
@@ -227,24 +296,60 @@ class PatchLevelDecoder(PreTrainedModel):
         torch.nn.init.normal_(self.patch_embedding.weight, std=0.02)
         self.base = GPT2Model(config)
 
+    def embedding_table(self) -> torch.Tensor:
+        """
+        The patch_embedding weight transposed to [PATCH_SIZE * 128, hidden], so that row position * 128 + char is the
+        column of that char at that position. It is rebuilt on every call with grad (training), and cached until the
+        weight changes otherwise (generation).
+        """
+        weight = self.patch_embedding.weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return weight.t().contiguous()
+        key = (weight.data_ptr(), weight._version, weight.dtype, weight.device)
+        if getattr(self, '_embedding_table_key', None) != key:
+            with torch.no_grad():
+                self._embedding_table = weight.t().contiguous()
+            self._embedding_table_key = key
+        return self._embedding_table
+
+    def embed(self, patches: torch.Tensor) -> torch.Tensor:
+        """
+        Embed the patches, equal to applying patch_embedding to their one-hot chars.
+        Instead of building the sparse [.., PATCH_SIZE * 128] one-hot tensor, the PATCH_SIZE rows of each patch
+        are gathered from the embedding table and summed with embedding_bag.
+        :param patches: the chars of the patches, of shape [batch, length * PATCH_SIZE] or [batch, length, PATCH_SIZE]
+        :return: the patch embeddings, of shape [batch, length, hidden]
+        :raise ValueError: when a char is not in [0, 128), which would read the rows of the next position
+        """
+        batch_size = len(patches)
+        # checked where the patches are, before the transfer, as the one-hot encoding failed on such chars
+        if patches.numel() > 0 and (patches.min() < 0 or patches.max() >= 128):
+            raise ValueError('Chars must be in [0, 128), got %d to %d' % (patches.min(), patches.max()))
+        patches = patches.to(self.device).reshape(-1, PATCH_SIZE)
+        offsets = torch.arange(PATCH_SIZE, device=patches.device) * 128
+        embeddings = torch.nn.functional.embedding_bag(patches + offsets, self.embedding_table(), mode='sum')
+        embeddings = embeddings + self.patch_embedding.bias
+        return embeddings.reshape(batch_size, -1, embeddings.shape[-1])
+
     def forward(self,
                 patches: torch.Tensor,
-                masks=None) -> torch.Tensor:
+                masks=None,
+                past_key_values=None,
+                position_ids=None) -> torch.Tensor:
         """
         The forward pass of the patch-level decoder model.
         :param patches: the patches to be encoded
-        :param masks: the masks for the patches
+        :param masks: the masks for the patches (covering the cached patches as well, if any)
+        :param past_key_values: the cached keys and values of the previously encoded patches
+        :param position_ids: the positions of the patches, defaults to following the cached patches
         :return: the encoded patches
         """
-        patches = torch.nn.functional.one_hot(patches, num_classes=128).to(self.dtype)
-        patches = patches.reshape(len(patches), -1, PATCH_SIZE * (128))
-        patches = self.patch_embedding(patches.to(self.device))
+        patches = self.embed(patches)
 
-        if masks==None:
-            return self.base(inputs_embeds=patches)
-        else:
-            return self.base(inputs_embeds=patches,
-                             attention_mask=masks)
+        return self.base(inputs_embeds=patches,
+                         attention_mask=masks,
+                         past_key_values=past_key_values,
+                         position_ids=position_ids)
 
 
 class CharLevelDecoder(PreTrainedModel):
@@ -328,6 +433,60 @@ class CharLevelDecoder(PreTrainedModel):
 
         return probs
 
+    def prefill(self,
+                encoded_patches: torch.Tensor,  # [bs, hidden_size]
+                tokens: torch.Tensor):          # [bs, n]
+        """
+        The first step of cached decoding: encode the encoded patch and the already known tokens at once.
+        :param encoded_patches: the encoded patches
+        :param tokens: the bos token followed by the already known tokens in each patch
+        :return: the logits of next token, and the cached keys and values
+        """
+        # Get input embeddings
+        tokens = torch.nn.functional.embedding(tokens, self.base.transformer.wte.weight)
+
+        # Concatenate the encoded patch with the input embeddings
+        inputs_embeds = torch.cat((encoded_patches.unsqueeze(1), tokens[:,1:,:]), dim=1)
+
+        outputs = self.base.transformer(inputs_embeds=inputs_embeds, use_cache=True)
+
+        # Only the last position is needed for the next token
+        logits = self.base.lm_head(outputs.last_hidden_state[:,-1,:])  # [bs, vocab_size]
+
+        return logits, outputs.past_key_values
+
+    def decode_step(self,
+                    tokens: torch.Tensor,   # [bs]
+                    past_key_values):
+        """
+        One step of cached decoding: feed only the last sampled token.
+        :param tokens: the last sampled token in each patch
+        :param past_key_values: the cached keys and values
+        :return: the logits of next token, and the updated keys and values
+        """
+        inputs_embeds = torch.nn.functional.embedding(tokens.reshape(-1, 1), self.base.transformer.wte.weight)
+
+        outputs = self.base.transformer(inputs_embeds=inputs_embeds, past_key_values=past_key_values, use_cache=True)
+        logits = self.base.lm_head(outputs.last_hidden_state[:,-1,:])  # [bs, vocab_size]
+
+        return logits, outputs.past_key_values
+
+    def score(self,
+              encoded_patches: torch.Tensor,    # [bs, hidden_size]
+              tokens: torch.Tensor):            # [bs, n]
+        """
+        Teacher-forced decoding: the logits of every position in one pass.
+        :param encoded_patches: the encoded patches
+        :param tokens: the bos token followed by the known tokens in each patch
+        :return: the logits of the token after each position, [bs, n, vocab_size]
+        """
+        tokens = torch.nn.functional.embedding(tokens, self.base.transformer.wte.weight)
+        inputs_embeds = torch.cat((encoded_patches.unsqueeze(1), tokens[:,1:,:]), dim=1)
+
+        outputs = self.base.transformer(inputs_embeds=inputs_embeds)
+
+        return self.base.lm_head(outputs.last_hidden_state)
+
 class NotaGenLMHeadModel(PreTrainedModel):
     """
     NotaGen is a language model with a hierarchical structure.
@@ -386,19 +545,1725 @@ class NotaGenLMHeadModel(PreTrainedModel):
 
         patches = patches.reshape(len(patches), -1, PATCH_SIZE) # [bs, seq, patch_size]
         encoded_patches = self.patch_level_decoder(patches)["last_hidden_state"]    # [bs, seq, hidden_size]
-        generated_patch = []            
 
-        while True:
-            prob = self.char_level_decoder.generate(encoded_patches[0][-1], tokens).cpu().detach().numpy()  # [128]
-            prob = top_k_sampling(prob, top_k=top_k, return_probs=True) # [128]
-            prob = top_p_sampling(prob, top_p=top_p, return_probs=True) # [128]
-            token = temperature_sampling(prob, temperature=temperature) # int
-            #char = chr(token)
-            generated_patch.append(token)
+        return self.generate_patch(encoded_patches[0][-1], tokens, top_k=top_k, top_p=top_p, temperature=temperature)
+
+    def generate_patch(self,
+                       encoded_patch: torch.Tensor,
+                       tokens: torch.Tensor,
+                       top_k=0,
+                       top_p=1,
+                       temperature=1.0,
+                       min_p=0.0,
+                       repetition_penalty=1.0):
+        """
+        Generate the chars of the next patch from the feature of the last encoded patch.
+        Sampling runs on the model's device, and the patch is transferred to the host only once it is finished.
+        :param encoded_patch: the feature of the last encoded patch, [hidden_size]
+        :param tokens: the bos token followed by the already known chars of the patch
+        :param top_k: the top k for sampling
+        :param top_p: the top p for sampling
+        :param temperature: the temperature for sampling
+        :param min_p: the min p for sampling
+        :param repetition_penalty: the penalty for chars already in the patch
+        :return: the generated chars (not including the known ones)
+        """
+        known_tokens = [tokens.reshape(-1)[1:].tolist()]
+
+        return self.generate_patches(encoded_patch.reshape(1, -1), known_tokens,
+                                     top_k=top_k,
+                                     top_p=top_p,
+                                     temperature=temperature,
+                                     min_p=min_p,
+                                     repetition_penalty=repetition_penalty)[0]
 
-            if len(tokens) >= PATCH_SIZE:# or token == self.eos_token_id:
+    def generate_patches(self,
+                         encoded_patches: torch.Tensor,
+                         known_tokens,
+                         top_k=0,
+                         top_p=1,
+                         temperature=1.0,
+                         min_p=0.0,
+                         repetition_penalty=1.0,
+                         return_probs=False,
+                         stop_at_eos=True,
+                         cancelled=None,
+                         check_every=4):
+        """
+        Generate the chars of the next patch for a batch of independent pieces.
+        The known chars shared by all rows are prefilled at once; beyond that, known chars are forced into
+        the char-level decoder in place of the sampled ones, so that all rows advance in lockstep.
+        With stop_at_eos, a row is finished once it has produced the eos char and the rest of its patch is padded with
+        the special char, which is how the patch is masked before it is encoded anyway. Finished rows are masked on
+        the device; only every check_every chars does the host wait for it, to drop them from the char-level decoder
+        and to stop once all rows are finished.
+        :param encoded_patches: the features of the last encoded patches, [bs, hidden_size]
+        :param known_tokens: the already known chars of each patch (without bos), a list of bs lists
+        :param top_k: the top k for sampling, a number or one value per row
+        :param top_p: the top p for sampling, a number or one value per row
+        :param temperature: the temperature for sampling, a number or one value per row
+        :param min_p: the min p for sampling, a number or one value per row
+        :param repetition_penalty: the penalty for chars already in the patch, a number or one value per row
+        :param return_probs: also return the distributions the generated chars were sampled from
+        :param stop_at_eos: stop decoding each row at its eos char (the padding gets a one-hot distribution)
+        :param cancelled: a callable checked between chars, returning the indices of the rows to stop decoding
+                          (their patches are padded like those stopped at eos, and are meant to be discarded)
+        :param check_every: the number of chars between the checks for finished rows
+        :return: the generated chars of each patch (not including the known ones), a list of bs lists,
+                 and with return_probs, a list of bs tensors [num_generated, vocab_size]
+        """
+        batch_size = encoded_patches.shape[0]
+        num_known = [len(tokens) for tokens in known_tokens]
+        num_prefilled = min(num_known)
+
+        forced_tokens = torch.full((batch_size, PATCH_SIZE), -1, dtype=torch.long)
+        for i, tokens in enumerate(known_tokens):
+            forced_tokens[i, :len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+        forced_tokens = forced_tokens.to(self.device)
+
+        tokens = torch.full((batch_size, 1), self.bos_token_id, dtype=torch.long, device=self.device)
+        tokens = torch.cat((tokens, forced_tokens[:, :num_prefilled]), dim=1)
+        logits, past_key_values = self.char_level_decoder.prefill(encoded_patches, tokens)
+
+        seen_tokens = None
+        if torch.is_tensor(repetition_penalty) or not isinstance(repetition_penalty, (int, float)) \
+                or repetition_penalty != 1:
+            seen_tokens = torch.zeros_like(logits, dtype=torch.bool)
+            seen_tokens.scatter_(-1, tokens[:, 1:], True)
+
+        num_generated = PATCH_SIZE - num_prefilled
+        generated_patches = torch.full((batch_size, num_generated), self.special_token_id, dtype=torch.long,
+                                       device=self.device)
+        if return_probs:
+            generated_probs = torch.zeros((batch_size, num_generated, logits.shape[-1]), device=self.device)
+            generated_probs[:, :, self.special_token_id] = 1
+
+        rows = torch.arange(batch_size, device=self.device)  # the rows still in the char-level decoder
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device)    # of the rows, padded from now on
+        sampling_params = {'top_k': top_k, 'top_p': top_p, 'temperature': temperature, 'min_p': min_p,
+                           'repetition_penalty': repetition_penalty}
+        # decided on the host once, and the values of the rows moved to the device once, rather than at every char
+        filters = sampling_filters(**sampling_params)
+        sampling_params = {name: value if isinstance(value, (int, float)) else torch.as_tensor(value, device=self.device)
+                           for name, value in sampling_params.items()}
+        for i in range(num_prefilled, PATCH_SIZE):
+            prob = torch.nn.functional.softmax(logits, dim=-1).float()   # [rows, 128]
+            prob = sampling_probs(prob, seen_tokens=seen_tokens, filters=filters, **sampling_params)
+            token = sample_tokens(prob)  # [rows]
+            token = torch.where(forced_tokens[rows, i] >= 0, forced_tokens[rows, i], token)
+            token = token.masked_fill(finished, self.special_token_id)
+            generated_patches[rows, i - num_prefilled] = token
+            if return_probs:
+                generated_probs[rows, i - num_prefilled] = torch.where(finished.unsqueeze(-1),
+                                                                       generated_probs[rows, i - num_prefilled], prob)
+
+            if i == PATCH_SIZE - 1:
                 break
+            if stop_at_eos:
+                finished |= token == self.eos_token_id
+            if cancelled is not None:
+                cancelled_rows = cancelled()
+                if len(cancelled_rows) > 0:
+                    cancelled_rows = torch.tensor(list(cancelled_rows), dtype=torch.long, device=self.device)
+                    finished |= torch.isin(rows, cancelled_rows)
+            if (stop_at_eos or cancelled is not None) and (i + 1 - num_prefilled) % check_every == 0:
+                decoding = ~finished
+                num_decoding = int(decoding.sum())     # the host waits for the device here only
+                if num_decoding == 0:
+                    break
+                if num_decoding < len(rows):
+                    rows, token, finished = rows[decoding], token[decoding], finished[decoding]
+                    past_key_values = tuple(tuple(state[decoding] for state in layer) for layer in past_key_values)
+                    if seen_tokens is not None:
+                        seen_tokens = seen_tokens[decoding]
+                    sampling_params = {name: _select_rows(value, decoding) for name, value in sampling_params.items()}
+            if seen_tokens is not None:
+                seen_tokens.scatter_(-1, token.unsqueeze(-1), True)
+            logits, past_key_values = self.char_level_decoder.decode_step(token, past_key_values)
+
+        generated_patches = generated_patches.tolist()   # the only transfer of the chars to the host
+        generated_patches = [patch[num_known[i] - num_prefilled:] for i, patch in enumerate(generated_patches)]
+
+        if return_probs:
+            return generated_patches, [probs[num_known[i] - num_prefilled:] for i, probs in enumerate(generated_probs)]
+        return generated_patches
+
+    def patch_probs(self,
+                    encoded_patches: torch.Tensor,
+                    patches: torch.Tensor,
+                    top_k=0,
+                    top_p=1,
+                    temperature=1.0,
+                    min_p=0.0,
+                    repetition_penalty=1.0):
+        """
+        The distributions generate_patches would sample each char of given patches from, in one teacher-forced pass
+        of the char-level decoder. Used to verify speculative patches.
+        :param encoded_patches: the features of the encoded patches before each patch, [n, hidden_size]
+        :param patches: the patches, [n, patch_size]
+        :param top_k: the top k for sampling
+        :param top_p: the top p for sampling
+        :param temperature: the temperature for sampling
+        :param min_p: the min p for sampling
+        :param repetition_penalty: the penalty for chars already in the patch
+        :return: the modified distributions, [n, patch_size, vocab_size]
+        """
+        num_patches, patch_size = patches.shape
+        tokens = torch.full((num_patches, 1), self.bos_token_id, dtype=torch.long, device=patches.device)
+        tokens = torch.cat((tokens, patches[:, :-1]), dim=1)
+        logits = self.char_level_decoder.score(encoded_patches, tokens)
+        probs = torch.nn.functional.softmax(logits, dim=-1).float()
+        vocab_size = probs.shape[-1]
+
+        seen_tokens = None
+        if repetition_penalty != 1:
+            # the chars before each position
+            seen_tokens = torch.nn.functional.one_hot(patches, vocab_size).cumsum(1) > 0
+            seen_tokens = torch.cat((torch.zeros_like(seen_tokens[:, :1]), seen_tokens[:, :-1]), dim=1)
+            seen_tokens = seen_tokens.reshape(-1, vocab_size)
+
+        probs = sampling_probs(probs.reshape(-1, vocab_size),
+                               top_k=top_k,
+                               top_p=top_p,
+                               temperature=temperature,
+                               min_p=min_p,
+                               repetition_penalty=repetition_penalty,
+                               seen_tokens=seen_tokens)
+
+        return probs.reshape(num_patches, patch_size, vocab_size)
+
+
+def _select_rows(value, rows):
+    """
+    Select rows of a sampling parameter, a number applies to all rows.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    value = torch.as_tensor(value)
+    return value[rows.to(value.device)]
+
+
+FILTER_ENABLED = {'top_k': lambda value: value > 0,
+                  'top_p': lambda value: 0 < value < 1,
+                  'min_p': lambda value: value > 0,
+                  'temperature': lambda value: value != 1,
+                  'repetition_penalty': lambda value: value != 1}
+
+
+def sampling_filters(**sampling_params):
+    """
+    The filters of sampling_probs() enabled for some row, decided on the host from the sampling parameters.
+    A tensor on another device is not read back, its filter is taken as enabled (it leaves its disabled rows unchanged).
+    :param sampling_params: top_k, top_p, min_p, temperature and repetition_penalty, each a number or one value per row
+    :return: the set of the names of the enabled filters
+    """
+    filters = set()
+    for name, value in sampling_params.items():
+        if torch.is_tensor(value) and value.device.type != 'cpu':
+            filters.add(name)
+        elif any(FILTER_ENABLED[name](value) for value in torch.as_tensor(value).reshape(-1).tolist()):
+            filters.add(name)
+    return filters
+
+
+def _row_param(value, probs, dtype):
+    """
+    A sampling parameter as an operand of rows of probs: a number as it is, a sequence or tensor with one value per
+    row as [bs, 1] on the device of probs.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    value = torch.as_tensor(value, dtype=dtype, device=probs.device)
+    return value.reshape(-1, 1).expand(probs.shape[0], 1)
+
+
+def _where(enabled, filtered_probs, probs):
+    """
+    The filtered rows where the filter is enabled, a number parameter enables it for all rows.
+    """
+    return torch.where(enabled, filtered_probs, probs) if torch.is_tensor(enabled) else filtered_probs
+
+
+def _remove_sorted(probs, sorted_tokens, sorted_remove, enabled):
+    """
+    Zero out the tokens removed in sorted order, and renormalise the rows where the filter is enabled.
+    """
+    remove = torch.zeros_like(sorted_remove).scatter(-1, sorted_tokens, sorted_remove)
+    probs = probs.masked_fill(remove, 0)
+    return _where(enabled, probs / probs.sum(-1, keepdim=True), probs)
+
+
+def sampling_probs(probs,
+                   top_k=0,
+                   top_p=1.0,
+                   temperature=1.0,
+                   min_p=0.0,
+                   repetition_penalty=1.0,
+                   seen_tokens=None,
+                   filters=None):
+    """
+    Modify next token distributions on their device, row by row.
+    It follows samplings' top_k_sampling, top_p_sampling and temperature_sampling (in that order),
+    with an optional repetition penalty before and min p filtering before the temperature.
+    Each parameter is either a number or a sequence or tensor with one value per row. Which filters run is decided on
+    the host (see sampling_filters()), so that sampling never waits for the device.
+    :param probs: the next token distributions, [bs, vocab_size]
+    :param top_k: the top k for sampling, 0 to disable
+    :param top_p: the top p for sampling, 1 to disable
+    :param temperature: the temperature for sampling
+    :param min_p: the min p (relative to the most likely token) for sampling, 0 to disable
+    :param repetition_penalty: the exponent applied to the probabilities of seen tokens, 1 to disable
+    :param seen_tokens: a boolean mask of the tokens to penalise, [bs, vocab_size]
+    :param filters: the enabled filters as returned by sampling_filters(), computed from the parameters if not given
+    :return: the modified distributions
+    """
+    if filters is None:
+        filters = sampling_filters(top_k=top_k, top_p=top_p, temperature=temperature, min_p=min_p,
+                                   repetition_penalty=repetition_penalty)
+
+    if seen_tokens is not None and 'repetition_penalty' in filters:
+        repetition_penalty = _row_param(repetition_penalty, probs, probs.dtype)
+        penalised = seen_tokens & (repetition_penalty != 1)
+        probs = torch.where(penalised, probs.pow(repetition_penalty), probs)
+        probs = probs / probs.sum(-1, keepdim=True)
+
+    if 'top_k' in filters:
+        top_k = _row_param(top_k, probs, torch.long)
+        enabled = top_k > 0
+        sorted_tokens = torch.argsort(probs, dim=-1, descending=True)
+        ranks = torch.arange(probs.shape[-1], device=probs.device).expand_as(probs)
+        probs = _remove_sorted(probs, sorted_tokens, (ranks >= top_k) & enabled, enabled)
+
+    if 'top_p' in filters:
+        top_p = _row_param(top_p, probs, probs.dtype)
+        enabled = (top_p > 0) & (top_p < 1)
+        sorted_probs, sorted_tokens = torch.sort(probs, dim=-1, descending=True)
+        sorted_remove = sorted_probs.cumsum(-1) > top_p
+        # Logical right shift, the first token is always kept
+        sorted_remove = torch.cat((torch.zeros_like(sorted_remove[:, :1]), sorted_remove[:, :-1]), dim=-1)
+        probs = _remove_sorted(probs, sorted_tokens, sorted_remove & enabled, enabled)
+
+    if 'min_p' in filters:
+        min_p = _row_param(min_p, probs, probs.dtype)
+        enabled = min_p > 0
+        remove = (probs < min_p * probs.max(-1, keepdim=True).values) & enabled
+        probs = probs.masked_fill(remove, 0)
+        probs = _where(enabled, probs / probs.sum(-1, keepdim=True), probs)
+
+    if 'temperature' in filters:
+        temperature = _row_param(temperature, probs, probs.dtype)
+        enabled = temperature != 1
+        probs_sum = probs.sum(-1, keepdim=True)
+        tempered_probs = torch.exp(torch.log(probs / probs_sum) / temperature)
+        tempered_probs = probs_sum * tempered_probs / tempered_probs.sum(-1, keepdim=True)
+        probs = _where(enabled, tempered_probs, probs)
+
+    return probs
+
+
+def sample_tokens(probs, uniform=None, generator=None):
+    """
+    Draw one token per row by inverse transform sampling on the device.
+    This is how numpy.random.choice (and thus samplings) draws, so the same uniform number picks the same token.
+    :param probs: the next token distributions, [bs, vocab_size]
+    :param uniform: numbers in [0, 1), one per row, drawn on the device if not given
+    :param generator: the random generator for drawing the uniform numbers
+    :return: the sampled tokens, [bs]
+    """
+    dtype = torch.float32 if probs.device.type == 'mps' else torch.float64
+    cdf = probs.to(dtype).cumsum(-1)
+    cdf = cdf / cdf[:, -1:]
+    if uniform is None:
+        uniform = torch.rand(probs.shape[0], dtype=dtype, device=probs.device, generator=generator)
+    uniform = torch.as_tensor(uniform, dtype=dtype, device=probs.device).reshape(-1, 1)
+    tokens = torch.searchsorted(cdf, uniform, right=True).squeeze(-1)
+
+    # rounding may leave the cdf short of 1 before the trailing tokens of zero probability, never pick those
+    last_tokens = torch.where(probs > 0, torch.arange(probs.shape[-1], device=probs.device), 0).amax(-1)
+    return torch.minimum(tokens, last_tokens)
+
+
+class BatchGenerationSession:
+    """
+    A stateful generation session of NotaGenLMHeadModel, advancing several independent pieces (lanes) in lockstep.
+    The patch history of each lane is kept in a preallocated buffer, and the keys and values of the patch-level
+    decoder are cached in one padded batch, with an attention mask marking the cached positions of each lane.
+    Lanes can be reset (e.g. at the stream window), retired and refilled independently.
+    With quantize_cache, the keys and values are kept in int8 with a scale per head and position (see quantize_kv()),
+    about half the memory of float16, so that more lanes or longer contexts fit.
+    """
+    def __init__(self, model, batch_size, patch_length=PATCH_LENGTH, patch_size=PATCH_SIZE, quantize_cache=False):
+        self.model = model
+        self.batch_size = batch_size
+        self.patch_length = patch_length
+        self.patch_size = patch_size
+        self.quantize_cache = quantize_cache
+        self.patches = torch.full((batch_size, patch_length, patch_size), model.special_token_id,
+                                  dtype=torch.long, device=model.device)
+        self.num_patches = [0] * batch_size
+        self.tokens = [[] for _ in range(batch_size)]   # chars of the incomplete last patch of each lane
+        self.active = [False] * batch_size
+        self.past_key_values = None     # (key, value) per layer, or (key, key scales, value, value scales) if quantized
+        self.attention_mask = torch.zeros((batch_size, 0), dtype=torch.long, device=model.device)
+        self.encoded_patches = None     # features of the last encoded patch of each lane
+
+    def lane_length(self, lane):
+        """
+        The number of ids in a lane, i.e. input_patches.shape[1] of the non-cached generation loop.
+        """
+        return self.num_patches[lane] * self.patch_size + len(self.tokens[lane])
+
+    def lane_patches(self, lane):
+        """
+        The flat patch history of a lane, [1, self.lane_length(lane)].
+        """
+        input_patches = self.patches[lane, :self.num_patches[lane]].reshape(1, -1)
+        if len(self.tokens[lane]) > 0:
+            tokens = torch.tensor([self.tokens[lane]], dtype=torch.long, device=self.patches.device)
+            input_patches = torch.cat([input_patches, tokens], dim=1)
+        return input_patches
+
+    def lane_cache(self, lane):
+        """
+        The cached keys and values of a lane as if it had been encoded alone, e.g. to save them with the patches of
+        the lane and restore it later with reset_lane(lane, patches, cache=...) without encoding them again.
+        :return: the float past_key_values of the complete patches of the lane (batch size 1), and the feature of its
+                 last patch
+        """
+        positions = self.attention_mask[lane].nonzero().squeeze(-1)
+        past_key_values = []
+        for layer in self.past_key_values:
+            states = [state[lane:lane + 1, :, positions] for state in layer]
+            if self.quantize_cache:
+                states = [dequantize_kv(states[0], states[1]), dequantize_kv(states[2], states[3])]
+            past_key_values.append(tuple(states))
+        return tuple(past_key_values), self.encoded_patches[lane].clone()
+
+    @torch.no_grad()
+    def reset_lane(self, lane, patches=None, prefix_cache=None, num_prefix_patches=None, cache=None):
+        """
+        Clear a lane and activate it, optionally prefilling it with patches in one pass.
+        :param lane: the index of the lane
+        :param patches: a list of id patches (as returned by Patchilizer.encode_generate) or a flat list of ids,
+                        the last patch may be incomplete
+        :param prefix_cache: a PrefixCache to fork the keys and values of the first patches from
+        :param num_prefix_patches: the number of patches looked up in prefix_cache, defaults to all complete patches
+        :param cache: the past_key_values and last feature of all the complete patches, as returned by lane_cache(),
+                      to take instead of encoding them
+        """
+        self.num_patches[lane] = 0
+        self.tokens[lane] = []
+        self.active[lane] = True
+        self.attention_mask[lane] = 0
+        if patches is None:
+            self._trim()
+            return
+        if len(patches) > 0 and isinstance(patches[0], (list, tuple)):
+            patches = [item for sublist in patches for item in sublist]
+
+        num_new_patches = len(patches) // self.patch_size
+        if num_new_patches > self.patch_length:
+            raise ValueError('The patches are longer than the patch length')
+        self.tokens[lane] = list(patches[num_new_patches * self.patch_size:])
+        if num_new_patches == 0:
+            self._trim()
+            return
+
+        new_patches = torch.tensor(patches[:num_new_patches * self.patch_size], dtype=torch.long)
+        self.patches[lane, :num_new_patches] = new_patches.reshape(-1, self.patch_size).to(self.patches.device)
+        self.num_patches[lane] = num_new_patches
+
+        # the lane is encoded alone, then its keys and values are right-aligned into the batch
+        if cache is not None:
+            past_key_values, encoded_patch = cache
+            if past_key_values[0][0].shape[2] != num_new_patches:
+                raise ValueError('The cache does not hold the complete patches')
+            past_key_values = tuple(tuple(state.to(self.patches.device) for state in layer) for layer in past_key_values)
+            encoded_patch = encoded_patch.to(self.patches.device)
+        elif prefix_cache is not None:
+            if num_prefix_patches is None or num_prefix_patches > num_new_patches:
+                num_prefix_patches = num_new_patches
+            past_key_values, encoded_patch = prefix_cache.get(patches[:num_prefix_patches * self.patch_size])
+            if num_prefix_patches < num_new_patches:
+                outputs = self.model.patch_level_decoder(self.patches[lane, num_prefix_patches:num_new_patches].unsqueeze(0),
+                                                         past_key_values=past_key_values)
+                past_key_values, encoded_patch = outputs["past_key_values"], outputs["last_hidden_state"][0][-1]
+        else:
+            outputs = self.model.patch_level_decoder(self.patches[lane, :num_new_patches].unsqueeze(0))
+            past_key_values, encoded_patch = outputs["past_key_values"], outputs["last_hidden_state"][0][-1]
+        self._splice_lane(lane, past_key_values)
+        self._set_encoded_patch(lane, encoded_patch)
+        self._trim()
+
+    def retire_lane(self, lane):
+        """
+        Deactivate a lane and drop its cached context.
+        """
+        self.num_patches[lane] = 0
+        self.tokens[lane] = []
+        self.active[lane] = False
+        self.attention_mask[lane] = 0
+        self._trim()
+
+    def fork_lane(self, lane, source):
+        """
+        Make a lane a copy of another, e.g. to sample several continuations of one context.
+        :param lane: the index of the lane to overwrite
+        :param source: the index of the lane to copy
+        """
+        self.num_patches[lane] = self.num_patches[source]
+        self.tokens[lane] = list(self.tokens[source])
+        self.active[lane] = True
+        self.patches[lane] = self.patches[source]
+        self.attention_mask[lane] = self.attention_mask[source]
+        if self.past_key_values is not None:
+            for layer in self.past_key_values:
+                for state in layer:
+                    state[lane] = state[source]
+        if self.encoded_patches is not None:
+            self.encoded_patches[lane] = self.encoded_patches[source]
+        self._trim()
+
+    def can_reset(self, num_patches, reserve=0):
+        """
+        Whether an idle lane can be reset with num_patches patches. The contiguous cache grows as needed, so it can.
+        :param reserve: the number of cache blocks to keep free after it (see PagedBatchGenerationSession)
+        """
+        return True
+
+    def can_extend(self, lanes, num_patches=1):
+        """
+        Whether each of the lanes can cache num_patches more patches. The contiguous cache grows as needed, so they can.
+        """
+        return True
+
+    @torch.no_grad()
+    def append(self, lane_tokens):
+        """
+        Append ids to lanes. The completed patches of all lanes are written into the buffer and encoded
+        incrementally in one batched pass.
+        :param lane_tokens: a dict from lane index to a flat list of ids
+        :return: a dict from lane index to the features of its new patches, [num_new_patches, hidden_size]
+        """
+        new_patches = {}
+        for lane, tokens in lane_tokens.items():
+            tokens = self.tokens[lane] + list(tokens)
+            num_new_patches = len(tokens) // self.patch_size
+            if self.num_patches[lane] + num_new_patches > self.patch_length:
+                raise ValueError('Lane %d is full, reset it with a shorter context' % lane)
+            if num_new_patches > 0:
+                start = self.num_patches[lane]
+                patches = torch.tensor(tokens[:num_new_patches * self.patch_size], dtype=torch.long)
+                self.patches[lane, start:start + num_new_patches] = patches.reshape(-1, self.patch_size).to(self.patches.device)
+                new_patches[lane] = num_new_patches
+            self.tokens[lane] = tokens[num_new_patches * self.patch_size:]
+        if len(new_patches) == 0:
+            return {}
+
+        # lanes without new patches (or with fewer) are padded with masked positions
+        num_steps = max(new_patches.values())
+        if self.attention_mask.shape[1] + num_steps > self.patch_length:
+            self._compact()
+        device = self.patches.device
+        input_patches = torch.full((self.batch_size, num_steps, self.patch_size), self.model.special_token_id,
+                                   dtype=torch.long, device=device)
+        position_ids = torch.zeros((self.batch_size, num_steps), dtype=torch.long, device=device)
+        step_mask = torch.zeros((self.batch_size, num_steps), dtype=torch.long, device=device)
+        for lane, num_new_patches in new_patches.items():
+            start = self.num_patches[lane]
+            input_patches[lane, :num_new_patches] = self.patches[lane, start:start + num_new_patches]
+            position_ids[lane, :num_new_patches] = torch.arange(start, start + num_new_patches, device=device)
+            step_mask[lane, :num_new_patches] = 1
+        attention_mask = torch.cat([self.attention_mask, step_mask], dim=1)
+
+        outputs = self._encode(input_patches, attention_mask, position_ids)
+        self.attention_mask = attention_mask
+        for lane, num_new_patches in new_patches.items():
+            self._set_encoded_patch(lane, outputs["last_hidden_state"][lane][num_new_patches - 1])
+            self.num_patches[lane] += num_new_patches
+
+        return {lane: outputs["last_hidden_state"][lane][:num_new_patches] for lane, num_new_patches in new_patches.items()}
+
+    def truncate_lane(self, lane, num_patches, encoded_patch):
+        """
+        Drop the last patches of a lane, e.g. rejected speculative patches.
+        :param lane: the index of the lane
+        :param num_patches: the number of patches to keep
+        :param encoded_patch: the feature of the last kept patch
+        """
+        used = self.attention_mask[lane].nonzero().squeeze(-1)
+        self.attention_mask[lane, used[num_patches:]] = 0
+        self.num_patches[lane] = num_patches
+        self.tokens[lane] = []
+        self._set_encoded_patch(lane, encoded_patch)
+
+        # drop the trailing positions that are masked in all lanes
+        used = self.attention_mask.any(dim=0).nonzero()
+        end = used[-1].item() + 1 if len(used) > 0 else 0
+        if self.past_key_values is not None and end < self.attention_mask.shape[1]:
+            self.past_key_values = tuple(tuple(state[:, :, :end] for state in layer) for layer in self.past_key_values)
+            self.attention_mask = self.attention_mask[:, :end]
+
+    @torch.no_grad()
+    def generate(self, lanes=None, prefixes=None, top_k=0, top_p=1, temperature=1.0, min_p=0.0, repetition_penalty=1.0,
+                 cancelled=None):
+        """
+        Generate the next patch of lanes in one batched pass, without changing the session.
+        :param lanes: the indices of the lanes, defaults to all active lanes
+        :param prefixes: a dict from lane index to known chars to put after its incomplete last patch before sampling
+        :param top_k: the top k for sampling, a number or one value per lane
+        :param top_p: the top p for sampling, a number or one value per lane
+        :param temperature: the temperature for sampling, a number or one value per lane
+        :param min_p: the min p for sampling, a number or one value per lane
+        :param repetition_penalty: the penalty for chars already in the patch, a number or one value per lane
+        :param cancelled: a callable checked between chars, returning the lanes to stop generating for (their chars
+                          are incomplete and meant to be discarded)
+        :return: the generated chars of each lane (not including its incomplete last patch and prefix)
+        """
+        if lanes is None:
+            lanes = [lane for lane in range(self.batch_size) if self.active[lane]]
+        if prefixes is None:
+            prefixes = {}
+        known_tokens = [self.tokens[lane] + list(prefixes.get(lane, [])) for lane in lanes]
+        encoded_patches = self.encoded_patches[torch.tensor(lanes, device=self.encoded_patches.device)]
+
+        cancelled_rows = None
+        if cancelled is not None:
+            def cancelled_rows():
+                cancelled_lanes = set(cancelled())
+                return [i for i, lane in enumerate(lanes) if lane in cancelled_lanes]
+
+        return self.model.generate_patches(encoded_patches, known_tokens,
+                                           top_k=top_k,
+                                           top_p=top_p,
+                                           temperature=temperature,
+                                           min_p=min_p,
+                                           repetition_penalty=repetition_penalty,
+                                           cancelled=cancelled_rows)
+
+    def cache_bytes(self):
+        """
+        The memory taken by the cached keys and values (with their scales if quantized).
+        """
+        if self.past_key_values is None:
+            return 0
+        return sum(state.numel() * state.element_size() for layer in self.past_key_values for state in layer)
+
+    def _encode(self, input_patches, attention_mask, position_ids):
+        """
+        Encode patches after the cached ones, and append their keys and values to the cache.
+        A quantized cache is dequantized one layer at a time as the model reaches it, and the new keys and values of
+        each layer are quantized as soon as the layer is done, so the float keys and values of only one layer exist
+        at a time.
+        :return: the outputs of the patch-level decoder
+        """
+        decoder = self.model.patch_level_decoder
+        if not self.quantize_cache:
+            outputs = decoder(input_patches, masks=attention_mask, past_key_values=self.past_key_values,
+                              position_ids=position_ids)
+            self.past_key_values = outputs["past_key_values"]
+            return outputs
+
+        num_steps = input_patches.shape[1]
+        new_layers = []
+
+        def store_present(block, args, outputs):
+            key, value = (state[:, :, -num_steps:] for state in outputs[1])
+            new_layers.append(quantize_kv(key) + quantize_kv(value))
+            return outputs[:1] + (None,) + outputs[2:]
+
+        handles = [block.register_forward_hook(store_present) for block in decoder.base.h]
+        try:
+            past_key_values = DequantizedCache(self.past_key_values) if self.past_key_values is not None else None
+            outputs = decoder(input_patches, masks=attention_mask, past_key_values=past_key_values,
+                              position_ids=position_ids)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        if self.past_key_values is None:
+            self.past_key_values = tuple(new_layers)
+        else:
+            self.past_key_values = tuple(tuple(torch.cat([state, new_state], dim=2) for state, new_state in zip(layer, new_layer))
+                                         for layer, new_layer in zip(self.past_key_values, new_layers))
+        return outputs
+
+    def _set_encoded_patch(self, lane, encoded_patch):
+        if self.encoded_patches is None:
+            self.encoded_patches = encoded_patch.new_zeros((self.batch_size, encoded_patch.shape[-1]))
+        self.encoded_patches[lane] = encoded_patch.to(self.encoded_patches.dtype)
+
+    def _splice_lane(self, lane, past_key_values):
+        """
+        Write the keys and values of a lane encoded alone into the last positions of the batch cache.
+        """
+        length = past_key_values[0][0].shape[2]
+        if self.quantize_cache:
+            past_key_values = tuple(quantize_kv(key) + quantize_kv(value) for key, value in past_key_values)
+        if self.past_key_values is None:
+            self.past_key_values = tuple(tuple(state.new_zeros((self.batch_size,) + state.shape[1:]) for state in layer)
+                                         for layer in past_key_values)
+            self.attention_mask = torch.zeros((self.batch_size, length), dtype=torch.long, device=self.patches.device)
+        elif length > self.attention_mask.shape[1]:
+            self._pad_left(length - self.attention_mask.shape[1])
+        for layer, lane_layer in zip(self.past_key_values, past_key_values):
+            for state, lane_state in zip(layer, lane_layer):
+                state[lane, :, -length:] = lane_state[0].to(state.dtype)
+        self.attention_mask[lane] = 0
+        self.attention_mask[lane, -length:] = 1
+
+    def _pad_left(self, length):
+        """
+        Prepend masked positions to the batch cache.
+        """
+        self.past_key_values = tuple(tuple(torch.cat([state.new_zeros(state.shape[:2] + (length,) + state.shape[3:]), state], dim=2)
+                                           for state in layer)
+                                     for layer in self.past_key_values)
+        self.attention_mask = torch.cat([self.attention_mask.new_zeros((self.batch_size, length)), self.attention_mask], dim=1)
+
+    def _trim(self):
+        """
+        Drop the leading positions that are masked in all lanes.
+        """
+        if self.past_key_values is None:
+            return
+        used = self.attention_mask.any(dim=0).nonzero()
+        start = used[0].item() if len(used) > 0 else self.attention_mask.shape[1]
+        if start > 0:
+            self.past_key_values = tuple(tuple(state[:, :, start:] for state in layer) for layer in self.past_key_values)
+            self.attention_mask = self.attention_mask[:, start:]
+
+    def _compact(self):
+        """
+        Right-align the cached positions of each lane, dropping the masked positions between them,
+        so that the cache never grows beyond the patch length.
+        """
+        num_used = self.attention_mask.sum(dim=1)
+        length = num_used.max().item()
+        index = torch.zeros((self.batch_size, length), dtype=torch.long, device=self.attention_mask.device)
+        for lane in range(self.batch_size):
+            used = self.attention_mask[lane].nonzero().squeeze(-1)
+            index[lane, length - len(used):] = used
+        self.attention_mask = (torch.arange(length, device=index.device) >= length - num_used.unsqueeze(1)).long()
+        self.past_key_values = tuple(tuple(state.gather(2, index[:, None, :, None].expand(-1, state.shape[1], -1, state.shape[3]))
+                                           for state in layer)
+                                     for layer in self.past_key_values)
+
+
+def quantize_kv(states):
+    """
+    Quantize cached keys or values to int8, symmetrically with one scale per head and position.
+    :param states: the keys or values, [batch, heads, length, head_dim]
+    :return: the int8 states, and their scales in the dtype of the states, [batch, heads, length, 1]
+    """
+    scales = (states.abs().amax(dim=-1, keepdim=True) / 127).clamp(min=torch.finfo(states.dtype).tiny)
+    # the scale may round below amax / 127 in half precision, so clamp rather than wrap the largest states around
+    return torch.round(states / scales).clamp(-127, 127).to(torch.int8), scales
+
+
+def dequantize_kv(states, scales):
+    return states.to(scales.dtype) * scales
+
+
+class DequantizedCache:
+    """
+    The float past_key_values of a quantized cache, as read by GPT2Model: each layer is dequantized when indexed,
+    and only the last one is kept (GPT2Model reads the length of the cache from the first layer before its loop).
+    """
+    def __init__(self, layers):
+        self.layers = layers    # (key, key scales, value, value scales) per layer
+        self.last = None
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __getitem__(self, index):
+        if self.last is None or self.last[0] != index:
+            key, key_scales, value, value_scales = self.layers[index]
+            self.last = index, (dequantize_kv(key, key_scales), dequantize_kv(value, value_scales))
+        return self.last[1]
+
+
+class KVBlockPool:
+    """
+    A fixed pool of blocks of keys and values of the patch-level decoder, shared by the lanes of
+    PagedBatchGenerationSessions. A block holds block_size consecutive patches of one lane in every layer. Blocks are
+    reference counted, so that forked lanes share the blocks of their common context until one of them writes to a
+    shared block, which it then copies (copy on write). Block 0 stays zero, for the padded positions of a batch.
+    :param num_blocks: the number of blocks, see num_blocks_for()
+    :param quantize: keep the keys and values in int8 with a scale per head and position (see quantize_kv())
+    """
+    def __init__(self, model, num_blocks, block_size=16, quantize=False):
+        config = model.patch_level_decoder.config
+        num_heads = config.n_head
+        head_dim = config.n_embd // num_heads
+        num_slots = num_blocks * block_size
+        dtype = model.dtype
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.quantize = quantize
+        if quantize:
+            shapes = [((num_slots, num_heads, head_dim), torch.int8), ((num_slots, num_heads, 1), dtype)] * 2
+        else:
+            shapes = [((num_slots, num_heads, head_dim), dtype)] * 2
+        # key, value (or key, key scales, value, value scales) of each layer, indexed by slot = block * block_size + offset
+        self.states = [[torch.empty(shape, dtype=state_dtype, device=model.device) for shape, state_dtype in shapes]
+                       for _ in range(config.n_layer)]
+        for layer in self.states:
+            for state in layer:
+                state[:block_size] = 0
+        self.ref_counts = [0] * num_blocks
+        self.free_blocks = list(range(num_blocks - 1, 0, -1))
+
+    @staticmethod
+    def block_bytes(model, block_size=16, quantize=False):
+        """
+        The memory of one block of the model.
+        """
+        config = model.patch_level_decoder.config
+        position_bytes = config.n_embd + config.n_head * model.dtype.itemsize if quantize else config.n_embd * model.dtype.itemsize
+        return config.n_layer * 2 * block_size * position_bytes
+
+    @classmethod
+    def num_blocks_for(cls, model, max_bytes, block_size=16, quantize=False):
+        """
+        The number of blocks fitting in max_bytes.
+        """
+        return int(max_bytes // cls.block_bytes(model, block_size, quantize))
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def allocate(self):
+        """
+        Take a free block.
+        :raise RuntimeError: when no block is free
+        """
+        if len(self.free_blocks) == 0:
+            raise RuntimeError('The key/value cache pool is full')
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def retain(self, block):
+        self.ref_counts[block] += 1
+
+    def release(self, block):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def copy(self, block):
+        """
+        Copy a block into a newly allocated one, and release it.
+        :return: the new block
+        """
+        new_block = self.allocate()
+        source = slice(block * self.block_size, (block + 1) * self.block_size)
+        target = slice(new_block * self.block_size, (new_block + 1) * self.block_size)
+        for layer in self.states:
+            for state in layer:
+                state[target] = state[source]
+        self.release(block)
+        return new_block
+
+    def write(self, layer, slots, key, value):
+        """
+        Store the keys and values of positions of a layer.
+        :param slots: the slots of the positions, [n]
+        :param key: the keys, [n, heads, head_dim]
+        :param value: the values, [n, heads, head_dim]
+        """
+        states = quantize_kv(key) + quantize_kv(value) if self.quantize else (key, value)
+        for state, new_state in zip(self.states[layer], states):
+            state[slots] = new_state.to(state.dtype)
+
+    def read(self, layer, index):
+        """
+        Gather the keys and values of a layer into a padded batch.
+        :param index: the slots of each lane and position, [batch, length]
+        :return: the keys and values, each [batch, heads, length, head_dim]
+        """
+        states = [state[index].transpose(1, 2) for state in self.states[layer]]
+        if self.quantize:
+            return dequantize_kv(states[0], states[1]), dequantize_kv(states[2], states[3])
+        return states[0], states[1]
+
+    def stats(self):
+        return {'blocks': self.num_blocks - 1, 'free_blocks': self.num_free_blocks, 'block_size': self.block_size}
+
+
+class PagedCache:
+    """
+    The past_key_values of a PagedBatchGenerationSession, as read by GPT2Model: each layer is gathered from the pool
+    when indexed, and only the last one is kept.
+    """
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.last = None
+
+    def __len__(self):
+        return len(self.pool.states)
+
+    def __getitem__(self, layer):
+        if layer >= len(self.pool.states):
+            raise IndexError(layer)
+        if self.last is None or self.last[0] != layer:
+            self.last = layer, self.pool.read(layer, self.index)
+        return self.last[1]
+
+
+class PagedBatchGenerationSession(BatchGenerationSession):
+    """
+    A BatchGenerationSession keeping the keys and values of each lane in blocks of a KVBlockPool, listed in the block
+    table of the lane, rather than in one batch tensor padded to the longest lane: a lane holds only the blocks of its
+    own patches, and the free blocks of the pool tell how many more pieces fit. For each pass of the model, the
+    cache is gathered one layer at a time into the padded batch the model reads, and the new keys and values of each
+    layer are written to the pool as soon as it is done. fork_lane() shares the blocks of a lane instead of copying
+    them.
+    """
+    def __init__(self, model, batch_size, pool, patch_length=PATCH_LENGTH, patch_size=PATCH_SIZE):
+        super().__init__(model, batch_size, patch_length=patch_length, patch_size=patch_size, quantize_cache=pool.quantize)
+        if pool.num_blocks - 1 < -(-patch_length // pool.block_size):
+            raise ValueError('The key/value cache pool cannot hold a lane of the patch length')
+        self.pool = pool
+        self.block_tables = [[] for _ in range(batch_size)]
+        self.cached_lengths = [0] * batch_size     # the cached patches of each lane
+
+    @property
+    def attention_mask(self):
+        """
+        The cached positions of each lane, right-aligned to the longest lane, [batch_size, length].
+        """
+        length = max(self.cached_lengths)
+        positions = torch.arange(length, device=self.patches.device)
+        lengths = torch.tensor(self.cached_lengths, device=self.patches.device)
+        return (positions >= length - lengths.unsqueeze(1)).long()
+
+    @attention_mask.setter
+    def attention_mask(self, value):
+        pass    # derived from the cached lengths
+
+    def reset_lane(self, lane, patches=None, prefix_cache=None, num_prefix_patches=None, cache=None):
+        self._free_lane(lane)
+        super().reset_lane(lane, patches, prefix_cache, num_prefix_patches, cache)
+
+    def lane_cache(self, lane):
+        num_cached = self.cached_lengths[lane]
+        positions = torch.arange(num_cached)
+        blocks = torch.tensor(self.block_tables[lane], dtype=torch.long)[positions // self.pool.block_size]
+        index = (blocks * self.pool.block_size + positions % self.pool.block_size).unsqueeze(0).to(self.patches.device)
+        past_key_values = tuple(self.pool.read(layer, index) for layer in range(len(self.pool.states)))
+        return past_key_values, self.encoded_patches[lane].clone()
+
+    def retire_lane(self, lane):
+        self._free_lane(lane)
+        super().retire_lane(lane)
+
+    def fork_lane(self, lane, source):
+        """
+        Make a lane a copy of another, sharing its blocks until either lane writes to them.
+        """
+        if lane == source:
+            return
+        self._free_lane(lane)
+        for block in self.block_tables[source]:
+            self.pool.retain(block)
+        self.block_tables[lane] = list(self.block_tables[source])
+        self.cached_lengths[lane] = self.cached_lengths[source]
+        self.num_patches[lane] = self.num_patches[source]
+        self.tokens[lane] = list(self.tokens[source])
+        self.active[lane] = True
+        self.patches[lane] = self.patches[source]
+        if self.encoded_patches is not None:
+            self.encoded_patches[lane] = self.encoded_patches[source]
+
+    def truncate_lane(self, lane, num_patches, encoded_patch):
+        self.num_patches[lane] = num_patches
+        self.tokens[lane] = []
+        self._set_encoded_patch(lane, encoded_patch)
+        self.cached_lengths[lane] = num_patches
+        num_blocks = -(-num_patches // self.pool.block_size)
+        for block in self.block_tables[lane][num_blocks:]:
+            self.pool.release(block)
+        del self.block_tables[lane][num_blocks:]
+
+    def can_reset(self, num_patches, reserve=0):
+        return -(-num_patches // self.pool.block_size) + reserve <= self.pool.num_free_blocks
+
+    def can_extend(self, lanes, num_patches=1):
+        num_blocks = sum(self._num_new_blocks(lane, self.cached_lengths[lane] + num_patches) for lane in lanes)
+        return num_blocks <= self.pool.num_free_blocks
+
+    def cache_bytes(self):
+        """
+        The memory of the blocks held by the lanes, counting shared blocks once.
+        """
+        blocks = {block for table in self.block_tables for block in table}
+        return len(blocks) * KVBlockPool.block_bytes(self.model, self.pool.block_size, self.pool.quantize)
+
+    def _num_new_blocks(self, lane, length):
+        """
+        The blocks to allocate for a lane to hold length patches, counting the copy of a shared last block.
+        """
+        table = self.block_tables[lane]
+        num_blocks = max(0, -(-length // self.pool.block_size) - len(table))
+        offset = self.cached_lengths[lane] % self.pool.block_size
+        if offset > 0 and length > self.cached_lengths[lane] and self.pool.ref_counts[table[-1]] > 1:
+            num_blocks += 1
+        return num_blocks
+
+    def _reserve(self, lane, length):
+        """
+        Make the blocks of a lane hold length patches, copying its last block if it is shared and to be written.
+        :return: the slots of positions cached_lengths[lane] to length
+        """
+        table = self.block_tables[lane]
+        start = self.cached_lengths[lane]
+        if start % self.pool.block_size > 0 and length > start and self.pool.ref_counts[table[-1]] > 1:
+            table[-1] = self.pool.copy(table[-1])
+        while len(table) * self.pool.block_size < length:
+            table.append(self.pool.allocate())
+        positions = torch.arange(start, length)
+        blocks = torch.tensor(table, dtype=torch.long)[positions // self.pool.block_size]
+        return (blocks * self.pool.block_size + positions % self.pool.block_size).to(self.patches.device)
+
+    def _free_lane(self, lane):
+        for block in self.block_tables[lane]:
+            self.pool.release(block)
+        self.block_tables[lane] = []
+        self.cached_lengths[lane] = 0
+
+    def _gather_index(self):
+        """
+        The slots of the cached positions of each lane, right-aligned as in attention_mask, padded with slot 0.
+        """
+        length = max(self.cached_lengths)
+        index = torch.zeros((self.batch_size, length), dtype=torch.long)
+        for lane, table in enumerate(self.block_tables):
+            num_cached = self.cached_lengths[lane]
+            if num_cached > 0:
+                positions = torch.arange(num_cached)
+                blocks = torch.tensor(table, dtype=torch.long)[positions // self.pool.block_size]
+                index[lane, length - num_cached:] = blocks * self.pool.block_size + positions % self.pool.block_size
+        return index.to(self.patches.device)
+
+    def _encode(self, input_patches, attention_mask, position_ids):
+        num_steps = input_patches.shape[1]
+        step_mask = attention_mask[:, -num_steps:].bool()
+        past_key_values = PagedCache(self.pool, self._gather_index()) if max(self.cached_lengths) > 0 else None
+
+        # the slots of the new patches are taken before the pass, so that it cannot fail halfway
+        slots = []
+        num_new_patches = step_mask.sum(dim=1).tolist()
+        for lane, num_new in enumerate(num_new_patches):
+            if num_new > 0:
+                slots.append(self._reserve(lane, self.cached_lengths[lane] + num_new))
+        slots = torch.cat(slots) if len(slots) > 0 else None
+
+        def store_present(layer, block, args, outputs):
+            if slots is not None:
+                key, value = (state[:, :, -num_steps:].transpose(1, 2)[step_mask] for state in outputs[1])
+                self.pool.write(layer, slots, key, value)
+            return outputs[:1] + (None,) + outputs[2:]
+
+        decoder = self.model.patch_level_decoder
+        handles = [block.register_forward_hook(functools.partial(store_present, layer))
+                   for layer, block in enumerate(decoder.base.h)]
+        try:
+            outputs = decoder(input_patches, masks=attention_mask, past_key_values=past_key_values,
+                              position_ids=position_ids)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        for lane, num_new in enumerate(num_new_patches):
+            self.cached_lengths[lane] += num_new
+        return outputs
+
+    def _splice_lane(self, lane, past_key_values):
+        """
+        Write the keys and values of a lane encoded alone into its blocks.
+        """
+        slots = self._reserve(lane, past_key_values[0][0].shape[2])
+        for layer, (key, value) in enumerate(past_key_values):
+            self.pool.write(layer, slots, key[0].transpose(0, 1), value[0].transpose(0, 1))
+        self.cached_lengths[lane] = len(slots)
+
+    def _compact(self):
+        pass    # the lanes are gathered without gaps
+
+
+class PrefixCache:
+    """
+    An LRU cache of the keys and values of the patch-level decoder for common prefixes, e.g. the bos patch and the
+    period, composer and instrumentation lines of each prompt. Sessions fork from a cached prefix by copying it into
+    their own cache, so the cached tensors are never modified.
+    """
+    def __init__(self, model, max_bytes=256 * 2 ** 20, patch_size=PATCH_SIZE):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.patch_size = patch_size
+        self.entries = OrderedDict()    # flat ids -> (past_key_values, encoded_patch, num_bytes)
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, patches):
+        return self._key(patches) in self.entries
+
+    def _key(self, patches):
+        if len(patches) > 0 and isinstance(patches[0], (list, tuple)):
+            patches = [item for sublist in patches for item in sublist]
+        return tuple(patches)
+
+    @torch.no_grad()
+    def get(self, patches):
+        """
+        The keys and values of a prefix, encoded on first use.
+        :param patches: a list of complete id patches or a flat list of ids
+        :return: the past_key_values of the prefix (batch size 1), and the feature of its last patch
+        """
+        key = self._key(patches)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            past_key_values, encoded_patch, _ = self.entries[key]
+            return past_key_values, encoded_patch
+
+        self.misses += 1
+        input_patches = torch.tensor(key, dtype=torch.long, device=self.model.device).reshape(1, -1, self.patch_size)
+        outputs = self.model.patch_level_decoder(input_patches)
+        past_key_values = tuple(tuple(state.clone() for state in layer) for layer in outputs["past_key_values"])
+        encoded_patch = outputs["last_hidden_state"][0][-1].clone()
+
+        num_bytes = sum(state.numel() * state.element_size() for layer in past_key_values for state in layer)
+        num_bytes += encoded_patch.numel() * encoded_patch.element_size()
+        if num_bytes <= self.max_bytes:
+            self.entries[key] = (past_key_values, encoded_patch, num_bytes)
+            self.num_bytes += num_bytes
+            while self.num_bytes > self.max_bytes:
+                _, (_, _, evicted_bytes) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_bytes
+                self.evictions += 1
+
+        return past_key_values, encoded_patch
+
+    def warm(self, prefixes):
+        """
+        Encode prefixes ahead of their first use, e.g. at startup.
+        :param prefixes: a list of prefixes as accepted by get()
+        """
+        for patches in prefixes:
+            if patches not in self:
+                self.get(patches)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.num_bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class GenerationSession:
+    """
+    A stateful generation session of NotaGenLMHeadModel for a single piece.
+    The patch history is kept in a preallocated buffer, and the keys and values of the patch-level decoder
+    are cached, so that each appended patch is encoded only once instead of re-running the whole history.
+    """
+    def __init__(self, model, patch_length=PATCH_LENGTH, patch_size=PATCH_SIZE, quantize_cache=False):
+        self.model = model
+        self.batch = BatchGenerationSession(model, 1, patch_length=patch_length, patch_size=patch_size,
+                                            quantize_cache=quantize_cache)
+        self.reset()
+
+    def reset(self, patches=None, prefix_cache=None, num_prefix_patches=None):
+        """
+        Clear the session, and optionally prefill it with patches in one pass.
+        :param patches: a list of id patches (as returned by Patchilizer.encode_generate) or a flat list of ids,
+                        the last patch may be incomplete
+        :param prefix_cache: a PrefixCache to fork the keys and values of the first patches from
+        :param num_prefix_patches: the number of patches looked up in prefix_cache, defaults to all complete patches
+        """
+        self.batch.reset_lane(0, patches, prefix_cache, num_prefix_patches)
+
+    def __len__(self):
+        """
+        The number of ids in the session, i.e. input_patches.shape[1] of the non-cached generation loop.
+        """
+        return self.batch.lane_length(0)
+
+    @property
+    def input_patches(self):
+        """
+        The flat patch history, [1, len(self)].
+        """
+        return self.batch.lane_patches(0)
+
+    @property
+    def encoded_patch(self):
+        """
+        The feature of the last encoded patch.
+        """
+        return self.batch.encoded_patches[0]
+
+    def append(self, tokens):
+        """
+        Append ids to the session. Every completed patch is written into the buffer and encoded incrementally.
+        :param tokens: a flat list of ids
+        :return: the features of the completed patches, [num_new_patches, hidden_size]
+        """
+        return self.batch.append({0: tokens}).get(0)
+
+    def truncate(self, num_patches, encoded_patch):
+        """
+        Drop the last patches of the session.
+        :param num_patches: the number of patches to keep
+        :param encoded_patch: the feature of the last kept patch
+        """
+        self.batch.truncate_lane(0, num_patches, encoded_patch)
+
+    @property
+    def num_patches(self):
+        return self.batch.num_patches[0]
+
+    def generate(self, prefix=None, top_k=0, top_p=1, temperature=1.0, min_p=0.0, repetition_penalty=1.0):
+        """
+        Generate the next patch, without changing the session.
+        :param prefix: known chars to put after the incomplete last patch before sampling
+        :param top_k: the top k for sampling
+        :param top_p: the top p for sampling
+        :param temperature: the temperature for sampling
+        :param min_p: the min p for sampling
+        :param repetition_penalty: the penalty for chars already in the patch
+        :return: the generated chars (not including the incomplete last patch and the prefix)
+        """
+        return self.batch.generate([0], {0: prefix} if prefix is not None else None,
+                                   top_k=top_k,
+                                   top_p=top_p,
+                                   temperature=temperature,
+                                   min_p=min_p,
+                                   repetition_penalty=repetition_penalty)[0]
+
+
+def mask_patch(patch, eos_token_id=2, special_token_id=0):
+    """
+    Replace the chars after the first eos of a patch with the special token, as the generation loop does.
+    """
+    patch = list(patch)
+    if eos_token_id in patch:
+        end = patch.index(eos_token_id) + 1
+        patch[end:] = [special_token_id] * (len(patch) - end)
+    return patch
+
+
+def speculative_verify(patches, target_probs, draft_probs=None, eos_token_id=2):
+    """
+    The rejection sampling rule of speculative decoding, applied char by char over speculative patches.
+    Each char is accepted with probability min(1, p / q); at the first rejection a char is drawn from
+    the residual distribution max(p - q, 0), so the accepted chars follow the target distribution exactly.
+    Chars after the eos of a patch are ignored by the generation loop, so they are always accepted.
+    :param patches: the speculative patches, [n, patch_size]
+    :param target_probs: the distributions of the target model for each char, [n, patch_size, vocab_size]
+    :param draft_probs: the distributions the chars were drafted from, or None for deterministic proposals
+    :return: the number of accepted chars (in flat order), and the char drawn at the first rejection (or None)
+    """
+    num_patches, patch_size, vocab_size = target_probs.shape
+    patches = patches.to(target_probs.device)
+    target_probs = target_probs / target_probs.sum(-1, keepdim=True)
+    p = target_probs.gather(-1, patches.unsqueeze(-1)).squeeze(-1)
+    if draft_probs is None:
+        draft_probs = torch.nn.functional.one_hot(patches, vocab_size).to(target_probs.dtype)
+        q = torch.ones_like(p)
+    else:
+        draft_probs = draft_probs / draft_probs.sum(-1, keepdim=True)
+        q = draft_probs.gather(-1, patches.unsqueeze(-1)).squeeze(-1)
+
+    uniform = torch.rand(p.shape, dtype=p.dtype, device=p.device)
+    accepted = uniform * q < p
+    ended = (patches == eos_token_id).long().cumsum(1) - (patches == eos_token_id).long() > 0
+    accepted = (accepted | ended).reshape(-1)
+
+    rejected = (~accepted).nonzero()
+    if len(rejected) == 0:
+        return num_patches * patch_size, None
+    index = rejected[0].item()
+
+    residual = (target_probs.reshape(-1, vocab_size)[index] - draft_probs.reshape(-1, vocab_size)[index]).clamp(min=0)
+    if residual.sum() <= 0:
+        residual = target_probs.reshape(-1, vocab_size)[index]
+
+    return index, sample_tokens(residual.unsqueeze(0)).item()
+
+
+class DraftModelProposer:
+    """
+    Propose speculative patches with a smaller NotaGen model (e.g. NotaGen-small) sharing the Patchilizer.
+    The draft model keeps its own cached session that follows the patch history of the target.
+    """
+    def __init__(self, model, patch_length=None, patch_size=PATCH_SIZE):
+        self.model = model
+        if patch_length is None:
+            patch_length = model.patch_level_decoder.config.max_position_embeddings
+        self.session = GenerationSession(model, patch_length=patch_length, patch_size=patch_size)
+        self.encoded_patches = {}   # number of patches -> feature of the last one, during the last proposal
+
+    def reset(self, patches=None):
+        self.session.reset(patches)
+        self.encoded_patches = {}
+
+    def append(self, tokens):
+        self.session.append(tokens)
+        self.encoded_patches = {}
+
+    def truncate(self, num_patches):
+        if num_patches >= self.session.num_patches:
+            return
+        if num_patches in self.encoded_patches:
+            self.session.truncate(num_patches, self.encoded_patches[num_patches])
+        else:
+            # back before the last proposal, re-encode the kept history
+            patch_size = self.session.batch.patch_size
+            self.session.reset(self.session.input_patches[0, :num_patches * patch_size].tolist())
+            self.encoded_patches = {}
+
+    @torch.no_grad()
+    def propose(self, num_patches, **sampling_params):
+        """
+        Draft the next patches autoregressively.
+        :param num_patches: the number of patches to draft
+        :return: the drafted patches, and the distributions their chars were sampled from, [n, patch_size, vocab_size]
+        """
+        num_patches = min(num_patches, self.session.batch.patch_length - self.session.num_patches)
+        self.encoded_patches = {self.session.num_patches: self.session.encoded_patch.clone()}
+        patches = []
+        probs = []
+        for _ in range(num_patches):
+            generated_patches, generated_probs = self.model.generate_patches(self.session.encoded_patch.unsqueeze(0),
+                                                                             [[]],
+                                                                             return_probs=True,
+                                                                             **sampling_params)
+            patch = mask_patch(generated_patches[0], self.model.eos_token_id, self.model.special_token_id)
+            patches.append(patch)
+            probs.append(generated_probs[0])
+            self.session.append(patch)
+            self.encoded_patches[self.session.num_patches] = self.session.encoded_patch.clone()
+
+        return patches, torch.stack(probs) if len(probs) > 0 else None
+
+
+class BarLookupProposer:
+    """
+    Propose speculative patches without a draft model, by prompt lookup over the patch history.
+    Scores repeat a lot (repeated bars, sequences, recapitulations), and bars are split into patches at barlines,
+    so the patches that followed an earlier occurrence of the latest patches are likely to follow again.
+    """
+    def __init__(self, max_ngram=3, min_ngram=1):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.patches = []   # the patch history, as tuples
+        self.tokens = []    # ids of the incomplete last patch
+
+    def reset(self, patches=None):
+        self.patches = []
+        self.tokens = []
+        if patches is not None:
+            self.append([item for sublist in patches for item in sublist]
+                        if len(patches) > 0 and isinstance(patches[0], (list, tuple)) else patches)
+
+    def append(self, tokens):
+        tokens = self.tokens + list(tokens)
+        num_new_patches = len(tokens) // PATCH_SIZE
+        for i in range(num_new_patches):
+            self.patches.append(tuple(tokens[i * PATCH_SIZE:(i + 1) * PATCH_SIZE]))
+        self.tokens = tokens[num_new_patches * PATCH_SIZE:]
+
+    def truncate(self, num_patches):
+        del self.patches[num_patches:]
+        self.tokens = []
+
+    def propose(self, num_patches, **sampling_params):
+        """
+        Find the latest earlier occurrence of the longest suffix of the history (of up to max_ngram patches),
+        and propose the patches that followed it.
+        :param num_patches: the maximum number of patches to propose
+        :return: the proposed patches, and None as the proposals are deterministic
+        """
+        length = len(self.patches)
+        for ngram in range(min(self.max_ngram, length - 1), self.min_ngram - 1, -1):
+            suffix = self.patches[length - ngram:]
+            for end in range(length - 1, ngram - 1, -1):
+                if self.patches[end - 1] == suffix[-1] and self.patches[end - ngram:end] == suffix:
+                    return [list(patch) for patch in self.patches[end:end + num_patches]], None
+        return [], None
+
+
+class SpeculativeGenerationSession:
+    """
+    A GenerationSession that generates several patches per pass of the target model.
+    A proposer drafts the next patches, the target model encodes them in one pass of the patch-level decoder and
+    scores their chars in one pass of the char-level decoder, and speculative_verify keeps the longest prefix that
+    the target would have sampled. The accepted patches are already encoded, so they are handed out by generate()
+    one by one and cost nothing when appended.
+    """
+    def __init__(self, model, proposer, num_draft_patches=4, patch_length=PATCH_LENGTH, patch_size=PATCH_SIZE,
+                 quantize_cache=False):
+        self.model = model
+        self.proposer = proposer
+        self.num_draft_patches = num_draft_patches
+        self.patch_size = patch_size
+        self.target = GenerationSession(model, patch_length=patch_length, patch_size=patch_size,
+                                        quantize_cache=quantize_cache)
+        self.ready = []         # (patch, encoded) of the verified patches, encoded if already in the target cache
+        self.num_committed = 0  # the patches appended by the caller
+        self.encoded_patches = {}   # number of patches -> feature of the last one, during the last speculation
+        self.stats = {'rounds': 0, 'drafted_patches': 0, 'accepted_patches': 0, 'drafted_chars': 0,
+                      'accepted_chars': 0, 'generated_patches': 0, 'draft_time': 0.0, 'verify_time': 0.0}
+
+    def reset(self, patches=None, prefix_cache=None, num_prefix_patches=None):
+        """
+        Clear the session, and optionally prefill it with patches in one pass.
+        """
+        self.target.reset(patches, prefix_cache, num_prefix_patches)
+        self.proposer.reset(patches)
+        self.ready = []
+        self.num_committed = self.target.num_patches
+        self.encoded_patches = {}
+
+    def __len__(self):
+        """
+        The number of ids appended to the session, not counting the verified patches not handed out yet.
+        """
+        return self.num_committed * self.patch_size + len(self.target.batch.tokens[0])
+
+    @property
+    def input_patches(self):
+        return self.target.input_patches[:, :len(self)]
+
+    @property
+    def num_patches(self):
+        return self.num_committed
+
+    @property
+    def encoded_patch(self):
+        """
+        The feature of the last committed patch.
+        """
+        if self.target.num_patches > self.num_committed:
+            return self.encoded_patches[self.num_committed]
+        return self.target.encoded_patch
+
+    @property
+    def acceptance_rate(self):
+        """
+        The share of drafted patches accepted as a whole.
+        """
+        return self.stats['accepted_patches'] / max(self.stats['drafted_patches'], 1)
+
+    @property
+    def patches_per_round(self):
+        """
+        The patches generated per pass of the target char-level decoder, the speedup if drafting were free.
+        """
+        return self.stats['generated_patches'] / max(self.stats['rounds'], 1)
+
+    def append(self, tokens):
+        """
+        Append ids to the session. A verified patch handed out by generate() is only committed.
+        """
+        if len(self.ready) > 0 and self.ready[0][1] and list(tokens) == self.ready[0][0]:
+            self.ready.pop(0)
+            self.num_committed += 1
+            return
+        self._rollback()
+        self.target.append(tokens)
+        self.proposer.append(tokens)
+        self.num_committed = self.target.num_patches
+
+    def truncate(self, num_patches, encoded_patch):
+        """
+        Drop the last committed patches, and the verified patches not handed out.
+        :param num_patches: the number of patches to keep
+        :param encoded_patch: the feature of the last kept patch
+        """
+        self.ready = []
+        self.target.truncate(num_patches, encoded_patch)
+        self.proposer.truncate(num_patches)
+        self.num_committed = num_patches
+
+    def generate(self, prefix=None, top_k=0, top_p=1, temperature=1.0, min_p=0.0, repetition_penalty=1.0):
+        """
+        Generate the next patch, as GenerationSession.generate.
+        """
+        sampling_params = dict(top_k=top_k, top_p=top_p, temperature=temperature, min_p=min_p,
+                               repetition_penalty=repetition_penalty)
+        if prefix is not None and len(self.ready) > 0 and self.ready[0][0][:len(prefix)] == list(prefix):
+            # a verified patch starting with the prefix is a sample given the prefix
+            return self.ready[0][0][len(prefix):]
+        if prefix is not None or len(self.target.batch.tokens[0]) > 0:
+            # the speculative patches were drawn without the prefix
+            self._rollback()
+            return self.target.generate(prefix=prefix, **sampling_params)
+
+        if len(self.ready) == 0:
+            self._speculate(sampling_params)
+        if len(self.ready) == 0:
+            return self.target.generate(**sampling_params)
+        return list(self.ready[0][0])
+
+    def _rollback(self):
+        """
+        Drop the verified patches not handed out, keeping the committed ones.
+        """
+        if self.target.num_patches > self.num_committed:
+            self.target.truncate(self.num_committed, self.encoded_patches[self.num_committed])
+            self.proposer.truncate(self.num_committed)
+        self.ready = []
+
+    @torch.no_grad()
+    def _speculate(self, sampling_params):
+        num_patches = min(self.num_draft_patches, self.target.batch.patch_length - self.target.num_patches)
+        if num_patches <= 0:
+            return
+
+        start_time = time.time()
+        patches, draft_probs = self.proposer.propose(num_patches, **sampling_params)
+        draft_time = time.time() - start_time
+        if len(patches) == 0:
+            return
+
+        # encode the speculative patches and score their chars in one pass of each decoder
+        base = self.target.num_patches
+        encoded_patch = self.target.encoded_patch.clone()
+        encoded_patches = self.target.append([item for patch in patches for item in patch])
+        encoded_patches = torch.cat((encoded_patch.unsqueeze(0), encoded_patches.to(encoded_patch.dtype)))
+        self.encoded_patches = {base + i: encoded_patch for i, encoded_patch in enumerate(encoded_patches)}
+        patch_tensor = torch.tensor(patches, dtype=torch.long, device=self.model.device)
+        target_probs = self.model.patch_probs(encoded_patches[:-1], patch_tensor, **sampling_params)
+        num_accepted, char = speculative_verify(patch_tensor, target_probs, draft_probs, self.model.eos_token_id)
+
+        num_accepted_patches = num_accepted // self.patch_size
+        self.ready = [(patch, True) for patch in patches[:num_accepted_patches]]
+        if char is not None:
+            self.target.truncate(base + num_accepted_patches, encoded_patches[num_accepted_patches])
+            self.proposer.truncate(base + num_accepted_patches)
+
+            # the rest of the rejected patch is generated by the target
+            known_tokens = patches[num_accepted_patches][:num_accepted % self.patch_size] + [char]
+            if char == self.model.eos_token_id or len(known_tokens) == self.patch_size:
+                rest = [self.model.special_token_id] * (self.patch_size - len(known_tokens))
             else:
-                tokens = torch.cat((tokens, torch.tensor([token], device=self.device)), dim=0)
-        
-        return generated_patch
+                rest = self.model.generate_patches(encoded_patches[num_accepted_patches].unsqueeze(0), [known_tokens],
+                                                   **sampling_params)[0]
+            self.ready.append((known_tokens + rest, False))
+
+        self.stats['rounds'] += 1
+        self.stats['drafted_patches'] += len(patches)
+        self.stats['accepted_patches'] += num_accepted_patches
+        self.stats['drafted_chars'] += len(patches) * self.patch_size
+        self.stats['accepted_chars'] += num_accepted
+        self.stats['generated_patches'] += len(self.ready)
+        self.stats['draft_time'] += draft_time
+        self.stats['verify_time'] += time.time() - start_time - draft_time
+
+
+def rng_state():
+    """
+    The state of the random generators that sample the patches, to save with a generation in progress.
+    """
+    state = {'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_generation(path, state):
+    """
+    Write the state of a generation in progress (plain values and tensors) with torch.save. It is written to a
+    temporary file that then replaces path, so that a save cut short by the end of the process keeps the last one.
+    """
+    temp_path = path + '.tmp'
+    torch.save(state, temp_path)
+    os.replace(temp_path, path)
+
+
+def load_generation(path):
+    """
+    Read a state written by save_generation(), with its tensors on the cpu.
+    """
+    return torch.load(path, map_location='cpu', weights_only=True)
+
+
+_register_parameter = torch.nn.Module.register_parameter
+_empty_parameters = threading.local()     # whether the thread is in empty_parameters()
+_empty_parameters_lock = threading.Lock()
+_num_empty_parameters = 0       # the threads in empty_parameters()
+
+
+def _register_empty_parameter(module, name, param):
+    if param is not None and getattr(_empty_parameters, 'active', False):
+        param = torch.nn.Parameter(param.to('meta'), requires_grad=param.requires_grad)
+    _register_parameter(module, name, param)
+
+
+@contextlib.contextmanager
+def empty_parameters():
+    """
+    Create the parameters of the modules built in the context on the meta device, so that no memory is filled and
+    their initialisation costs nothing; buffers are created as usual (the causal masks of GPT2 are not saved with the
+    weights). The parameters are then assigned by load_model().
+    Only the modules built by the calling thread are affected: Module.register_parameter is replaced while a thread
+    is in the context, and behaves as usual on the other threads, e.g. those of a server starting while the models
+    load.
+    """
+    global _num_empty_parameters
+    with _empty_parameters_lock:
+        if _num_empty_parameters == 0:
+            torch.nn.Module.register_parameter = _register_empty_parameter
+        _num_empty_parameters += 1
+    active = getattr(_empty_parameters, 'active', False)
+    _empty_parameters.active = True
+    try:
+        yield
+    finally:
+        _empty_parameters.active = active
+        with _empty_parameters_lock:
+            _num_empty_parameters -= 1
+            if _num_empty_parameters == 0:
+                torch.nn.Module.register_parameter = _register_parameter
+
+
+def converted_path(checkpoint_path, dtype):
+    return os.path.splitext(checkpoint_path)[0] + '_' + str(dtype).split('.')[-1] + '.safetensors'
+
+
+def convert_checkpoint(checkpoint_path, weights_path=None, dtype=torch.float16):
+    """
+    Convert a training checkpoint (a pickle with the model weights under 'model', and possibly the optimizer state)
+    into a weights-only safetensors file in dtype.
+    Tied weights are stored once, the other names are kept in the metadata as aliases.
+    :return: the path of the safetensors file, by default the checkpoint path with a _<dtype>.safetensors extension
+    """
+    if weights_path is None:
+        weights_path = converted_path(checkpoint_path, dtype)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu', mmap=True)
+    state_dict = checkpoint.get('model', checkpoint)
+
+    tensors = {}
+    aliases = {}
+    names = {}      # data_ptr -> name of the stored tensor
+    for name, tensor in state_dict.items():
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+        if key in names:
+            aliases[name] = names[key]
+            continue
+        names[key] = name
+        tensors[name] = (tensor.to(dtype) if tensor.is_floating_point() else tensor).contiguous()
+
+    temp_path = f'{weights_path}.{os.getpid()}.tmp'
+    save_file(tensors, temp_path, metadata={'aliases': json.dumps(aliases), 'source': os.path.basename(checkpoint_path)})
+    os.replace(temp_path, weights_path)    # never leave a partial file behind, nor mix those of two processes
+    return weights_path
+
+
+def weights_file(checkpoint_path, dtype=torch.float16):
+    """
+    The safetensors file of a checkpoint, converted by convert_checkpoint() at the first call and reused while it is
+    newer than the checkpoint. A safetensors path is returned as is, and so is the checkpoint if its directory is
+    not writable.
+    """
+    if checkpoint_path.endswith('.safetensors'):
+        return checkpoint_path
+    weights_path = converted_path(checkpoint_path, dtype)
+    if os.path.exists(weights_path) and os.path.getmtime(weights_path) >= os.path.getmtime(checkpoint_path):
+        return weights_path
+    try:
+        return convert_checkpoint(checkpoint_path, weights_path, dtype=dtype)
+    except OSError as e:
+        print(f'Cannot convert {checkpoint_path}: {e}, loading it directly')
+        return checkpoint_path
+
+
+def load_model(build, weights_path, device, dtype=torch.float16):
+    """
+    Build a model and load its weights without initialising or copying them twice: the parameters are created empty,
+    then assigned the tensors of the weights file. A safetensors file is memory-mapped, or read straight to a cuda
+    device; tensors already in dtype are used as they are. A .pth checkpoint is read with torch.load(mmap=True).
+    :param build: a callable building the model, e.g. lambda: NotaGenLMHeadModel(encoder_config, decoder_config)
+    :param weights_path: a safetensors file (see weights_file()) or a .pth checkpoint
+    :return: the model in eval mode
+    """
+    device = torch.device(device)
+    with empty_parameters():
+        model = build()
+
+    if weights_path.endswith('.safetensors'):
+        state_dict = load_file(weights_path, device='cpu' if device.type != 'cuda' else str(device))
+        with safe_open(weights_path, framework='pt') as f:
+            aliases = json.loads((f.metadata() or {}).get('aliases', '{}'))
+        for name, target in aliases.items():
+            state_dict[name] = state_dict[target]
+    else:
+        checkpoint = torch.load(weights_path, map_location='cpu', mmap=True)
+        state_dict = checkpoint.get('model', checkpoint)
+
+    state_dict = {name: tensor.to(device=device, dtype=dtype if tensor.is_floating_point() else tensor.dtype)
+                  for name, tensor in state_dict.items()}
+    model.load_state_dict(state_dict, assign=True)
+    for module in model.modules():
+        if isinstance(module, PreTrainedModel):
+            module.tie_weights()    # the assigned parameters replaced the tied ones
+    return model.to(device=device, dtype=dtype).eval()     # only the buffers are left to move
+
+
+def cpu_supports_bf16():
+    """
+    Whether the cpu computes bfloat16 matmuls natively (avx512_bf16 or amx), rather than emulating them more slowly
+    than float32.
+    """
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def autocast(device, dtype):
+    """
+    The autocast context of generation on a device with the models in dtype: float16 on cuda, bfloat16 on the cpu
+    with bfloat16 models, and none otherwise (float32 or int8 models on the cpu, mps).
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return torch.autocast(device_type='cuda', dtype=torch.float16)
+    if device.type == 'cpu' and dtype == torch.bfloat16:
+        return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def quantize_int8(model):
+    """
+    Quantize the linear layers of both decoders to int8 weights with dynamic activation scales, for the cpu.
+    The GPT2 Conv1D layers are first replaced with the equivalent nn.Linear, which torch quantizes. The patch
+    embedding stays in float, as it is read as an embedding table (see PatchLevelDecoder.embed()).
+    The activations are quantized with one scale per call, so the lanes of a batch slightly shift each other's logits.
+    :param model: a float32 model on the cpu
+    :return: the model, quantized in place
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(*child.weight.shape, device='meta')
+                linear.weight = torch.nn.Parameter(child.weight.t().contiguous(), requires_grad=False)
+                linear.bias = child.bias
+                setattr(module, name, linear)
+    qconfig_spec = {name: torch.ao.quantization.default_dynamic_qconfig for name, module in model.named_modules()
+                    if isinstance(module, torch.nn.Linear) and not name.endswith('patch_embedding')}
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
@@ -0,0 +1,101 @@
+import os
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+from .config import *
+from . import inference
+from .utils import weights_file
+
+
+def _init_worker(core_sets):
+    """
+    Pin the worker to its cores, load the models on the cpu, then size its thread pool to the cores.
+    The weights are memory-mapped from the safetensors file, so all workers read the same pages of the page cache.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # the parent decides when to stop
+    cores = core_sets.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_interop_threads(1)
+
+    inference.device = torch.device('cpu')
+    inference.load_models()
+    torch.set_num_threads(len(cores))   # after load_models(), which sets CPU_THREADS
+
+
+def _discard(text):
+    pass
+
+
+def _generate(prompt, params=None):
+    return inference.inference_patch(*prompt, write=_discard, params=params)
+
+
+class CPUWorkerPool:
+    """
+    Generate pieces in parallel worker processes on the cpu.
+    The checkpoint is converted once to a safetensors file (see weights_file()), which every worker memory-maps, so
+    the weights are in memory once however many workers there are. With CPU_PRECISION = 'int8', each worker keeps
+    its own copy of the quantized linear layers, a quarter of their float32 size. Each worker is pinned to its own
+    cores with an intra-op thread pool of their number, so that the workers do not compete for cores.
+    :param num_workers: the number of worker processes
+    :param threads_per_worker: the cores of each worker, defaults to the available cores split evenly
+    """
+    def __init__(self, num_workers, threads_per_worker=None):
+        # convert the checkpoints here, rather than in every worker at once
+        weights_dtype = inference.weights_dtype('cpu')
+        weights_file(os.path.join(inference.MODEL_CACHE_DIR, inference.INFERENCE_WEIGHTS_PATH), dtype=weights_dtype)
+        if inference.DRAFT_WEIGHTS_PATH:
+            weights_file(os.path.join(inference.MODEL_CACHE_DIR, inference.DRAFT_WEIGHTS_PATH), dtype=weights_dtype)
+
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        if threads_per_worker is None:
+            threads_per_worker = max(1, len(cores) // num_workers)
+        if num_workers * threads_per_worker > len(cores):
+            print(f'{num_workers} workers of {threads_per_worker} threads share {len(cores)} cores')
+
+        context = multiprocessing.get_context('spawn')     # a fresh torch in each worker
+        core_sets = context.Queue()
+        for i in range(num_workers):
+            start = i * threads_per_worker
+            core_sets.put({cores[(start + j) % len(cores)] for j in range(threads_per_worker)})
+
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                                            initializer=_init_worker, initargs=(core_sets,))
+
+    def submit(self, prompt, params=None):
+        """
+        Queue a piece to generate.
+        :param prompt: (period, composer, instrumentation)
+        :param params: sampling parameters overriding the config, e.g. {'temperature': 1.0}
+        :return: a concurrent.futures.Future of the post-processed piece
+        """
+        inference.sampling_params(params)  # raise the ValueError of unknown parameters here
+        return self.executor.submit(_generate, tuple(prompt), params)
+
+    def generate_pieces(self, prompts, params=None):
+        """
+        Generate a piece for each (period, composer, instrumentation) prompt, as generate_pieces() does.
+        :return: an iterator of (index of the prompt, abc_text), in the order the pieces finish
+        """
+        futures = {self.submit(prompt, params): index for index, prompt in enumerate(prompts)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def close(self, cancel=False):
+        """
+        Stop the workers once the pieces in progress are done.
+        :param cancel: drop the queued pieces that have not started
+        """
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close(cancel=True)
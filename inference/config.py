@@ -6,6 +6,11 @@ NUM_SAMPLES = 1000                                               # Number of sam
 TOP_K = 9                                                       # Top k for sampling
 TOP_P = 0.9                                                      # Top p for sampling
 TEMPERATURE = 1.2                                                 # Temperature for sampling
+BATCH_SIZE = 1                                                   # Number of pieces generated in lockstep
+STREAM_OVERLAP = 0.5                                             # Share of the tunebody lines kept when the stream window shifts
+CHECKPOINT_PATH = ''                                             # File to save the pieces in progress to on SIGTERM or SIGINT, and to resume them from ('' to disable)
+CHECKPOINT_INTERVAL = 300                                        # Seconds between saves of the pieces in progress
+CHECKPOINT_CACHE = False                                         # Also save the key/value cache, to resume without re-encoding (a larger file)
 ORIGINAL_OUTPUT_FOLDER = os.path.join('../output/original', os.path.splitext(os.path.split(INFERENCE_WEIGHTS_PATH)[-1])[0] + '_k_' + str(TOP_K) + '_p_' + str(TOP_P) + '_temp_' + str(TEMPERATURE))
 INTERLEAVED_OUTPUT_FOLDER = os.path.join('../output/interleaved', os.path.splitext(os.path.split(INFERENCE_WEIGHTS_PATH)[-1])[0] + '_k_' + str(TOP_K) + '_p_' + str(TOP_P) + '_temp_' + str(TEMPERATURE))
 
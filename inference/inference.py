@@ -2,6 +2,7 @@
 import os
 import time
 import torch
+import signal
 from utils import *
 from config import *
 from transformers import GPT2Config, LlamaConfig
@@ -37,15 +38,13 @@ byte_config = GPT2Config(num_hidden_layers=CHAR_NUM_LAYERS,
                          num_attention_heads=HIDDEN_SIZE // 64,
                          vocab_size=128)
 
-model = NotaGenLMHeadModel(encoder_config=patch_config, decoder_config=byte_config)
+# the checkpoint is converted to a float32 safetensors file at the first run, then memory-mapped
+model = load_model(lambda: NotaGenLMHeadModel(encoder_config=patch_config, decoder_config=byte_config),
+                   weights_file(os.path.join(MODEL_CACHE_DIR, INFERENCE_WEIGHTS_PATH), dtype=torch.float32),
+                   device, dtype=torch.float32)
 
 print("Parameter Number: " + str(sum(p.numel() for p in model.parameters() if p.requires_grad)))
 
-checkpoint = torch.load(os.path.join(MODEL_CACHE_DIR, INFERENCE_WEIGHTS_PATH), map_location=torch.device(device))
-model.load_state_dict(checkpoint['model'])
-model = model.to(device)
-model.eval()
-
 
 def rest_unreduce(abc_lines):
 
@@ -137,54 +136,173 @@ def rest_unreduce(abc_lines):
     return unreduced_lines
 
 
-def inference_patch(prompt_lines=[], pieces=NUM_SAMPLES):
+def save_piece(abc_text, generation_time_cost, file_no):
+    """
+    Write a finished piece to the interleaved and original output folders.
+    :return: whether the piece was saved
+    """
+    filename = time.strftime("%Y%m%d-%H%M%S") + \
+            "_" + format(generation_time_cost, '.2f') + '_' + str(file_no) + ".abc"
+
+    # unreduce
+    unreduced_output_path = os.path.join(INTERLEAVED_OUTPUT_FOLDER, filename)
+
+    abc_lines = abc_text.split('\n')
+    abc_lines = list(filter(None, abc_lines))
+    abc_lines = [line + '\n' for line in abc_lines]
+    try:
+        abc_lines = rest_unreduce(abc_lines)
+
+        with open(unreduced_output_path, 'w') as file:
+            file.writelines(abc_lines)
+    except:
+        return False
+    else:
+        # original
+        original_output_path = os.path.join(ORIGINAL_OUTPUT_FOLDER, filename)
+        with open(original_output_path, 'w') as w:
+            w.write(abc_text)
+        return True
+
+
+def lane_state(session, lanes, lane, cache=False):
+    """
+    The generation state of the piece in a lane as plain values and tensors, to save with save_generation().
+    :param cache: also save its keys and values, so that it resumes without re-encoding its patches
+    """
+    state = lanes[lane]
+    saved = {'elapsed': time.time() - state['start_time'],
+             'byte_list': ''.join(state['byte_list']),
+             'tunebody_flag': state['tunebody_flag'],
+             'rules': state['rules'].state_dict(),
+             'cut_index': state['cut_index'],
+             'patches': session.lane_patches(lane)[0].to('cpu', torch.uint8)}
+    if cache:
+        past_key_values, encoded_patch = session.lane_cache(lane)
+        saved['cache'] = (tuple(tuple(tensor.cpu() for tensor in layer) for layer in past_key_values), encoded_patch.cpu())
+    return saved
+
+
+def restore_lane(session, lane, saved):
+    """
+    Reset a lane with a piece saved by lane_state().
+    :return: the generation state of the piece
+    """
+    session.reset_lane(lane, saved['patches'].tolist(), cache=saved.get('cache'))
+    rules = TunebodyRules(patchilizer.bos_token_id, patchilizer.eos_token_id)
+    rules.load_state_dict(saved['rules'])
+    return {'start_time': time.time() - saved['elapsed'],
+            'byte_list': list(saved['byte_list']),
+            'tunebody_flag': saved['tunebody_flag'],
+            'rules': rules,
+            'cut_index': saved['cut_index']}
+
+
+def inference_patch(prompt_lines=[], pieces=NUM_SAMPLES, batch_size=BATCH_SIZE, checkpoint_path=CHECKPOINT_PATH):
+    """
+    Generate pieces and save them to the output folders.
+    With checkpoint_path, the pieces in progress are saved to it every CHECKPOINT_INTERVAL seconds, and on SIGTERM
+    or SIGINT after the current patch, before returning; the next call resumes them.
+    """
 
     file_no = 1
+    verbose = batch_size == 1   # chars of concurrent pieces would interleave on stdout
 
     bos_patch = [patchilizer.bos_token_id] * (PATCH_SIZE - 1) + [patchilizer.eos_token_id]
+    r0_patch = [ord(c) for c in '[r:0/']
+
+    prompt_patches = patchilizer.patchilize_metadata(prompt_lines)
+    prompt_patches = [[ord(c) for c in patch] + [patchilizer.special_token_id] * (PATCH_SIZE - len(patch)) for patch
+                      in prompt_patches]
+    prompt_patches.insert(0, bos_patch)
+
+    session = BatchGenerationSession(model, batch_size)
+    prefix_cache = PrefixCache(model)   # the prompt, and the metadata of each piece at its stream window
+    lanes = [None] * batch_size     # generation state of the piece in each lane
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        checkpoint = load_generation(checkpoint_path)
+        if len(checkpoint['lanes']) > batch_size:
+            raise ValueError('%s holds %d pieces, more than the batch size' % (checkpoint_path, len(checkpoint['lanes'])))
+        file_no = checkpoint['file_no']
+        for lane, saved in enumerate(checkpoint['lanes']):
+            lanes[lane] = restore_lane(session, lane, saved)
+            if verbose:
+                print(''.join(lanes[lane]['byte_list']), end='')
+        set_rng_state(checkpoint['rng'])
+        print('Resumed %d pieces from %s' % (len(checkpoint['lanes']), checkpoint_path))
+
+    signals = []    # received, to save the pieces in progress and stop
+    if checkpoint_path:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda sig, _: signals.append(sig))
+    save_time = time.time()
 
     while file_no <= pieces:
 
-        start_time = time.time()
-        start_time_format = time.strftime("%Y%m%d-%H%M%S")
-
-        prompt_patches = patchilizer.patchilize_metadata(prompt_lines)
-        byte_list = list(''.join(prompt_lines))
-        print(''.join(byte_list), end='')
-
-        prompt_patches = [[ord(c) for c in patch] + [patchilizer.special_token_id] * (PATCH_SIZE - len(patch)) for patch
-                          in prompt_patches]
-        prompt_patches.insert(0, bos_patch)
-
-        input_patches = torch.tensor(prompt_patches, device=device).reshape(1, -1)
-
-        failure_flag = False
-        end_flag = False
-        cut_index = None
-
-        tunebody_flag = False
-        while True:
-            predicted_patch = model.generate(input_patches.unsqueeze(0),
-                                             top_k=TOP_K,
-                                             top_p=TOP_P,
-                                             temperature=TEMPERATURE)
-            if not tunebody_flag and patchilizer.decode([predicted_patch]).startswith('[r:'):  # start with [r:0/
-                tunebody_flag = True
-                r0_patch = torch.tensor([ord(c) for c in '[r:0/']).unsqueeze(0).to(device)
-                temp_input_patches = torch.concat([input_patches, r0_patch], axis=-1)
-                predicted_patch = model.generate(temp_input_patches.unsqueeze(0),
+        # keep no more pieces in flight than are left to save
+        for lane in range(batch_size):
+            if lanes[lane] is None and sum(state is not None for state in lanes) <= pieces - file_no:
+                session.reset_lane(lane, prompt_patches, prefix_cache=prefix_cache)
+                lanes[lane] = {'start_time': time.time(),
+                               'byte_list': list(''.join(prompt_lines)),
+                               'tunebody_flag': False,
+                               'rules': TunebodyRules(patchilizer.bos_token_id, patchilizer.eos_token_id),
+                               'cut_index': None}
+                if verbose:
+                    print(''.join(prompt_lines), end='')
+
+        active_lanes = [lane for lane in range(batch_size) if lanes[lane] is not None]
+
+        # chars predicted by the tunebody rules are forced, lanes with a fully predicted patch skip the model
+        predicted_patches = {}
+        forced_prefixes = {}
+        for lane in active_lanes:
+            prefix = lanes[lane]['rules'].next_prefix() if lanes[lane]['tunebody_flag'] else None
+            if prefix is None:
+                continue
+            if len(prefix) == PATCH_SIZE:
+                predicted_patches[lane] = prefix
+            else:
+                forced_prefixes[lane] = prefix
+
+        generate_lanes = [lane for lane in active_lanes if lane not in predicted_patches]
+        if len(generate_lanes) > 0:
+            generated_patches = session.generate(generate_lanes, forced_prefixes,
                                                  top_k=TOP_K,
                                                  top_p=TOP_P,
                                                  temperature=TEMPERATURE)
-                predicted_patch = [ord(c) for c in '[r:0/'] + predicted_patch
+            for lane, predicted_patch in zip(generate_lanes, generated_patches):
+                predicted_patches[lane] = forced_prefixes.get(lane, []) + predicted_patch
+        predicted_patches = [predicted_patches[lane] for lane in active_lanes]
+
+        prefixes = {}
+        for lane, predicted_patch in zip(active_lanes, predicted_patches):
+            if not lanes[lane]['tunebody_flag'] and patchilizer.decode([predicted_patch]).startswith('[r:'):  # start with [r:0/
+                lanes[lane]['tunebody_flag'] = True
+                prefixes[lane] = r0_patch
+        if len(prefixes) > 0:
+            regenerated_patches = session.generate(list(prefixes), prefixes,
+                                                   top_k=TOP_K,
+                                                   top_p=TOP_P,
+                                                   temperature=TEMPERATURE)
+            for lane, predicted_patch in zip(prefixes, regenerated_patches):
+                predicted_patches[active_lanes.index(lane)] = r0_patch + predicted_patch
+
+        finished = {}   # lane -> failure_flag
+        lane_tokens = {}
+        for lane, predicted_patch in zip(active_lanes, predicted_patches):
+            state = lanes[lane]
             if predicted_patch[0] == patchilizer.bos_token_id and predicted_patch[1] == patchilizer.eos_token_id:
-                end_flag = True
-                break
+                finished[lane] = False
+                continue
             next_patch = patchilizer.decode([predicted_patch])
 
-            for char in next_patch:
-                byte_list.append(char)
-                print(char, end='')
+            state['byte_list'].extend(next_patch)
+            if state['tunebody_flag']:
+                state['rules'].feed(next_patch)
+            if verbose:
+                print(next_patch, end='')
 
             patch_end_flag = False
             for j in range(len(predicted_patch)):
@@ -192,80 +310,82 @@ def inference_patch(prompt_lines=[], pieces=NUM_SAMPLES):
                     predicted_patch[j] = patchilizer.special_token_id
                 if predicted_patch[j] == patchilizer.eos_token_id:
                     patch_end_flag = True
-
-            predicted_patch = torch.tensor([predicted_patch], device=device)  # (1, 16)
-            input_patches = torch.cat([input_patches, predicted_patch], dim=1)  # (1, 16 * patch_len)
-
-            if len(byte_list) > 102400:  
-                failure_flag = True
-                break
-            if time.time() - start_time > 20 * 60:  
-                failure_flag = True
-                break
-
-            if input_patches.shape[1] >= PATCH_LENGTH * PATCH_SIZE and not end_flag:
-                print('Stream generating...')
-                abc_code = ''.join(byte_list)
-                abc_lines = abc_code.split('\n')
-
-                tunebody_index = None
-                for i, line in enumerate(abc_lines):
-                    if line.startswith('[r:') or line.startswith('[V:'):
-                        tunebody_index = i
-                        break
-                if tunebody_index is None or tunebody_index == len(abc_lines) - 1:
+            lane_tokens[lane] = predicted_patch
+
+            if len(state['byte_list']) > 102400:
+                finished[lane] = True
+            elif time.time() - state['start_time'] > 20 * 60:
+                finished[lane] = True
+
+        session.append(lane_tokens)  # encodes only the new patches
+
+        for lane in active_lanes:
+            if lane in finished or session.lane_length(lane) < PATCH_LENGTH * PATCH_SIZE:
+                continue
+            state = lanes[lane]
+            print('Stream generating...')
+            abc_code = ''.join(state['byte_list'])
+            abc_lines = abc_code.split('\n')
+
+            tunebody_index = None
+            for i, line in enumerate(abc_lines):
+                if line.startswith('[r:') or line.startswith('[V:'):
+                    tunebody_index = i
                     break
+            if tunebody_index is None or tunebody_index == len(abc_lines) - 1:
+                finished[lane] = False
+                continue
 
-                metadata_lines = abc_lines[:tunebody_index]
-                tunebody_lines = abc_lines[tunebody_index:]
-
-                metadata_lines = [line + '\n' for line in metadata_lines]
-                if not abc_code.endswith('\n'):  
-                    tunebody_lines = [tunebody_lines[i] + '\n' for i in range(len(tunebody_lines) - 1)] + [
-                        tunebody_lines[-1]]
-                else:
-                    tunebody_lines = [tunebody_lines[i] + '\n' for i in range(len(tunebody_lines))]
-
-                if cut_index is None:
-                    cut_index = len(tunebody_lines) // 2
-
-                abc_code_slice = ''.join(metadata_lines + tunebody_lines[-cut_index:])
-                input_patches = patchilizer.encode_generate(abc_code_slice)
-
-                input_patches = [item for sublist in input_patches for item in sublist]
-                input_patches = torch.tensor([input_patches], device=device)
-                input_patches = input_patches.reshape(1, -1)
-
-        if not failure_flag:
-            generation_time_cost = time.time() - start_time
-
-            abc_text = ''.join(byte_list)
-            filename = time.strftime("%Y%m%d-%H%M%S") + \
-                    "_" + format(generation_time_cost, '.2f') + '_' + str(file_no) + ".abc"
-                    
-            # unreduce
-            unreduced_output_path = os.path.join(INTERLEAVED_OUTPUT_FOLDER, filename)
-            
-            abc_lines = abc_text.split('\n')
-            abc_lines = list(filter(None, abc_lines))
-            abc_lines = [line + '\n' for line in abc_lines]
-            try:
-                abc_lines = rest_unreduce(abc_lines)
+            metadata_lines = abc_lines[:tunebody_index]
+            tunebody_lines = abc_lines[tunebody_index:]
 
-                with open(unreduced_output_path, 'w') as file:
-                    file.writelines(abc_lines)
-            except:
-                pass
+            metadata_lines = [line + '\n' for line in metadata_lines]
+            if not abc_code.endswith('\n'):
+                tunebody_lines = [tunebody_lines[i] + '\n' for i in range(len(tunebody_lines) - 1)] + [
+                    tunebody_lines[-1]]
             else:
-                # original
-                original_output_path = os.path.join(ORIGINAL_OUTPUT_FOLDER, filename)
-                with open(original_output_path, 'w') as w:
-                    w.write(abc_text)
-
-                file_no += 1
-
-        else:
-            print('failed')
+                tunebody_lines = [tunebody_lines[i] + '\n' for i in range(len(tunebody_lines))]
+
+            if state['cut_index'] is None:
+                state['cut_index'] = max(1, int(len(tunebody_lines) * STREAM_OVERLAP))
+
+            abc_code_slice = ''.join(metadata_lines + tunebody_lines[-state['cut_index']:])
+            input_patches = patchilizer.encode_generate(abc_code_slice)
+
+            # the metadata is forked from the cache after the first shift, only the tunebody window is re-encoded
+            num_metadata_patches = 1 + len(patchilizer.patchilize_metadata([line for line in metadata_lines if line != '\n']))
+            num_cached_patches = num_metadata_patches if input_patches[:num_metadata_patches] in prefix_cache else 0
+            shift_start_time = time.time()
+            session.reset_lane(lane, input_patches, prefix_cache=prefix_cache, num_prefix_patches=num_metadata_patches)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            print('Re-encoded %d patches (%d cached) in %.0f ms' % (sum(len(patch) == PATCH_SIZE for patch in input_patches) - num_cached_patches,
+                                                                  num_cached_patches, (time.time() - shift_start_time) * 1000))
+
+        for lane, failure_flag in finished.items():
+            state = lanes[lane]
+            if not failure_flag:
+                generation_time_cost = time.time() - state['start_time']
+                if save_piece(''.join(state['byte_list']), generation_time_cost, file_no):
+                    file_no += 1
+            else:
+                print('failed')
+            session.retire_lane(lane)
+            lanes[lane] = None
+
+        # a signal is answered within one step, i.e. one patch of each piece
+        if checkpoint_path and (len(signals) > 0 or time.time() - save_time > CHECKPOINT_INTERVAL):
+            save_generation(checkpoint_path, {'file_no': file_no,
+                                              'lanes': [lane_state(session, lanes, lane, CHECKPOINT_CACHE)
+                                                        for lane in range(batch_size) if lanes[lane] is not None],
+                                              'rng': rng_state()})
+            save_time = time.time()
+            if len(signals) > 0:
+                print('Saved the pieces in progress to ' + checkpoint_path)
+                return
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
 
 
@@ -114,7 +114,7 @@ def collate_batch(input_batches):
     input_patches = torch.nn.utils.rnn.pad_sequence(input_patches, batch_first=True, padding_value=0)
     input_masks = torch.nn.utils.rnn.pad_sequence(input_masks, batch_first=True, padding_value=0)
 
-    return input_patches.to(device), input_masks.to(device)
+    return input_patches.to(device).long(), input_masks.to(device)
 
 def split_into_minibatches(input_patches, input_masks, minibatch_size):
     minibatches = []
@@ -126,8 +126,9 @@ def split_into_minibatches(input_patches, input_masks, minibatch_size):
     return minibatches
 
 class NotaGenDataset(Dataset):
-    def __init__(self, filenames):
+    def __init__(self, filenames, shards=None):
         self.filenames = filenames
+        self.shards = shards    # PackedShards of the pieces, None to read their abc files
 
     def __len__(self):
         return len(self.filenames)
@@ -138,6 +139,11 @@ class NotaGenDataset(Dataset):
 
         key = random.choice(['C#', 'F#', 'B', 'E', 'A', 'D', 'G', 'C', 'F', 'Bb', 'Eb', 'Ab', 'Db', 'Gb', 'Cb'])
 
+        if self.shards is not None:
+            file_bytes = torch.from_numpy(self.shards.patches(self.filenames[idx]['piece'], key))
+            file_masks = torch.ones(len(file_bytes), dtype=torch.long)
+            return file_bytes, file_masks
+
         folder = os.path.dirname(filepath)
         name = os.path.split(filepath)[-1]
         des_filepath = os.path.join(folder, key, name + '_' + key + '.abc')
@@ -229,13 +235,13 @@ if __name__ == "__main__":
                    name=WANDB_NAME)
     
     # load data
-    with open(DATA_TRAIN_INDEX_PATH, "r", encoding="utf-8") as f:
+    with open(os.path.join(DATA_TRAIN_PACKED_PATH, "index.jsonl") if DATA_TRAIN_PACKED_PATH else DATA_TRAIN_INDEX_PATH, "r", encoding="utf-8") as f:
         print("Loading Data...")
         train_files = []
         for line in f:
             train_files.append(json.loads(line))
     
-    with open(DATA_EVAL_INDEX_PATH, "r", encoding="utf-8") as f:
+    with open(os.path.join(DATA_EVAL_PACKED_PATH, "index.jsonl") if DATA_EVAL_PACKED_PATH else DATA_EVAL_INDEX_PATH, "r", encoding="utf-8") as f:
         print("Loading Data...")
         eval_files = []
         for line in f:
@@ -251,8 +257,8 @@ if __name__ == "__main__":
     train_files = train_files[:train_batch_nums*batch_size]
     eval_files = eval_files[:eval_batch_nums*batch_size]
 
-    train_set = NotaGenDataset(train_files)
-    eval_set = NotaGenDataset(eval_files)
+    train_set = NotaGenDataset(train_files, PackedShards(DATA_TRAIN_PACKED_PATH, patchilizer) if DATA_TRAIN_PACKED_PATH else None)
+    eval_set = NotaGenDataset(eval_files, PackedShards(DATA_EVAL_PACKED_PATH, patchilizer) if DATA_EVAL_PACKED_PATH else None)
 
     train_sampler = DistributedSampler(train_set, num_replicas=world_size, rank=local_rank)
     eval_sampler = DistributedSampler(eval_set, num_replicas=world_size, rank=local_rank)
@@ -1,8 +1,10 @@
+import os
 import torch
 import random
 import bisect
 import json
 import re
+import numpy as np
 from config import *
 from transformers import GPT2Model, GPT2LMHeadModel, LlamaModel, LlamaForCausalLM, PreTrainedModel
 from samplings import top_p_sampling, top_k_sampling, temperature_sampling
@@ -87,7 +89,11 @@ class Patchilizer:
        
         return tunebody_patches
 
-    def encode_train(self, abc_text, patch_length=PATCH_LENGTH, patch_size=PATCH_SIZE, add_special_patches=True, cut=True):
+    def patchilize_train(self, abc_text, patch_size=PATCH_SIZE, add_special_patches=True):
+        """
+        Split a piece into its metadata and tunebody patches for training, without the stream window.
+        :return: the metadata patches, the tunebody patches, and the tunebody lines (numbered with [r:n/n] if stream)
+        """
 
         lines = abc_text.split('\n')
         lines = list(filter(None, lines))
@@ -116,34 +122,50 @@ class Patchilizer:
             metadata_patches = [bos_patch] + metadata_patches
             tunebody_patches = tunebody_patches + [eos_patch]
 
+        return metadata_patches, tunebody_patches, tunebody_lines
+
+    def choose_cut(self, num_patches, available_cut_indexes, patch_length=PATCH_LENGTH):
+        """
+        Choose the stream window of a piece longer than patch_length: its head, its tail, or its metadata followed by
+        the tunebody from a random line in between.
+        :param num_patches: the number of patches of the piece
+        :param available_cut_indexes: 0, and the index after each tunebody patch that ends a line
+        :return: the index of the tunebody line the window starts at, 0 for the head
+        """
+        end_index = num_patches - patch_length
+        biggest_index = bisect.bisect_left(available_cut_indexes, end_index) 
+        available_cut_indexes = available_cut_indexes[:biggest_index + 1]
+
+        if len(available_cut_indexes) == 1:
+            choices = ['head']
+        elif len(available_cut_indexes) == 2:
+            choices = ['head', 'tail']
+        else:
+            choices = ['head', 'tail', 'middle']
+        choice = random.choice(choices)
+        if choice == 'head':
+            return 0
+        elif choice == 'tail':
+            return len(available_cut_indexes) - 1
+        else:
+            return random.choice(range(1, len(available_cut_indexes) - 1))
+
+    def encode_train(self, abc_text, patch_length=PATCH_LENGTH, patch_size=PATCH_SIZE, add_special_patches=True, cut=True):
+
+        metadata_patches, tunebody_patches, tunebody_lines = self.patchilize_train(abc_text, patch_size, add_special_patches)
+
         if self.stream:
             if len(metadata_patches) + len(tunebody_patches) > patch_length:
                 available_cut_indexes = [0] + [index + 1 for index, patch in enumerate(tunebody_patches) if '\n' in patch]
-                line_index_for_cut_index = list(range(len(available_cut_indexes)))  
-                end_index = len(metadata_patches) + len(tunebody_patches) - patch_length
-                biggest_index = bisect.bisect_left(available_cut_indexes, end_index) 
-                available_cut_indexes = available_cut_indexes[:biggest_index + 1]
-
-                if len(available_cut_indexes) == 1:
-                    choices = ['head']
-                elif len(available_cut_indexes) == 2:
-                    choices = ['head', 'tail']
-                else:
-                    choices = ['head', 'tail', 'middle']
-                choice = random.choice(choices)
-                if choice == 'head':
+                line_index = self.choose_cut(len(metadata_patches) + len(tunebody_patches), available_cut_indexes, patch_length)
+                if line_index == 0:
                     patches = metadata_patches + tunebody_patches[0:]
                 else:
-                    if choice == 'tail':
-                        cut_index = len(available_cut_indexes) - 1
-                    else:
-                        cut_index = random.choice(range(1, len(available_cut_indexes) - 1))
-
-                    line_index = line_index_for_cut_index[cut_index] 
                     stream_tunebody_lines = tunebody_lines[line_index : ]
                     
                     stream_tunebody_patches = self.patchilize_tunebody(stream_tunebody_lines, encode_mode='train')
                     if add_special_patches:
+                        eos_patch = chr(self.bos_token_id) + chr(self.eos_token_id) * (patch_size - 1)
                         stream_tunebody_patches = stream_tunebody_patches + [eos_patch]
                     patches = metadata_patches + stream_tunebody_patches
             else:
@@ -218,6 +240,65 @@ class Patchilizer:
         
 
 
+class PackedShards:
+    """
+    The patchilized pieces written by pack_data.py, read from memory-mapped shards.
+    Each piece is stored once per key as the ids of its metadata and tunebody patches (with bos and eos), with the
+    indexes after its tunebody patches that end a line. A window is then sliced from the shard instead of reading
+    and patchilizing the abc file, with the same choice of head, tail or middle as Patchilizer.encode_train.
+    Each shard holds the pieces of pieces_per_shard consecutive piece numbers, in shard_XXXXX.bin ([patches, patch
+    size] uint8), shard_XXXXX.index.npy (a row of patch offset, metadata patches, tunebody patches, cut offset and
+    cuts per piece and key) and shard_XXXXX.cuts.npy.
+    """
+    def __init__(self, path, patchilizer):
+        self.path = path
+        self.patchilizer = patchilizer
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.keys = meta['keys']
+        self.key_indexes = {key: i for i, key in enumerate(self.keys)}
+        self.patch_size = meta['patch_size']
+        self.num_pieces = meta['num_pieces']
+        self.pieces_per_shard = meta['pieces_per_shard']
+        if meta['stream'] != patchilizer.stream or self.patch_size != PATCH_SIZE:
+            raise ValueError(f'{path} was packed with PATCH_STREAM = {meta["stream"]} and PATCH_SIZE = {self.patch_size}, '
+                             f'repack it with pack_data.py')
+        self.shards = {}    # shard number -> (patches, index, cuts), mapped on first use in each worker
+
+    def shard(self, number):
+        if number not in self.shards:
+            name = os.path.join(self.path, 'shard_%05d' % number)
+            patches = np.memmap(name + '.bin', dtype=np.uint8, mode='c')
+            self.shards[number] = (patches.reshape(-1, self.patch_size),
+                                   np.load(name + '.index.npy', mmap_mode='r'),
+                                   np.load(name + '.cuts.npy', mmap_mode='r'))
+        return self.shards[number]
+
+    def patches(self, piece, key, patch_length=PATCH_LENGTH):
+        """
+        A training window of a piece transposed to a key, as encode_train gives for its abc file.
+        :param piece: the piece number given to it in the index written by pack_data.py
+        :return: the patch ids, of shape [patches, patch size] uint8, a view of the shard unless the window is cut
+        """
+        if not 0 <= piece < self.num_pieces:
+            raise IndexError(f'Piece {piece} is not in the {self.num_pieces} packed pieces of {self.path}')
+        patches, index, cuts = self.shard(piece // self.pieces_per_shard)
+        row = (piece % self.pieces_per_shard) * len(self.keys) + self.key_indexes[key]
+        offset, num_metadata_patches, num_tunebody_patches, cut_offset, num_cuts = (int(value) for value in index[row])
+        num_patches = num_metadata_patches + num_tunebody_patches
+        piece_patches = patches[offset : offset + num_patches]
+
+        if self.patchilizer.stream and num_patches > patch_length:
+            available_cut_indexes = [0] + cuts[cut_offset : cut_offset + num_cuts].tolist()
+            line_index = self.patchilizer.choose_cut(num_patches, available_cut_indexes, patch_length)
+            if line_index > 0:
+                tunebody_start = num_metadata_patches + available_cut_indexes[line_index]
+                piece_patches = np.concatenate([piece_patches[ : num_metadata_patches],
+                                                piece_patches[tunebody_start : tunebody_start + patch_length - num_metadata_patches]])
+
+        return piece_patches[ : patch_length]
+
+
 class PatchLevelDecoder(PreTrainedModel):
     """
     A Patch-level Decoder model for generating patch features in an auto-regressive manner. 
@@ -229,6 +310,41 @@ class PatchLevelDecoder(PreTrainedModel):
         torch.nn.init.normal_(self.patch_embedding.weight, std=0.02)
         self.base = GPT2Model(config)
 
+    def embedding_table(self) -> torch.Tensor:
+        """
+        The patch_embedding weight transposed to [PATCH_SIZE * 128, hidden], so that row position * 128 + char is the
+        column of that char at that position. It is rebuilt on every call with grad (training), and cached until the
+        weight changes otherwise (generation).
+        """
+        weight = self.patch_embedding.weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return weight.t().contiguous()
+        key = (weight.data_ptr(), weight._version, weight.dtype, weight.device)
+        if getattr(self, '_embedding_table_key', None) != key:
+            with torch.no_grad():
+                self._embedding_table = weight.t().contiguous()
+            self._embedding_table_key = key
+        return self._embedding_table
+
+    def embed(self, patches: torch.Tensor) -> torch.Tensor:
+        """
+        Embed the patches, equal to applying patch_embedding to their one-hot chars.
+        Instead of building the sparse [.., PATCH_SIZE * 128] one-hot tensor, the PATCH_SIZE rows of each patch
+        are gathered from the embedding table and summed with embedding_bag.
+        :param patches: the chars of the patches, of shape [batch, length * PATCH_SIZE] or [batch, length, PATCH_SIZE]
+        :return: the patch embeddings, of shape [batch, length, hidden]
+        :raise ValueError: when a char is not in [0, 128), which would read the rows of the next position
+        """
+        batch_size = len(patches)
+        # checked where the patches are, before the transfer, as the one-hot encoding failed on such chars
+        if patches.numel() > 0 and (patches.min() < 0 or patches.max() >= 128):
+            raise ValueError('Chars must be in [0, 128), got %d to %d' % (patches.min(), patches.max()))
+        patches = patches.to(self.device).reshape(-1, PATCH_SIZE)
+        offsets = torch.arange(PATCH_SIZE, device=patches.device) * 128
+        embeddings = torch.nn.functional.embedding_bag(patches + offsets, self.embedding_table(), mode='sum')
+        embeddings = embeddings + self.patch_embedding.bias
+        return embeddings.reshape(batch_size, -1, embeddings.shape[-1])
+
     def forward(self,
                 patches: torch.Tensor,
                 masks=None) -> torch.Tensor:
@@ -238,9 +354,7 @@ class PatchLevelDecoder(PreTrainedModel):
         :param masks: the masks for the patches
         :return: the encoded patches
         """
-        patches = torch.nn.functional.one_hot(patches, num_classes=128).to(self.dtype)
-        patches = patches.reshape(len(patches), -1, PATCH_SIZE * (128))
-        patches = self.patch_embedding(patches.to(self.device))
+        patches = self.embed(patches)
 
         if masks==None:
             return self.base(inputs_embeds=patches)
@@ -368,13 +482,15 @@ class NotaGenLMHeadModel(PreTrainedModel):
                  patches: torch.Tensor,
                  top_k=0,
                  top_p=1,
-                 temperature=1.0):
+                 temperature=1.0,
+                 stop_at_eos=True):
         """
         The generate function for generating patches based on patches.
         :param patches: the patches to be encoded
         :param top_k: the top k for sampling
         :param top_p: the top p for sampling
         :param temperature: the temperature for sampling
+        :param stop_at_eos: stop at the eos char and pad the rest of the patch with the special char
         :return: the generated patches
         """
         if patches.shape[-1] % PATCH_SIZE != 0:
@@ -398,6 +514,9 @@ class NotaGenLMHeadModel(PreTrainedModel):
 
             if len(tokens) >= PATCH_SIZE:
                 break
+            elif stop_at_eos and token == self.eos_token_id:
+                generated_patch += [self.special_token_id] * (PATCH_SIZE - len(tokens))
+                break
             else:
                 tokens = torch.cat((tokens, torch.tensor([token], device=self.device)), dim=0)
         
@@ -6,8 +6,10 @@ import asyncio
 from concurrent.futures import ProcessPoolExecutor
 
 from gradio_app.inference import postprocess_inst_names
-from gradio_app.inference import inference_patch
+from gradio_app.inference import LineProgress
+from gradio_app.service import GenerationService
 from gradio_app.convert import abc2xml, xml2, pdf2img
+from gradio_app.config import BATCH_SIZE
 
 
 
@@ -90,21 +92,27 @@ async def run_in_process(pool, func, *args):
 	return await loop.run_in_executor(pool, func, *args)
 
 
-async def async_main(period, composer, instrumentation, n):
-	tasks = []
-	with ProcessPoolExecutor() as pool:
-		for i in range(n):
-			print(f"\033[1;94mGenerating {i+1}/{n} piece...\033[0m")
-			abc_content = inference_patch(period, composer, instrumentation)
-			future = pool.submit(convert_files, abc_content, period, composer, instrumentation)
-			task = asyncio.wrap_future(future)
-			tasks.append(task)
+async def generate_and_convert(service, pool, prompt, on_event):
+	abc_content = await service.generate(prompt, on_event=on_event)
+	return await asyncio.wait_for(run_in_process(pool, convert_files, abc_content, *prompt), timeout=120)
 
-	try:
-		await asyncio.wait_for(asyncio.gather(*tasks), timeout=120)
-	except asyncio.TimeoutError:
-		print("Timeout reached. Exiting...")
-		exit()
+
+async def async_main(period, composer, instrumentation, n, batch_size):
+	# the pieces are generated together by the worker of the service, each is converted as soon as it is done
+	service = GenerationService(batch_size=batch_size, max_waiting=n)
+	progress = LineProgress()
+	prompt = (period, composer, instrumentation)
+	print(f"\033[1;94mGenerating {n} piece(s)...\033[0m")
+	with ProcessPoolExecutor() as pool:
+		tasks = [generate_and_convert(service, pool, prompt, progress) for _ in range(n)]
+		for i, task in enumerate(asyncio.as_completed(tasks)):
+			try:
+				await task
+			except asyncio.TimeoutError:
+				print("Timeout reached. Exiting...")
+				exit()
+			progress.close()
+			print(f"\033[1;94m{i+1}/{n} piece(s) done\033[0m")
 
 
 @app.command()
@@ -113,8 +121,9 @@ def main(
 	composer: str = typer.Argument(..., help="Composer of the music"),
 	instrumentation: str = typer.Argument(..., help="Instrumentation of the music"),
 	n: int = typer.Option(1, help="Number of pieces to generate"),
+	batch_size: int = typer.Option(BATCH_SIZE, help="Number of pieces generated at once"),
 ):
-	 asyncio.run(async_main(period, composer, instrumentation, n))
+	 asyncio.run(async_main(period, composer, instrumentation, n, batch_size))
 
 if __name__ == "__main__":
 	app()
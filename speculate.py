@@ -0,0 +1,86 @@
+
+import time
+import torch
+import typer
+import random
+import functools
+
+from gradio_app.config import *
+from gradio_app.utils import autocast, GenerationSession, SpeculativeGenerationSession, DraftModelProposer, BarLookupProposer
+from gradio_app import inference
+from gradio_app.inference import load_models, PieceGeneration
+
+
+
+app = typer.Typer()
+
+
+def time_patches(session, prompt, num_patches):
+	"""
+	Generate up to num_patches patches of a piece, return the number of patches and the seconds taken.
+	"""
+	piece = PieceGeneration(*prompt, verbose=False)
+
+	count = 0
+	start_time = time.time()
+	with torch.inference_mode(), autocast(inference.device, inference.model_dtype()):
+		session.reset(piece.prompt_patches())
+		while count < num_patches and not piece.stop_flag:
+			predicted_patch = piece.next_patch(functools.partial(session.generate, top_k=TOP_K, top_p=TOP_P, temperature=TEMPERATURE))
+			piece.advance(session, predicted_patch)
+			count += 1
+
+			if not piece.stop_flag and len(session) >= PATCH_LENGTH * PATCH_SIZE:
+				piece.shift_window(session.reset)
+
+	return count, time.time() - start_time
+
+
+@app.command()
+def main(
+	prompts: str = typer.Argument(..., help="A file path to the prompts list"),
+	n: int = typer.Option(4, help="Number of prompts to sample from the list"),
+	patches: int = typer.Option(128, help="Number of patches to generate per prompt"),
+	k: str = typer.Option('2,4,8', help="Comma separated numbers of draft patches to try"),
+	proposer: str = typer.Option('draft', help="'draft' to draft with the model of DRAFT_WEIGHTS_PATH, 'lookup' to propose repeated bars"),
+):
+	"""
+	Measure the acceptance rate and the effective speedup of speculative decoding per prompt and number of draft patches.
+	"""
+	model = load_models()
+	draft_model = inference.draft_model
+
+	if proposer == 'lookup':
+		make_proposer = BarLookupProposer
+	elif proposer == 'draft':
+		if draft_model is None:
+			raise typer.BadParameter('Set DRAFT_WEIGHTS_PATH in gradio_app/config.py to a draft model')
+		make_proposer = lambda: DraftModelProposer(draft_model)
+	else:
+		raise typer.BadParameter(f'Unknown proposer: {proposer}')
+
+	prompt_list = open(prompts, 'r').readlines()
+	prompt_list = [line.strip().split('_') for line in prompt_list]
+	prompt_list = [p for p in prompt_list if len(p) == 3]
+	k_list = [int(item) for item in k.split(',')]
+
+	plain_session = GenerationSession(model)
+
+	for prompt in random.sample(prompt_list, min(n, len(prompt_list))):
+		print(f"\033[1;94m{'_'.join(prompt)}\033[0m")
+		count, seconds = time_patches(plain_session, prompt, patches)
+		plain_ms = seconds * 1000 / count
+		print(f'plain\t{plain_ms:.1f} ms/patch')
+
+		for num_draft_patches in k_list:
+			session = SpeculativeGenerationSession(model, make_proposer(), num_draft_patches)
+			count, seconds = time_patches(session, prompt, patches)
+			ms = seconds * 1000 / count
+			print(f'k={num_draft_patches}\t{ms:.1f} ms/patch'
+				f'\tacceptance rate: {session.acceptance_rate:.2f}'
+				f'\tpatches per pass: {session.patches_per_round:.2f}'
+				f'\tspeedup: {plain_ms / ms:.2f}x')
+
+
+if __name__ == "__main__":
+	app()
@@ -0,0 +1,91 @@
+import os
+import sys
+
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# A tiny model, so that the tests run on the cpu in seconds. The modules read the config when they are imported.
+import gradio_app.config as config
+config.PATCH_NUM_LAYERS = 2
+config.CHAR_NUM_LAYERS = 1
+config.HIDDEN_SIZE = 64
+config.PATCH_LENGTH = 64
+
+from gradio_app import inference
+from gradio_app.utils import NotaGenLMHeadModel, PrefixCache
+
+METADATA_LINES = ['%%score { 1 | 2 }\n', 'L:1/8\n', 'M:2/4\n', 'K:C\n', 'V:1 treble\n', 'V:2 bass\n']
+BARS = {'c': 'cdef', 'g': 'gabc', 'e': 'e2d2', 'B': 'B4', 'x': 'x4'}    # by first char, lines of x4 have no barline
+NUM_LINES = 8       # the tunebody lines of a scripted piece
+
+
+def scripted_line(i, j, bar):
+    """
+    A tunebody line of one bar in both voices.
+    """
+    if bar == 'x4':
+        return '[r:%d/%d][V:1]x4[V:2]x4\n' % (i, j)
+    return '[r:%d/%d][V:1]%s|[V:2]%s|\n' % (i, j, bar, bar.upper())
+
+
+@pytest.fixture(scope='session')
+def model():
+    """
+    A randomly initialised NotaGenLMHeadModel of the tiny config, in float32 on the cpu.
+    """
+    torch.manual_seed(0)
+    model = NotaGenLMHeadModel(encoder_config=inference.patch_config, decoder_config=inference.byte_config)
+    return model.eval()
+
+
+@pytest.fixture
+def loaded_model(model, monkeypatch):
+    """
+    The tiny model as load_models() returns it, with an empty prefix cache.
+    """
+    monkeypatch.setattr(inference, 'device', torch.device('cpu'))
+    monkeypatch.setattr(inference, 'model', model)
+    monkeypatch.setattr(inference, 'prefix_cache', PrefixCache(model))
+    return model
+
+
+@pytest.fixture
+def scripted_lines(monkeypatch):
+    """
+    Shape the patches sampled from the random model into a piece: the METADATA_LINES, then NUM_LINES lines of one of
+    the BARS, chosen by the sampled chars at the start of each line. The pieces then go through the tunebody rules,
+    the line checks and their end as with the real model, and still depend on the sampling.
+    """
+    tunebody_prefix = inference.PieceGeneration.tunebody_prefix
+    accept = inference.PieceGeneration.accept
+    patchilizer = inference.patchilizer
+
+    def scripted_tunebody_prefix(self, predicted_patch):
+        if not self.tunebody_flag and ''.join(self.metadata_byte_list).count('\n') >= len(METADATA_LINES):
+            predicted_patch = [ord(c) for c in '[r:'] + predicted_patch[3:]
+        return tunebody_prefix(self, predicted_patch)
+
+    def scripted_accept(self, predicted_patch):
+        if predicted_patch[0] == patchilizer.bos_token_id and predicted_patch[1] == patchilizer.eos_token_id:
+            return accept(self, predicted_patch)
+        if self.tunebody_flag:
+            line = ''.join(self.byte_list).rsplit('\n', 1)[-1]
+            if line == '':
+                bar = list(BARS.values())[sum(predicted_patch) % len(BARS)]
+            else:
+                bar = BARS[line[line.index('[V:1]') + len('[V:1]')]]
+            text = scripted_line(self.num_lines, NUM_LINES - self.num_lines - 1, bar)[len(line):]
+        else:
+            metadata = ''.join(self.metadata_byte_list)
+            line = metadata.rsplit('\n', 1)[-1]
+            text = METADATA_LINES[min(metadata.count('\n'), len(METADATA_LINES) - 1)][len(line):]
+        text = text[:inference.PATCH_SIZE - 1]
+        predicted_patch = [ord(c) for c in text] + [patchilizer.eos_token_id] + \
+                          [patchilizer.special_token_id] * (inference.PATCH_SIZE - len(text) - 1)
+        return accept(self, predicted_patch)
+
+    monkeypatch.setattr(inference.PieceGeneration, 'tunebody_prefix', scripted_tunebody_prefix)
+    monkeypatch.setattr(inference.PieceGeneration, 'accept', scripted_accept)
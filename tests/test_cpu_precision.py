@@ -0,0 +1,63 @@
+import copy
+
+import pytest
+import torch
+
+from gradio_app import inference
+from gradio_app.utils import autocast, cpu_supports_bf16, quantize_int8
+
+NUM_PATCHES = 16
+
+# Bounds of the parity of the char logits with float32, a few times what the tiny model measures
+INT8_MAX_KL = 1e-4
+INT8_MAX_LOGIT_DIFF = 0.05
+BF16_MAX_KL = 1e-5
+BF16_MAX_LOGIT_DIFF = 0.02
+
+
+def random_patches(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(0, inference.byte_config.vocab_size, (NUM_PATCHES, inference.PATCH_SIZE), generator=generator)
+
+
+def char_logits(model, patches):
+    """
+    The teacher-forced logits of every char of the patches after the first, as benchmark_cpu.py scores them.
+    """
+    with torch.inference_mode(), autocast('cpu', model.dtype):
+        encoded_patches = model.patch_level_decoder(patches.unsqueeze(0))["last_hidden_state"][0]
+        tokens = torch.full((len(patches) - 1, 1), model.bos_token_id, dtype=torch.long)
+        tokens = torch.cat((tokens, patches[1:, :-1]), dim=1)
+        return model.char_level_decoder.score(encoded_patches[:-1], tokens).float()
+
+
+def kl_divergence(reference_logits, logits):
+    reference_log_probs = torch.log_softmax(reference_logits, dim=-1)
+    log_probs = torch.log_softmax(logits, dim=-1)
+    return (reference_log_probs.exp() * (reference_log_probs - log_probs)).sum(-1).mean().item()
+
+
+def test_cpu_defaults_to_float32():
+    assert inference.CPU_PRECISION == 'float32'
+    assert inference.model_dtype('cpu') == torch.float32
+    assert not inference.quantized('cpu')
+    assert inference.weights_dtype('cpu') == torch.float32
+
+
+def test_int8_logits_match_float32(model):
+    patches = random_patches()
+    reference_logits = char_logits(model, patches)
+    logits = char_logits(quantize_int8(copy.deepcopy(model)), patches)
+
+    assert kl_divergence(reference_logits, logits) < INT8_MAX_KL
+    assert (reference_logits - logits).abs().max().item() < INT8_MAX_LOGIT_DIFF
+
+
+@pytest.mark.skipif(not cpu_supports_bf16(), reason='the cpu lacks native bfloat16')
+def test_bfloat16_logits_match_float32(model):
+    patches = random_patches()
+    reference_logits = char_logits(model, patches)
+    logits = char_logits(copy.deepcopy(model).to(torch.bfloat16), patches)
+
+    assert kl_divergence(reference_logits, logits) < BF16_MAX_KL
+    assert (reference_logits - logits).abs().max().item() < BF16_MAX_LOGIT_DIFF
@@ -0,0 +1,108 @@
+import os
+import sys
+import importlib
+import importlib.util
+
+import pytest
+import torch
+from transformers import GPT2Config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# every copy of PatchLevelDecoder, the training ones import their config as a top-level module
+UTILS_COPIES = ['gradio_app', 'inference', 'pretrain', 'finetune']
+
+
+def load_utils(directory):
+    """
+    Import the utils.py of a folder of the repository.
+    """
+    if directory in ('gradio_app', 'inference'):
+        return importlib.import_module(directory + '.utils')
+    path = os.path.join(ROOT, directory)
+    saved_modules = {name: sys.modules.pop(name) for name in ('config', 'utils') if name in sys.modules}
+    sys.path.insert(0, path)
+    try:
+        spec = importlib.util.spec_from_file_location(directory + '_utils', os.path.join(path, 'utils.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(path)
+        sys.modules.pop('config', None)
+        sys.modules.update(saved_modules)
+    return module
+
+
+def one_hot_embed(decoder, patches, patch_size):
+    """
+    The patch embedding before embedding_bag: patch_embedding applied to the dense one-hot chars.
+    """
+    patches = torch.nn.functional.one_hot(patches, num_classes=128).to(decoder.dtype)
+    patches = patches.reshape(len(patches), -1, patch_size * 128)
+    return decoder.patch_embedding(patches)
+
+
+@pytest.fixture(params=UTILS_COPIES)
+def utils(request):
+    return load_utils(request.param)
+
+
+@pytest.fixture
+def decoder(utils):
+    torch.manual_seed(0)
+    config = GPT2Config(num_hidden_layers=1, max_length=8, max_position_embeddings=8, n_embd=64, num_attention_heads=1,
+                        vocab_size=1)
+    decoder = utils.PatchLevelDecoder(config)
+    with torch.no_grad():
+        decoder.patch_embedding.bias.normal_()
+    return decoder
+
+
+def random_patches(batch_size, num_patches, patch_size, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(0, 128, (batch_size, num_patches * patch_size), generator=generator)
+
+
+@pytest.mark.parametrize('grad', [True, False])
+def test_embed_matches_one_hot(utils, decoder, grad):
+    patches = random_patches(3, 5, utils.PATCH_SIZE)
+    with torch.set_grad_enabled(grad):
+        expected = one_hot_embed(decoder, patches, utils.PATCH_SIZE)
+        torch.testing.assert_close(decoder.embed(patches), expected, rtol=1e-5, atol=1e-6)
+        # patches split into [batch, length, patch size]
+        torch.testing.assert_close(decoder.embed(patches.reshape(3, 5, -1)), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_embed_gradients_match_one_hot(utils, decoder):
+    patches = random_patches(3, 5, utils.PATCH_SIZE)
+    parameters = (decoder.patch_embedding.weight, decoder.patch_embedding.bias)
+    expected = torch.autograd.grad(one_hot_embed(decoder, patches, utils.PATCH_SIZE).square().sum(), parameters)
+    grads = torch.autograd.grad(decoder.embed(patches).square().sum(), parameters)
+    for grad, expected_grad in zip(grads, expected):
+        torch.testing.assert_close(grad, expected_grad, rtol=1e-5, atol=1e-6)
+
+
+def test_embedding_table_follows_weight_updates(utils, decoder):
+    patches = random_patches(2, 4, utils.PATCH_SIZE)
+    weight = decoder.patch_embedding.weight
+    with torch.no_grad():
+        before = decoder.embed(patches)     # caches the embedding table
+
+        weight.mul_(2)      # in place, as an optimizer step or load_state_dict: the version changes
+        after = decoder.embed(patches)
+        torch.testing.assert_close(after, one_hot_embed(decoder, patches, utils.PATCH_SIZE), rtol=1e-5, atol=1e-6)
+        assert not torch.allclose(after, before)
+
+        weight.data = torch.randn_like(weight)  # new storage: the data pointer changes
+        torch.testing.assert_close(decoder.embed(patches), one_hot_embed(decoder, patches, utils.PATCH_SIZE),
+                                   rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('char', [128, 255, -1])
+def test_embed_rejects_chars_out_of_range(utils, decoder, char):
+    patches = random_patches(2, 4, utils.PATCH_SIZE)
+    patches[1, 5] = char    # e.g. a non-ascii byte, which would read the rows of the next position
+    with pytest.raises(ValueError):
+        decoder.embed(patches)
+    with pytest.raises(RuntimeError):
+        one_hot_embed(decoder, patches, utils.PATCH_SIZE)
@@ -0,0 +1,83 @@
+import random
+
+import pytest
+import torch
+
+from gradio_app import inference
+from gradio_app.inference import infill_patch, number_lines, split_piece
+
+PROMPT_LINES = ['%Classical\n', '%Beethoven, Ludwig van\n', '%Keyboard\n']
+METADATA_LINES = ['%%score { 1 | 2 }\n', 'L:1/8\n', 'M:2/4\n', 'K:C\n', 'V:1 treble\n', 'V:2 bass\n']
+BARS = ['[V:1]gabc|[V:2]GABC|\n', '[V:1]cdef|[V:2]CDEF|\n', '[V:1]B4|[V:2]B4|\n', '[V:1]e2d2|[V:2]E2D2|\n',
+        '[V:1]cdef|[V:2]CDEF|\n', '[V:1]gabc|[V:2]GABC|\n', '[V:1]B4|[V:2]B4|\n', '[V:1]cdef|[V:2]CDEF|\n']
+TUNEBODY_LINES = ['[r:%d/%d]' % (i, len(BARS) - i - 1) + bar for i, bar in enumerate(BARS)]
+RAW_PIECE = ''.join(PROMPT_LINES + METADATA_LINES + TUNEBODY_LINES)     # as generated
+POST_PROCESSED_PIECE = ''.join(['X:1\n'] + PROMPT_LINES + METADATA_LINES + BARS)     # as returned by result()
+
+
+def test_number_lines():
+    assert number_lines(BARS) == TUNEBODY_LINES
+    assert number_lines(TUNEBODY_LINES) == TUNEBODY_LINES
+    assert number_lines(['[r:5/0]' + bar for bar in BARS[:2]]) == ['[r:0/1]' + BARS[0], '[r:1/0]' + BARS[1]]
+    assert number_lines([]) == []
+
+
+@pytest.mark.parametrize('abc_text', [RAW_PIECE, POST_PROCESSED_PIECE], ids=['raw', 'post_processed'])
+def test_split_piece_round_trip(abc_text):
+    prompt_lines, metadata_lines, tunebody_lines = split_piece(abc_text)
+
+    assert prompt_lines == PROMPT_LINES
+    assert metadata_lines == METADATA_LINES
+    assert tunebody_lines == TUNEBODY_LINES
+    assert ''.join(prompt_lines + metadata_lines + tunebody_lines) == RAW_PIECE
+
+
+def test_split_piece_renumbers_lines():
+    abc_text = ''.join(PROMPT_LINES + METADATA_LINES + ['[r:9/9]' + bar for bar in BARS[:3]]) + '\n\n'
+    assert split_piece(abc_text)[2] == number_lines(BARS[:3])
+
+
+def test_split_piece_without_prompt_lines():
+    with pytest.raises(ValueError):
+        split_piece(''.join(['X:1\n'] + METADATA_LINES + BARS))
+
+
+@pytest.mark.parametrize('start_line, end_line', [(0, 1), (len(BARS) - 1, len(BARS)), (2, 5)],
+                         ids=['first', 'last', 'middle'])
+def test_infill_patch_keeps_other_lines(loaded_model, scripted_lines, start_line, end_line):
+    random.seed(0)
+    torch.manual_seed(0)
+    written = []
+    abc_text = infill_patch(POST_PROCESSED_PIECE, start_line, end_line, write=written.append)
+
+    assert len(written) > 0
+    prompt_lines, metadata_lines, tunebody_lines = split_piece(abc_text)
+    assert prompt_lines == PROMPT_LINES
+    assert metadata_lines == METADATA_LINES
+    assert len(tunebody_lines) == len(TUNEBODY_LINES)
+    assert tunebody_lines[:start_line] == TUNEBODY_LINES[:start_line]
+    assert tunebody_lines[end_line:] == TUNEBODY_LINES[end_line:]
+    assert tunebody_lines == number_lines(tunebody_lines)
+
+
+@pytest.mark.parametrize('start_line, end_line', [(3, 3), (4, 2), (0, len(BARS) + 1), (-1, 2),
+                                                  (len(BARS), len(BARS) + 1)],
+                         ids=['empty', 'reversed', 'past_the_end', 'negative', 'after_the_last'])
+def test_infill_patch_rejects_ranges(loaded_model, scripted_lines, start_line, end_line):
+    with pytest.raises(ValueError):
+        infill_patch(POST_PROCESSED_PIECE, start_line, end_line, write=lambda text: None)
+
+
+def test_infill_patch_caches_only_prompt_and_metadata(loaded_model, scripted_lines):
+    piece = inference.PieceGeneration('Classical', 'Beethoven, Ludwig van', 'Keyboard', verbose=False)
+    prefix_patches = piece.prompt_patches() + inference.patchilizer.patchilize_metadata(METADATA_LINES)
+    assert piece.prefill(METADATA_LINES, TUNEBODY_LINES[:4])[:len(prefix_patches)] == \
+        inference.encode_lines(''.join(PROMPT_LINES + METADATA_LINES), patch_length=None)[:len(prefix_patches)]
+
+    infill_patch(POST_PROCESSED_PIECE, 4, 6, write=lambda text: None)
+    assert len(inference.prefix_cache) > 0
+    assert max(len(key) for key in inference.prefix_cache.entries) <= len(prefix_patches) * inference.PATCH_SIZE
+
+    num_hits = inference.prefix_cache.hits
+    infill_patch(POST_PROCESSED_PIECE, 2, 3, write=lambda text: None)
+    assert inference.prefix_cache.hits > num_hits
@@ -0,0 +1,79 @@
+import functools
+import random
+
+import pytest
+import torch
+
+from gradio_app import inference
+from gradio_app.inference import PieceGeneration
+from gradio_app.utils import GenerationSession, dequantize_kv, quantize_kv
+
+NUM_PATCHES = 24
+
+# Bounds of the deviation of the char logits from those with the float cache, a few times what the tiny model measures
+INT8_MAX_KL = 1e-6
+INT8_MAX_LOGIT_DIFF = 2e-3
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float16, torch.bfloat16])
+def test_quantize_kv_round_trip(dtype):
+    generator = torch.Generator().manual_seed(0)
+    states = (torch.randn(2, 4, 8, 16, generator=generator) * torch.rand(2, 4, 8, 1, generator=generator) * 10).to(dtype)
+    states[0, 0, 0] = 0
+    quantized, scales = quantize_kv(states)
+
+    assert quantized.dtype == torch.int8 and scales.dtype == dtype
+    assert scales.shape == (2, 4, 8, 1)
+    assert quantized.abs().max() <= 127
+    # symmetric rounding to the nearest step: within half a scale of each state, plus the rounding of the float dtype
+    # at the largest state of the row (127 scales), in the division and in the product
+    error = (dequantize_kv(quantized, scales).float() - states.float()).abs()
+    assert (error <= scales.float() * (0.5 + 2 * 127 * torch.finfo(dtype).eps)).all()
+    assert (dequantize_kv(quantized, scales)[0, 0, 0] == 0).all()
+
+
+def generate_piece(model, num_patches, seed=0):
+    """
+    Generate num_patches patches of a piece with a float cache, as benchmark_kv_cache.py does.
+    :return: the prompt patches, and the generated patches
+    """
+    random.seed(seed)
+    torch.manual_seed(seed)
+    piece = PieceGeneration('Classical', 'Beethoven, Ludwig van', 'Keyboard', verbose=False)
+    session = GenerationSession(model)
+    prompt_patches = piece.prompt_patches()
+    session.reset(prompt_patches)
+    for _ in range(num_patches):
+        predicted_patch = piece.next_patch(functools.partial(session.generate, top_k=inference.TOP_K,
+                                                             top_p=inference.TOP_P, temperature=inference.TEMPERATURE))
+        piece.advance(session, predicted_patch)
+    history = session.input_patches[0, len(prompt_patches) * inference.PATCH_SIZE:session.num_patches * inference.PATCH_SIZE]
+    return prompt_patches, history.reshape(-1, inference.PATCH_SIZE).tolist()
+
+
+def replay(model, prompt_patches, patches, quantize_cache):
+    """
+    The char logits of each patch from the feature of the patches before it, appending them one by one to a session.
+    """
+    session = GenerationSession(model, quantize_cache=quantize_cache)
+    session.reset(prompt_patches)
+    logits = []
+    for patch in patches:
+        tokens = torch.tensor([[model.bos_token_id] + patch[:-1]])
+        logits.append(model.char_level_decoder.score(session.encoded_patch.unsqueeze(0), tokens)[0].float())
+        session.append(patch)
+    return torch.stack(logits)
+
+
+def test_int8_cache_logits_match_float_cache(model):
+    with torch.inference_mode():
+        prompt_patches, patches = generate_piece(model, NUM_PATCHES)
+        reference_logits = replay(model, prompt_patches, patches, quantize_cache=False)
+        logits = replay(model, prompt_patches, patches, quantize_cache=True)
+
+    assert len(patches) >= NUM_PATCHES // 2
+    reference_log_probs = torch.log_softmax(reference_logits, dim=-1)
+    log_probs = torch.log_softmax(logits, dim=-1)
+    kl = (reference_log_probs.exp() * (reference_log_probs - log_probs)).sum(-1).mean().item()
+    assert kl < INT8_MAX_KL
+    assert (reference_logits - logits).abs().max().item() < INT8_MAX_LOGIT_DIFF
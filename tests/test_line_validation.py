@@ -0,0 +1,101 @@
+import pytest
+import torch
+
+from gradio_app import inference
+from gradio_app.utils import GenerationSession
+
+METADATA_LINES = ['%%score { 1 | 2 }\n', 'L:1/8\n', 'M:2/4\n', 'K:C\n', 'V:1 treble\n', 'V:2 bass\n']
+TUNEBODY_LINES = ['[r:0/5][V:1]cdef|[V:2]CDEF|\n', '[r:1/4][V:1]gabc|[V:2]GABC|\n']
+VALID_LINE = '[r:2/3][V:1]e2d2|[V:2]E2D2|\n'
+INVALID_LINE = '[r:3/2][V:1]e2d2[V:2]E2D2\n'    # no barlines
+NEXT_LINE = '[r:3/2][V:1]B4|[V:2]B4|\n'
+
+
+def line_patches(text):
+    """
+    The patches of generated text, each of up to PATCH_SIZE - 1 chars and an eos.
+    """
+    patchilizer = inference.patchilizer
+    patches = []
+    for start in range(0, len(text), inference.PATCH_SIZE - 1):
+        chars = [ord(c) for c in text[start : start + inference.PATCH_SIZE - 1]]
+        patches.append(chars + [patchilizer.eos_token_id] + [patchilizer.special_token_id] * (inference.PATCH_SIZE - len(chars) - 1))
+    return patches
+
+
+def feed(piece, session, text):
+    for patch in line_patches(text):
+        piece.advance(session, patch)
+
+
+def piece_state(piece, session):
+    """
+    The state of a piece and its session to compare, without the elapsed time.
+    """
+    state = piece.state_dict()
+    del state['elapsed']
+    checkpoint = state.pop('checkpoint')
+    return {'piece': state,
+            'checkpoint': None if checkpoint is None else dict(checkpoint, encoded_patch=checkpoint['encoded_patch'].tolist()),
+            'num_patches': session.num_patches,
+            'patches': session.input_patches[0].tolist(),
+            'encoded_patch': session.encoded_patch.tolist()}
+
+
+@pytest.fixture
+def generation(model):
+    """
+    A piece prefilled with metadata and two tunebody lines, and a third line generated after them, so that it has
+    a checkpoint to roll back to. Returns the piece, its session and the text written by it.
+    """
+    written = []
+    piece = inference.PieceGeneration('Classical', 'Beethoven, Ludwig van', 'Keyboard', write=written.append)
+    session = GenerationSession(model)
+    with torch.inference_mode():
+        session.reset(piece.prefill(METADATA_LINES, TUNEBODY_LINES))
+        feed(piece, session, VALID_LINE)
+    assert piece.validator is not None and piece.checkpoint is not None
+    return piece, session, written
+
+
+def test_rejected_line_restores_the_piece(generation):
+    piece, session, written = generation
+    before = piece_state(piece, session)
+    text_before = ''.join(written)
+
+    with torch.inference_mode():
+        feed(piece, session, INVALID_LINE)
+
+    after = piece_state(piece, session)
+    assert after['piece'] == dict(before['piece'], line_retries=1, num_rollbacks=1)
+    after['piece'], before['piece'] = None, None
+    assert after == before
+    assert ''.join(written) == text_before      # the rejected patches were held back, never written
+
+    # the piece goes on from the last valid line
+    with torch.inference_mode():
+        feed(piece, session, NEXT_LINE)
+    assert ''.join(piece.byte_list).endswith(VALID_LINE + NEXT_LINE)
+    assert piece.num_lines == 4 and piece.line_retries == 0
+    assert session.num_patches == before['num_patches'] + len(line_patches(NEXT_LINE))
+    assert ''.join(written).endswith(VALID_LINE + NEXT_LINE)
+
+
+def test_line_kept_after_retries(generation):
+    piece, session, written = generation
+    before = piece_state(piece, session)
+
+    with torch.inference_mode():
+        for retry in range(inference.LINE_RETRIES):
+            feed(piece, session, INVALID_LINE)
+            after = piece_state(piece, session)
+            assert after['num_patches'] == before['num_patches']
+            assert after['piece']['byte_list'] == before['piece']['byte_list']
+            assert piece.line_retries == retry + 1
+
+        # out of retries: the line is kept, and the piece goes on after it
+        feed(piece, session, INVALID_LINE)
+    assert ''.join(piece.byte_list).endswith(VALID_LINE + INVALID_LINE)
+    assert piece.num_lines == 4 and piece.num_rollbacks == inference.LINE_RETRIES
+    assert session.num_patches == before['num_patches'] + len(line_patches(INVALID_LINE))
+    assert ''.join(written).endswith(INVALID_LINE)
@@ -0,0 +1,46 @@
+import os
+import threading
+
+import torch
+
+from gradio_app import inference
+from gradio_app.utils import NotaGenLMHeadModel, empty_parameters, load_model, weights_file
+
+
+def test_empty_parameters_only_affects_its_thread():
+    entered = threading.Event()
+    built = threading.Event()
+    devices = {}
+
+    def build_empty():
+        with empty_parameters():
+            entered.set()
+            devices['empty'] = torch.nn.Linear(4, 4).weight.device
+            built.wait(10)
+
+    thread = threading.Thread(target=build_empty)
+    thread.start()
+    entered.wait(10)
+    # built on another thread while the model is being built with empty parameters, as by a server starting
+    devices['other'] = torch.nn.Linear(4, 4).weight.device
+    built.set()
+    thread.join()
+
+    assert devices == {'empty': torch.device('meta'), 'other': torch.device('cpu')}
+    assert torch.nn.Linear(4, 4).weight.device == torch.device('cpu')
+
+
+def test_load_model_matches_the_checkpoint(model, tmp_path):
+    checkpoint_path = os.path.join(tmp_path, 'weights.pth')
+    torch.save({'model': model.state_dict()}, checkpoint_path)
+    weights_path = weights_file(checkpoint_path, dtype=torch.float32)
+    loaded = load_model(lambda: NotaGenLMHeadModel(encoder_config=inference.patch_config,
+                                                   decoder_config=inference.byte_config),
+                        weights_path, 'cpu', torch.float32)
+
+    assert weights_path.endswith('.safetensors')
+    assert all(tensor.device.type == 'cpu' for tensor in list(loaded.parameters()) + list(loaded.buffers()))
+    patches = torch.randint(0, 128, (1, 4 * inference.PATCH_SIZE), generator=torch.Generator().manual_seed(0))
+    with torch.inference_mode():
+        expected = model.patch_level_decoder(patches)["last_hidden_state"]
+        torch.testing.assert_close(loaded.patch_level_decoder(patches)["last_hidden_state"], expected)
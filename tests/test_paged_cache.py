@@ -0,0 +1,134 @@
+import random
+
+import torch
+
+from gradio_app import inference
+from gradio_app.utils import BatchGenerationSession, KVBlockPool, PagedBatchGenerationSession
+
+BATCH_SIZE = 3
+BLOCK_SIZE = 4
+NUM_BLOCKS = 12     # too few for every lane at MAX_PATCHES, so that the pool runs out
+PATCH_LENGTH = 24
+MAX_PATCHES = 20    # the patches at which the piece of a lane is finished
+NUM_STEPS = 80
+FORK_STEP = 6
+
+
+def random_patch(rng):
+    return [rng.randrange(3, 128) for _ in range(inference.PATCH_SIZE)]
+
+
+def prompt(rng, num_patches):
+    return [[inference.patchilizer.bos_token_id] * (inference.PATCH_SIZE - 1) + [inference.patchilizer.eos_token_id]] + \
+           [random_patch(rng) for _ in range(num_patches - 1)]
+
+
+def assert_pool_free(pool):
+    assert pool.num_free_blocks == pool.num_blocks - 1     # block 0 is never allocated
+    assert all(count == 0 for count in pool.ref_counts)
+
+
+def test_paged_session_matches_padded_session(model):
+    """
+    Drive a paged and a padded session with the same patches, as BatchGenerator does: pieces start, fork, finish and
+    restart, and when the pool runs out, the latest started piece is preempted (retired from the paged session, paused
+    in the padded one) and resumes by re-encoding its patches once the pool has room. The features of the running
+    lanes must match after every step.
+    """
+    pool = KVBlockPool(model, NUM_BLOCKS, BLOCK_SIZE)
+    paged = PagedBatchGenerationSession(model, BATCH_SIZE, pool, patch_length=PATCH_LENGTH)
+    padded = BatchGenerationSession(model, BATCH_SIZE, patch_length=PATCH_LENGTH)
+    rng = random.Random(0)
+    start_order = [0] * BATCH_SIZE
+    running = set()
+    preempted = {}     # lane -> its patches
+    events = {'forks': 0, 'retires': 0, 'preemptions': 0, 'resumes': 0}
+
+    def start(lane, patches):
+        paged.reset_lane(lane, patches)
+        padded.reset_lane(lane, patches)
+        start_order[lane] = max(start_order) + 1
+        running.add(lane)
+
+    with torch.inference_mode():
+        for lane, num_patches in enumerate([3, 1, 2]):
+            start(lane, prompt(rng, num_patches))
+
+        for step in range(NUM_STEPS):
+            if step == FORK_STEP:
+                paged.fork_lane(2, 0)
+                padded.fork_lane(2, 0)
+                start_order[2] = max(start_order) + 1
+                events['forks'] += 1
+            for lane in sorted(running):
+                if paged.num_patches[lane] >= MAX_PATCHES:
+                    paged.retire_lane(lane)
+                    padded.retire_lane(lane)
+                    running.remove(lane)
+                    events['retires'] += 1
+            for lane in sorted(preempted):
+                patches = preempted[lane]
+                if paged.can_reset(len(patches), reserve=len(running) + 1):
+                    paged.reset_lane(lane, patches)
+                    del preempted[lane]
+                    running.add(lane)
+                    events['resumes'] += 1
+            for lane in range(BATCH_SIZE):
+                if lane not in running and lane not in preempted and paged.can_reset(2, reserve=len(running) + 1):
+                    start(lane, prompt(rng, 2))
+            while not paged.can_extend(sorted(running)):
+                lane = max(running, key=lambda lane: start_order[lane])
+                preempted[lane] = paged.lane_patches(lane)[0].reshape(-1, inference.PATCH_SIZE).tolist()
+                paged.retire_lane(lane)
+                running.remove(lane)
+                events['preemptions'] += 1
+
+            lane_tokens = {lane: random_patch(rng) for lane in sorted(running)}
+            paged.append(lane_tokens)
+            padded.append(lane_tokens)
+            for lane in running:
+                assert paged.num_patches[lane] == padded.num_patches[lane]
+                torch.testing.assert_close(paged.encoded_patches[lane], padded.encoded_patches[lane], rtol=1e-4, atol=1e-5)
+
+        assert all(count > 0 for count in events.values()), events
+        for lane in range(BATCH_SIZE):
+            paged.retire_lane(lane)
+    assert_pool_free(pool)
+
+
+PROMPTS = [('Classical', 'Beethoven, Ludwig van', 'Keyboard'), ('Romantic', 'Chopin, Frederic', 'Keyboard'),
+           ('Baroque', 'Bach, Johann Sebastian', 'Keyboard'), ('Classical', 'Mozart, Wolfgang Amadeus', 'Keyboard')]
+MAX_STEPS = 2000
+
+
+def generate(kv_cache_mb, monkeypatch, batch_size=3):
+    """
+    Generate the PROMPTS greedily with a BatchGenerator, so that the pieces do not depend on the order of the random
+    draws of the lanes, which preemption changes.
+    :return: the finished pieces by key, and the generator
+    """
+    monkeypatch.setattr(inference, 'KV_CACHE_MB', kv_cache_mb)
+    monkeypatch.setattr(inference, 'KV_BLOCK_SIZE', 8)
+    generator = inference.BatchGenerator(batch_size=batch_size)
+    for key, prompt in enumerate(PROMPTS):
+        generator.submit(key, *prompt, params={'top_k': 1})
+    results = {}
+    for _ in range(MAX_STEPS):
+        if not generator.busy:
+            break
+        results.update(generator.step())
+    assert not generator.busy
+    return results, generator
+
+
+def test_paged_generator_matches_padded_generator(loaded_model, scripted_lines, monkeypatch):
+    block_bytes = KVBlockPool.block_bytes(loaded_model, block_size=8)
+    # a lane of PATCH_LENGTH patches and a few blocks more: too few for three pieces
+    kv_cache_mb = (-(-inference.PATCH_LENGTH // 8) + 3) * block_bytes / 2 ** 20
+    paged_results, paged_generator = generate(kv_cache_mb, monkeypatch)
+    padded_results, _ = generate(0, monkeypatch)
+
+    assert paged_generator.num_preemptions > 0
+    assert paged_results == padded_results
+    assert sorted(paged_results) == list(range(len(PROMPTS)))
+    assert_pool_free(paged_generator.session.pool)
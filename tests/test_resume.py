@@ -0,0 +1,57 @@
+import os
+
+import pytest
+import torch
+
+from gradio_app import inference
+from gradio_app.utils import load_generation, save_generation
+
+PROMPTS = [('Classical', 'Beethoven, Ludwig van', 'Keyboard'), ('Romantic', 'Chopin, Frederic', 'Keyboard'),
+           ('Baroque', 'Bach, Johann Sebastian', 'Keyboard')]
+BATCH_SIZE = 2      # fewer lanes than prompts, so that a prompt is still queued at the save
+SAVE_STEP = 12
+MAX_STEPS = 2000
+
+
+def submit_prompts(generator):
+    for key, prompt in enumerate(PROMPTS):
+        generator.submit(key, *prompt, params={'temperature': 1.0 + key / 10})
+
+
+def run(generator, num_steps=MAX_STEPS):
+    results = {}
+    for _ in range(num_steps):
+        if not generator.busy:
+            break
+        results.update(generator.step())
+    return results
+
+
+@pytest.mark.parametrize('cache', [False, True], ids=['re_encoded', 'cached'])
+def test_resumed_generation_matches_uninterrupted(loaded_model, scripted_lines, tmp_path, cache):
+    torch.manual_seed(0)
+    generator = inference.BatchGenerator(batch_size=BATCH_SIZE)
+    submit_prompts(generator)
+    uninterrupted = run(generator)
+    assert not generator.busy
+    assert sorted(uninterrupted) == list(range(len(PROMPTS)))
+
+    torch.manual_seed(0)
+    generator = inference.BatchGenerator(batch_size=BATCH_SIZE)
+    submit_prompts(generator)
+    results = run(generator, SAVE_STEP)
+    state = generator.state_dict(cache=cache)
+    assert [entry['key'] for entry in state['pieces']] == [0, 1]
+    assert [entry['key'] for entry in state['queue']] == [2]
+    assert all(('cache' in entry) == cache for entry in state['pieces'])
+    path = os.path.join(tmp_path, 'generation.pt')
+    save_generation(path, state)
+    del generator
+
+    torch.manual_seed(1)    # the state restores the random generators
+    generator = inference.BatchGenerator(batch_size=BATCH_SIZE)
+    generator.load_state_dict(load_generation(path))
+    results.update(run(generator))
+    assert not generator.busy
+
+    assert results == uninterrupted
@@ -0,0 +1,128 @@
+import importlib
+
+import numpy as np
+import pytest
+import torch
+from samplings import top_k_sampling, top_p_sampling, temperature_sampling
+
+# utils.py of inference/ is a copy of that of gradio_app/
+UTILS_MODULES = ['gradio_app.utils', 'inference.utils']
+
+TOP_KS = [0, 9, 3, 128]
+TOP_PS = [0.9, 1.0, 0.5, 0.99]
+TEMPERATURES = [1.2, 1.0, 0.7, 2.0]
+
+
+def random_probs(seed, batch_size=4, vocab_size=128):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.softmax(torch.randn(batch_size, vocab_size, generator=generator) * 3, dim=-1)
+
+
+def reference_probs(probs, top_k, top_p, temperature):
+    """
+    The distribution of a row as samplings modifies it for top_k_sampling, top_p_sampling and temperature_sampling.
+    """
+    probs = top_k_sampling(probs.numpy(), top_k=top_k, return_probs=True)
+    probs = top_p_sampling(probs, top_p=top_p, return_probs=True)
+    return temperature_sampling(probs, temperature=temperature, return_probs=True)
+
+
+@pytest.fixture(params=UTILS_MODULES)
+def utils(request):
+    return importlib.import_module(request.param)
+
+
+@pytest.mark.parametrize('top_k, top_p, temperature', list(zip(TOP_KS, TOP_PS, TEMPERATURES)))
+def test_sampling_probs_matches_samplings(utils, top_k, top_p, temperature):
+    for seed in range(50):
+        probs = random_probs(seed)
+        modified_probs = utils.sampling_probs(probs, top_k=top_k, top_p=top_p, temperature=temperature)
+        for row in range(len(probs)):
+            expected = reference_probs(probs[row], top_k, top_p, temperature)
+            np.testing.assert_allclose(modified_probs[row].numpy(), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_sampling_probs_per_row_parameters(utils):
+    for seed in range(50):
+        probs = random_probs(seed)
+        # a different combination of the parameters in every row
+        top_ks = TOP_KS[seed % 4:] + TOP_KS[:seed % 4]
+        modified_probs = utils.sampling_probs(probs, top_k=torch.tensor(top_ks), top_p=torch.tensor(TOP_PS),
+                                              temperature=torch.tensor(TEMPERATURES))
+        for row in range(len(probs)):
+            expected = reference_probs(probs[row], top_ks[row], TOP_PS[row], TEMPERATURES[row])
+            np.testing.assert_allclose(modified_probs[row].numpy(), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_sample_tokens_draws_like_numpy(utils):
+    for seed in range(200):
+        probs = random_probs(seed)
+        top_ks = TOP_KS[seed % 4:] + TOP_KS[:seed % 4]
+        modified_probs = utils.sampling_probs(probs, top_k=torch.tensor(top_ks), top_p=torch.tensor(TOP_PS),
+                                              temperature=torch.tensor(TEMPERATURES))
+        expected_tokens = []
+        uniform = []
+        for row in range(len(probs)):
+            row_probs = reference_probs(probs[row], top_ks[row], TOP_PS[row], TEMPERATURES[row])
+            np.random.seed(seed * len(probs) + row)
+            expected_tokens.append(np.random.choice(range(len(row_probs)), p=row_probs))
+            np.random.seed(seed * len(probs) + row)
+            uniform.append(np.random.random_sample())   # the number numpy.random.choice drew
+
+        tokens = utils.sample_tokens(modified_probs, uniform=torch.tensor(uniform))
+        assert tokens.tolist() == expected_tokens
+
+
+def test_sample_tokens_never_picks_removed_tokens(utils):
+    probs = utils.sampling_probs(random_probs(0), top_k=3)
+    tokens = utils.sample_tokens(probs, uniform=torch.tensor([0.0, 0.5, 1 - 1e-12, 0.999999]))
+    assert (probs.gather(-1, tokens.unsqueeze(-1)) > 0).all()
+
+
+def test_sampling_filters(utils):
+    assert utils.sampling_filters(top_k=0, top_p=1.0, temperature=1.0, min_p=0.0, repetition_penalty=1.0) == set()
+    assert utils.sampling_filters(top_k=9, top_p=0.9, temperature=1.2, min_p=0.1, repetition_penalty=1.1) == \
+           {'top_k', 'top_p', 'temperature', 'min_p', 'repetition_penalty'}
+    # enabled for one of the rows
+    assert utils.sampling_filters(top_k=[0, 3], top_p=torch.tensor([1.0, 1.0]), temperature=(1.0, 0.7)) == \
+           {'top_k', 'temperature'}
+
+
+def test_sampling_probs_never_reads_the_device(utils, monkeypatch):
+    """
+    With the filters decided on the host, sampling_probs() and sample_tokens() only queue work on the device: no
+    value of a tensor is read back, which would make the host wait for the device at every char.
+    """
+    probs = random_probs(0)
+    params = {'top_k': torch.tensor(TOP_KS), 'top_p': torch.tensor(TOP_PS), 'temperature': torch.tensor(TEMPERATURES),
+              'min_p': torch.tensor([0.0, 0.1, 0.0, 0.2])}
+    expected_probs = utils.sampling_probs(probs, **params)
+    filters = utils.sampling_filters(**params)
+
+    def read_back(*args):
+        raise AssertionError('A tensor was read back by the host')
+    for name in ('__bool__', 'item', 'tolist'):
+        monkeypatch.setattr(torch.Tensor, name, read_back)
+    modified_probs = utils.sampling_probs(probs, filters=filters, **params)
+    utils.sample_tokens(modified_probs)
+    monkeypatch.undo()
+
+    torch.testing.assert_close(modified_probs, expected_probs)
+
+
+def test_generate_patches_waits_for_the_device_every_few_chars(model, monkeypatch):
+    """
+    The rows finished at eos are masked on the device, the host reads them back only every check_every chars.
+    """
+    reads = []
+    for name in ('__bool__', '__int__', 'item'):
+        read = getattr(torch.Tensor, name)
+        monkeypatch.setattr(torch.Tensor, name, lambda tensor, *args, _read=read, _name=name:
+                            reads.append(_name) or _read(tensor, *args))
+    with torch.inference_mode():
+        patches = model.generate_patches(torch.randn(3, model.patch_level_decoder.config.n_embd), [[], [91], [91, 114]],
+                                         top_k=[0, 9, 3], top_p=0.9, temperature=[1.0, 1.2, 0.7], check_every=4)
+    monkeypatch.undo()
+
+    assert [len(patch) for patch in patches] == [16, 15, 14]
+    assert reads == ['__int__'] * len(reads) and len(reads) <= 16 // 4
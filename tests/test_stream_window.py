@@ -0,0 +1,17 @@
+import pytest
+
+from gradio_app.inference import PieceGeneration
+
+METADATA = '%%score { 1 | 2 }\nL:1/8\nM:2/4\nK:C\nV:1 treble\nV:2 bass\n'
+LINES = ['[r:%d/9][V:1]cdef|[V:2]CDEF|\n' % i for i in range(3)] + ['[r:3/9][V:1]cd']     # the last line unfinished
+
+
+@pytest.mark.parametrize('stream_overlap, num_kept', [(0.1, 1), (0.3, 1), (0.5, 2), (1.0, 4)])
+def test_stream_window_keeps_a_line_and_shrinks(stream_overlap, num_kept):
+    piece = PieceGeneration('Classical', 'Beethoven, Ludwig van', 'Keyboard', verbose=False,
+                            stream_overlap=stream_overlap)
+    piece.metadata_byte_list = list(METADATA)
+    piece.context_tunebody_byte_list = list(''.join(LINES))
+
+    assert piece.stream_patches() is not None
+    assert ''.join(piece.context_tunebody_byte_list) == ''.join(LINES[-num_kept:])
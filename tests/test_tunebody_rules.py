@@ -0,0 +1,31 @@
+from gradio_app.utils import TunebodyRules
+
+
+def chars(prefix):
+    return ''.join(chr(c) for c in prefix)
+
+
+def test_forces_the_line_counters_only():
+    rules = TunebodyRules()
+    rules.feed('[r:0/3][V:1]cdef|[V:2]CDEF|\n[r:1/2][V:1]gabc|[V:2]GABC|\n')
+    # every line so far starts with [V:1], which a resting first voice would still omit
+    assert chars(rules.next_prefix()) == '[r:2/1]'
+    rules.feed('[r:2/1][V:2]CDEF|\n[r:3/0')
+    assert rules.next_prefix() is None     # within a line
+    rules.feed('][V:1]c4|[V:2]C4|\n')
+    assert rules.next_prefix() == [rules.bos_token_id] + [rules.eos_token_id] * (rules.patch_size - 1)
+
+
+def test_stops_at_a_broken_line():
+    rules = TunebodyRules()
+    rules.feed('[r:0/3][V:1]cdef|[V:2]CDEF|\n[V:1]gabc|\n')
+    assert rules.next_prefix() is None
+
+
+def test_state_dict_round_trip():
+    rules = TunebodyRules()
+    rules.feed('[r:0/3][V:1]cdef|[V:2]CDEF|\n[r:1/2][V:1]ga')
+    restored = TunebodyRules()
+    restored.load_state_dict(rules.state_dict())
+    restored.feed('bc|[V:2]GABC|\n')
+    assert chars(restored.next_prefix()) == '[r:2/1]'
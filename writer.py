@@ -1,11 +1,14 @@
 
 import os
+import time
 import typer
 import random
 import hashlib
 import signal
 
-from gradio_app.inference import inference_patch
+from gradio_app.inference import inference_patch, generate_pieces, generate_variations, LineProgress, BatchGenerator
+from gradio_app.utils import save_generation, load_generation
+from gradio_app.workers import CPUWorkerPool
 
 
 
@@ -17,6 +20,14 @@ def main(
 	prompts: str = typer.Argument(..., help="A file path to the prompts list"),
 	n: int = typer.Option(1, help="Number of pieces to generate"),
 	target_dir: str = typer.Option('./opus/abc', help="Directory to save the generated pieces"),
+	batch_size: int = typer.Option(1, help="Number of pieces generated in lockstep"),
+	workers: int = typer.Option(0, help="Number of cpu worker processes sharing one copy of the weights (0 to generate in this process)"),
+	threads: int = typer.Option(None, help="Cores of each cpu worker, defaults to the cores split evenly"),
+	variations: int = typer.Option(1, help="Number of variations of each piece, branching after --branch-lines lines"),
+	branch_lines: int = typer.Option(16, help="Number of tunebody lines (bars) shared by the variations of a piece"),
+	checkpoint: str = typer.Option(None, help="File to save the pieces in progress to, every --checkpoint-interval seconds and on SIGTERM or SIGINT, and to resume them from at the next run"),
+	checkpoint_interval: float = typer.Option(300, help="Seconds between saves of the pieces in progress"),
+	checkpoint_cache: bool = typer.Option(False, help="Also save the key/value cache, so that the pieces resume without re-encoding (a larger file)"),
 ):
 	prompt_list = open(prompts, 'r').readlines()
 	prompt_list = [line.strip().split('_') for line in prompt_list]
@@ -30,17 +41,107 @@ def main(
 		global to_quit
 		to_quit = True
 	signal.signal(signal.SIGINT, handle_sigint)
+	if checkpoint is not None:
+		signal.signal(signal.SIGTERM, handle_sigint)
 
-	for i in range(n):
-		period, composer, instrumentation = random.choice(prompt_list)
-		print(f"\033[1;94mGenerating {i+1}/{n} piece...\033[0m")
-		abc_content = inference_patch(period, composer, instrumentation)
+	def save(abc_content):
 		md5_hash = hashlib.md5(abc_content.encode('utf-8')).hexdigest()
 		dir = f'{md5_hash[:2]}/{md5_hash[2:4]}'
 		os.makedirs(f'{target_dir}/{dir}', exist_ok=True)
 		with open(f'{target_dir}/{dir}/{md5_hash}.abc', 'w') as f:
 			f.write(abc_content)
 
+	progress = LineProgress()
+
+	if checkpoint is not None:
+		if workers > 0:
+			raise typer.BadParameter('--checkpoint does not apply to the pieces of --workers')
+
+		# the pieces go through one BatchGenerator, whose state is saved between its steps
+		generator = BatchGenerator(batch_size=max(batch_size, variations))
+		num_saved = 0
+		if os.path.exists(checkpoint):
+			state = load_generation(checkpoint)
+			num_saved = state['num_saved']
+			generator.load_state_dict(state, on_event=progress)
+			print(f"\033[1;94mResumed {len(state['pieces'])} pieces in progress and {len(state['queue'])} queued from {checkpoint}.\033[0m")
+		else:
+			for i in range(n):
+				period, composer, instrumentation = random.choice(prompt_list)
+				if variations > 1:
+					generator.submit_variations([(i, v) for v in range(variations)], period, composer, instrumentation,
+												branch_lines, on_event=progress)
+				else:
+					generator.submit(i, period, composer, instrumentation, on_event=progress)
+
+		save_time = time.time()
+		while generator.busy:
+			for _, abc_content in generator.step():
+				progress.close()
+				num_saved += 1
+				print(f"\033[1;94mGenerated {num_saved}/{n * variations} piece.\033[0m")
+				save(abc_content)
+
+			# a signal is answered within one step, i.e. one patch of each piece
+			if to_quit or time.time() - save_time > checkpoint_interval:
+				state = generator.state_dict(cache=checkpoint_cache)
+				state['num_saved'] = num_saved
+				save_generation(checkpoint, state)
+				save_time = time.time()
+				if to_quit:
+					progress.close()
+					print(f"Safe shutdown, the pieces in progress are saved to {checkpoint}.")
+					return
+		if os.path.exists(checkpoint):
+			os.remove(checkpoint)
+		return
+
+	if variations > 1:
+		for i in range(n):
+			period, composer, instrumentation = random.choice(prompt_list)
+			print(f"\033[1;94mGenerating {variations} variations of {i+1}/{n} piece...\033[0m")
+			pieces = generate_variations(period, composer, instrumentation, variations, branch_lines,
+										 batch_size=max(batch_size, variations), on_event=progress)
+			for _, abc_content in pieces:
+				save(abc_content)
+			progress.close()
+
+			if to_quit:
+				print("Safe shutdown.")
+				break
+		return
+
+	if workers > 0:
+		with CPUWorkerPool(workers, threads_per_worker=threads) as pool:
+			pieces = pool.generate_pieces([random.choice(prompt_list) for _ in range(n)])
+			for i, (_, abc_content) in enumerate(pieces):
+				print(f"\033[1;94mGenerated {i+1}/{n} piece.\033[0m")
+				save(abc_content)
+
+				if to_quit:
+					print("Safe shutdown, finishing the pieces in progress...")
+					break
+		return
+
+	if batch_size > 1:
+		pieces = generate_pieces([random.choice(prompt_list) for _ in range(n)], batch_size=batch_size, on_event=progress)
+		for i, (_, abc_content) in enumerate(pieces):
+			progress.close()
+			print(f"\033[1;94mGenerated {i+1}/{n} piece.\033[0m")
+			save(abc_content)
+
+			if to_quit:
+				print("Safe shutdown.")
+				break
+		return
+
+	for i in range(n):
+		period, composer, instrumentation = random.choice(prompt_list)
+		print(f"\033[1;94mGenerating {i+1}/{n} piece...\033[0m")
+		abc_content = inference_patch(period, composer, instrumentation, on_event=progress)
+		progress.close()
+		save(abc_content)
+
 		if to_quit:
 			print("Safe shutdown.")
 			break